@@ -91,6 +91,17 @@ DATABASES = {
 }
 
 
+# Cache
+# File-based so every gunicorn worker sees the same data version and cached reports
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': BASE_DIR / 'cache',
+    }
+}
+
+
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
 
@@ -170,8 +181,27 @@ STATIC_ROOT = BASE_DIR / "staticfiles"
 MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 
+# Uploaded documents (these MEDIA_ROOT folders) are served by
+# invent.views.protected_media after a scope check; other media is public.
+PROTECTED_MEDIA_DIRS = ('payment_proofs', 'purchase_orders')
+# Set to 'x-accel-redirect' (nginx, with an `internal` location at
+# PROTECTED_MEDIA_INTERNAL_URL aliased to MEDIA_ROOT) or 'x-sendfile'
+# (Apache mod_xsendfile / lighttpd) to let the front proxy send the bytes.
+PROTECTED_MEDIA_SENDFILE = None
+PROTECTED_MEDIA_INTERNAL_URL = '/protected-media/'
+
+# Resumable chunked uploads (large inventory workbooks) are assembled here
+CHUNKED_UPLOAD_DIR = os.path.join(BASE_DIR, 'upload_sessions')
+
+# Worker processes for parsing shipments in manage.py receive_workbooks (None: one per CPU)
+INVENTORY_INGEST_WORKERS = None
+
 BRANCH_ADMIN_ASSIGNABLE_GROUPS = [
     'Requestor',
     'Storeclerk',
     'Branch Admin',
 ]
+
+# How long IMEIs picked in select_imeis stay held before
+# `python manage.py release_expired_reservations` returns them to stock
+IMEI_RESERVATION_HOURS = 48
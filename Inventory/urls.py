@@ -31,5 +31,7 @@ urlpatterns = [
          name='password_reset_complete'),
 ]
 
+# Uploaded documents under MEDIA_URL match invent.views.protected_media above,
+# which checks access first; the rest of the media is public
 if settings.DEBUG:
-    urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
\ No newline at end of file
+    urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
@@ -24,14 +24,21 @@ from .models import (
     IssuanceRecord,
     ReturnRecord,
     DeviceRequest,
+    DeviceOrder,
     Profile,
     Country,
     DeviceIMEI,
     DeviceRequestSelectedIMEI,
     SelectedDevice, 
-    DeviceReports
+    DeviceReports,
+    ClientHolding,
+    identifier_q,
+    is_exact_identifier,
 )
 from django.shortcuts import render, redirect
+from .issuance import approve_selected_requests, reject_open_requests
+from .stock import AllocationError
+from .storage import THUMBNAIL_SUFFIX
 
 # Removed openpyxl and DeviceUploadForm imports that were part of the old, incorrect bulk upload logic
 
@@ -364,6 +371,7 @@ class SelectedDeviceInline(admin.TabularInline):
 class DeviceRequestAdmin(admin.ModelAdmin):
     list_display = (
         'id',
+        'order',
         'device',
         'requestor',
         'client',
@@ -385,91 +393,121 @@ class DeviceRequestAdmin(admin.ModelAdmin):
 
     inlines = [SelectedDeviceInline]
 
+    readonly_fields = ('payment_proof_preview',)
+
     actions = ['approve_requests', 'reject_requests']
 
+    def get_queryset(self, request):
+        return super().get_queryset(request).select_related('order')
+
+    def payment_proof_preview(self, obj):
+        return proof_thumbnail(obj.proof)
+    payment_proof_preview.short_description = 'Payment proof'
+
     @admin.action(description="✅ Approve selected IMEIs")
     def approve_requests(self, request, queryset):
-        approved_count = 0
-
-        for device_request in queryset:
-            if device_request.status != 'Waiting Approval':
-                continue
-
-            # NOTE: Use the correct related name 'selected_imeis'
-            selections = device_request.selected_imeis.filter(approved=False, rejected=False)
-            
-            # Quantity enforcement
-            if selections.count() != device_request.quantity:
-                self.message_user(
-                    request,
-                    f"Request #{device_request.id}: selected IMEIs "
-                    f"({selections.count()}) do not match quantity ({device_request.quantity})",
-                    level=messages.ERROR
-                )
-                continue
-
-            can_approve = True
-            imeis_to_issue = []
-            for selection in selections:
-                imei = selection.imei
-                if not imei.is_available:
-                    self.message_user(
-                        request,
-                        f"IMEI {imei.imei_number} is no longer available.",
-                        level=messages.ERROR
-                    )
-                    can_approve = False
-                    break
-                imeis_to_issue.append(imei)
-            
-            if not can_approve:
-                continue
-
-            for imei in imeis_to_issue:
-                # Lock IMEI (Assuming mark_unavailable() is a method on DeviceIMEI)
-                imei.is_available = False # Direct update if mark_unavailable doesn't exist
-                imei.save(update_fields=['is_available'])
-                
-                # Create issuance record
-                IssuanceRecord.objects.create(
-                    device=imei.device,
-                    imei=imei, # Pass the DeviceIMEI object
-                    client=device_request.client,
-                    logistics_manager=request.user,
-                    device_request=device_request
-                )
-
-            # Mark all selections for this request as approved
-            selections.update(approved=True)
-            
-            device_request.status = 'Approved'
-            device_request.date_issued = timezone.now()
-            device_request.save(update_fields=['status', 'date_issued'])
-
-            approved_count += 1
+        try:
+            approved, errors = approve_selected_requests(queryset.values_list('pk', flat=True), request.user)
+        except AllocationError as e:
+            self.message_user(request, str(e), level=messages.ERROR)
+            return
+
+        for pk, error in sorted(errors.items()):
+            self.message_user(request, f"Request #{pk}: {error}", level=messages.ERROR)
 
         self.message_user(
             request,
-            f"{approved_count} request(s) approved successfully.",
+            f"{len(approved)} request(s) approved successfully.",
             level=messages.SUCCESS
         )
 
     @admin.action(description="❌ Reject selected requests")
     def reject_requests(self, request, queryset):
-        rejected = 0
+        rejected = reject_open_requests(queryset.values_list('pk', flat=True))
+
+        self.message_user(
+            request,
+            f"{len(rejected)} request(s) rejected.",
+            level=messages.ERROR
+        )
+
+
+def proof_thumbnail(proof):
+    """Inline thumbnail linking to the full proof; the thumbnail is a few KB instead of the scan."""
+    if not proof:
+        return "-"
+    return format_html(
+        '<a href="{}" target="_blank"><img src="{}{}" alt="{}" loading="lazy" '
+        'style="max-width:120px; max-height:120px; border:1px solid #ddd"></a>',
+        proof.url, proof.url, THUMBNAIL_SUFFIX, "View proof",
+    )
+
+
+# DeviceOrder admin: approve or reject every line of an order at once
+
+class DeviceRequestLineInline(admin.TabularInline):
+    model = DeviceRequest
+    fk_name = 'order'
+    extra = 0
+    fields = ('id', 'device', 'quantity', 'branch', 'status', 'date_issued')
+    readonly_fields = fields
+    show_change_link = True
+
+    def has_add_permission(self, request, obj=None):
+        return False
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).select_related('device', 'branch')
+
 
-        for device_request in queryset:
-            if device_request.status == 'Pending':
-                device_request.status = 'Rejected'
-                device_request.save(update_fields=['status'])
-                rejected += 1
-                
-                # Release any selected IMEIs that were not approved/rejected yet (safety)
-                device_request.selected_imeis.filter(approved=False, rejected=False).update(rejected=True)
+@admin.register(DeviceOrder)
+class DeviceOrderAdmin(admin.ModelAdmin):
+    list_display = ('id', 'requestor', 'client', 'line_count', 'proof_preview', 'date_requested')
+    search_fields = ('id', 'requestor__username', 'client__name', 'lines__device__name')
+    list_select_related = ('requestor', 'client')
+    readonly_fields = ('proof_preview',)
+    inlines = [DeviceRequestLineInline]
+    actions = ['approve_orders', 'reject_orders']
+
+    def proof_preview(self, obj):
+        return proof_thumbnail(obj.payment_proof)
+    proof_preview.short_description = 'Payment proof'
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).annotate(line_total=Count('lines'))
+
+    def line_count(self, obj):
+        return obj.line_total
+    line_count.short_description = 'Lines'
+    line_count.admin_order_field = 'line_total'
+
+    @admin.action(description="✅ Approve selected orders")
+    def approve_orders(self, request, queryset):
+        line_ids = DeviceRequest.objects.filter(order__in=queryset).values_list('pk', flat=True)
+        try:
+            approved, errors = approve_selected_requests(line_ids, request.user)
+        except AllocationError as e:
+            self.message_user(request, str(e), level=messages.ERROR)
+            return
+
+        for pk, error in sorted(errors.items()):
+            self.message_user(request, f"Request #{pk}: {error}", level=messages.ERROR)
+
+        self.message_user(
+            request,
+            f"{len(approved)} line(s) approved successfully.",
+            level=messages.SUCCESS
+        )
+
+    @admin.action(description="❌ Reject selected orders")
+    def reject_orders(self, request, queryset):
+        rejected = reject_open_requests(
+            DeviceRequest.objects.filter(order__in=queryset).values_list('pk', flat=True)
+        )
 
         self.message_user(
             request,
-            f"{rejected} request(s) rejected.",
+            f"{len(rejected)} line(s) rejected.",
             level=messages.ERROR
         )
 
@@ -484,8 +522,28 @@ class PurchaseOrderAdmin(ImportExportModelAdmin, BranchScopedAdmin):
 # IssuanceRecord admin (fallback to device.branch)
 
 
+class IdentifierSearchMixin:
+    """
+    A search term that can only be a full IMEI or MAC address is an exact
+    lookup on the indexed integer key columns (or the serial), instead of a
+    substring scan over every search field. Other terms that still read as
+    one (twelve hex characters) search as usual, plus the key match.
+    """
+    identifier_prefix = ''  # path to DeviceIMEI, e.g. 'imei__'
+
+    def get_search_results(self, request, queryset, search_term):
+        term = search_term.strip()
+        keys = identifier_q(term, self.identifier_prefix)
+        if keys is not None and is_exact_identifier(term):
+            return queryset.filter(keys | Q(**{f'{self.identifier_prefix}serial_no': term})), False
+        results, may_have_duplicates = super().get_search_results(request, queryset, search_term)
+        if keys is not None:
+            results |= queryset.filter(keys)
+        return results, may_have_duplicates
+
+
 @admin.register(IssuanceRecord)
-class IssuanceRecordAdmin(BranchScopedAdmin):
+class IssuanceRecordAdmin(IdentifierSearchMixin, BranchScopedAdmin):
     # FIX: Added imei back to display
     list_display = ('device', 'imei', 'client', 'logistics_manager', 'issued_at') 
     # FIX: Search on imei fields, not old device fields
@@ -495,6 +553,7 @@ class IssuanceRecordAdmin(BranchScopedAdmin):
         'client__name', 
         'logistics_manager__username'
     )
+    identifier_prefix = 'imei__'
     branch_field = None
 # ReturnRecord admin
 
@@ -507,10 +566,19 @@ class ReturnRecordAdmin(BranchScopedAdmin):
     branch_field = None
 
 
+@admin.register(ClientHolding)
+class ClientHoldingAdmin(IdentifierSearchMixin, BranchScopedAdmin):
+    list_display = ('imei', 'client', 'device', 'issued_at')
+    search_fields = ('imei__imei_number', 'imei__serial_no', 'client__name')
+    identifier_prefix = 'imei__'
+    list_select_related = ('imei__device', 'client', 'device')
+    branch_field = None
+
+
 @admin.register(DeviceIMEI)
-class DeviceIMEIAdmin(BranchScopedAdmin):
+class DeviceIMEIAdmin(IdentifierSearchMixin, BranchScopedAdmin):
     # FIX: Added serial_no/mac_address for better visibility
-    list_display = ('imei_number', 'serial_no', 'mac_address', 'device', 'is_available') 
+    list_display = ('imei_number', 'serial_no', 'mac_address', 'device', 'is_available', 'current_client')
     # FIX: Search fields adjusted
     search_fields = ('imei_number', 'serial_no', 'mac_address', 'device__name', 'device__category')
     list_filter = ('is_available',)
@@ -0,0 +1,342 @@
+"""
+Demand and turnover analytics over the request / issuance / return history.
+
+The history is pulled once per table with values_list() into NumPy arrays and
+every metric is computed with vectorized group-bys (bincount over a dense
+device index), so the reports page never walks rows in Python or templates.
+Results are cached per data version (see invent.utils.get_data_version).
+"""
+import math
+
+import numpy as np
+from django.core.cache import cache
+from django.db.models import Count, Sum
+from django.db.models.functions import TruncMonth
+from django.utils import timezone
+
+from .models import Branch, Device, DeviceRequest, IssuanceRecord, ReturnRecord, available_unit_q
+from .utils import get_data_version
+
+HISTORY_DAYS = 730          # two years of history
+ROLLING_WEEKS = 4           # window used for the "current" demand rate
+CACHE_TIMEOUT = 60 * 60     # safety net; the data version does the real invalidation
+
+SECONDS_PER_DAY = 86400.0
+SECONDS_PER_WEEK = 7 * SECONDS_PER_DAY
+
+
+def _timestamps(values):
+    """Aware datetimes -> float64 epoch seconds (NaN for missing values)."""
+    return np.fromiter(
+        (v.timestamp() if v is not None else np.nan for v in values),
+        dtype=np.float64,
+        count=len(values),
+    )
+
+
+def _dense_index(device_ids, keys):
+    """Map device ids onto rows of the (sorted) device_ids array; -1 if out of scope."""
+    keys = np.asarray(keys, dtype=np.int64)
+    if not len(device_ids) or not len(keys):
+        return np.full(len(keys), -1, dtype=np.int64)
+    pos = np.searchsorted(device_ids, keys)
+    pos = np.clip(pos, 0, len(device_ids) - 1)
+    return np.where(device_ids[pos] == keys, pos, -1)
+
+
+def _group_percentile(groups, values, n_groups, q):
+    """Linear-interpolated percentile of `values` per group (NaN for empty groups)."""
+    out = np.full(n_groups, np.nan)
+    if not len(values):
+        return out
+    order = np.lexsort((values, groups))
+    groups, values = groups[order], values[order]
+    counts = np.bincount(groups, minlength=n_groups)
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    has = counts > 0
+    rank = (counts[has] - 1) * (q / 100.0)
+    lo = np.floor(rank).astype(np.int64)
+    hi = np.ceil(rank).astype(np.int64)
+    frac = rank - lo
+    base = starts[has]
+    out[has] = values[base + lo] * (1 - frac) + values[base + hi] * frac
+    return out
+
+
+def _rolling_sum(matrix, window):
+    """Trailing sum over `window` columns for each row (column 0 is the most recent week)."""
+    padded = np.concatenate((np.zeros((matrix.shape[0], 1)), np.cumsum(matrix, axis=1)), axis=1)
+    n_cols = matrix.shape[1]
+    ends = np.minimum(np.arange(n_cols) + window, n_cols)
+    return padded[:, ends] - padded[:, :n_cols]
+
+
+def _clean(value, digits=1):
+    if value is None or (isinstance(value, float) and (math.isnan(value) or math.isinf(value))):
+        return None
+    return round(float(value), digits)
+
+
+def compute_device_analytics(country=None, now=None):
+    """
+    Per-device (and per-branch) demand and turnover metrics.
+
+    - demand rate: units requested per week, long-run and over the last ROLLING_WEEKS
+    - days to issue: mean / median / 90th percentile from request to issuance
+    - return rate: units returned / units issued
+    - weeks of cover: available units / current weekly demand
+    """
+    now = now or timezone.now()
+    since = now - timezone.timedelta(days=HISTORY_DAYS)
+    n_weeks = int(math.ceil(HISTORY_DAYS / 7))
+    now_ts = now.timestamp()
+
+    devices_qs = Device.objects.all()
+    if country is not None:
+        devices_qs = devices_qs.filter(branch__country=country)
+
+    # -------------------- Devices (dense index + availability) -------------------- #
+    device_rows = list(
+        devices_qs.annotate(
+            available_units=Count('imeis', filter=available_unit_q('imeis__'))
+        ).order_by('id').values_list(
+            'id', 'name', 'category', 'oem__name', 'branch_id', 'branch__name', 'available_units'
+        )
+    )
+    n_dev = len(device_rows)
+    device_ids = np.fromiter((r[0] for r in device_rows), dtype=np.int64, count=n_dev)
+    available = np.fromiter((r[6] for r in device_rows), dtype=np.float64, count=n_dev)
+
+    # -------------------- Requests: demand -------------------- #
+    req = list(
+        DeviceRequest.objects.filter(device__in=devices_qs, date_requested__gte=since)
+        .values_list('device_id', 'quantity', 'date_requested')
+    )
+    req_idx = _dense_index(device_ids, [r[0] for r in req])
+    req_qty = np.fromiter((r[1] for r in req), dtype=np.float64, count=len(req))
+    req_age = (now_ts - _timestamps([r[2] for r in req])) / SECONDS_PER_WEEK
+    keep = (req_idx >= 0) & (req_age >= 0)
+    req_idx, req_qty = req_idx[keep], req_qty[keep]
+    req_week = np.minimum(req_age[keep].astype(np.int64), n_weeks - 1)
+
+    requested = np.bincount(req_idx, weights=req_qty, minlength=n_dev)
+    weekly = np.bincount(
+        req_idx * n_weeks + req_week, weights=req_qty, minlength=n_dev * n_weeks
+    ).reshape(n_dev, n_weeks)
+
+    # Weeks of history per device: from its first request up to now
+    oldest_week = np.full(n_dev, -1, dtype=np.int64)
+    np.maximum.at(oldest_week, req_idx, req_week)
+    span_weeks = np.where(oldest_week >= 0, oldest_week + 1, 1).astype(np.float64)
+
+    rolling = _rolling_sum(weekly, ROLLING_WEEKS) / ROLLING_WEEKS
+    current_rate = rolling[:, 0]
+    peak_rate = rolling.max(axis=1) if n_weeks else np.zeros(n_dev)
+    long_run_rate = requested / span_weeks
+
+    # -------------------- Issuances: lead time -------------------- #
+    iss = list(
+        IssuanceRecord.objects.filter(device__in=devices_qs, issued_at__gte=since)
+        .values_list('device_id', 'issued_at', 'device_request__date_requested')
+    )
+    iss_idx = _dense_index(device_ids, [r[0] for r in iss])
+    iss_at = _timestamps([r[1] for r in iss])
+    iss_req_at = _timestamps([r[2] for r in iss])
+    keep = iss_idx >= 0
+    issued = np.bincount(iss_idx[keep], minlength=n_dev).astype(np.float64)
+
+    lead_mask = keep & ~np.isnan(iss_req_at)
+    lead_idx = iss_idx[lead_mask]
+    lead_days = np.maximum(iss_at[lead_mask] - iss_req_at[lead_mask], 0) / SECONDS_PER_DAY
+    lead_n = np.bincount(lead_idx, minlength=n_dev)
+    lead_sum = np.bincount(lead_idx, weights=lead_days, minlength=n_dev)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        avg_days = np.where(lead_n > 0, lead_sum / lead_n, np.nan)
+    p50_days = _group_percentile(lead_idx, lead_days, n_dev, 50)
+    p90_days = _group_percentile(lead_idx, lead_days, n_dev, 90)
+
+    # -------------------- Returns -------------------- #
+    ret = list(
+        ReturnRecord.objects.filter(device__in=devices_qs, returned_at__gte=since)
+        .values_list('device_id', flat=True)
+    )
+    ret_idx = _dense_index(device_ids, ret)
+    returned = np.bincount(ret_idx[ret_idx >= 0], minlength=n_dev).astype(np.float64)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return_rate = np.where(issued > 0, returned / issued, np.nan)
+        cover_rate = np.where(current_rate > 0, current_rate, long_run_rate)
+        weeks_of_cover = np.where(cover_rate > 0, available / cover_rate, np.inf)
+
+    rows = []
+    for i, (dev_id, name, category, oem_name, branch_id, branch_name, _) in enumerate(device_rows):
+        rows.append({
+            'device_id': dev_id,
+            'device': name,
+            'category': category or '-',
+            'oem': oem_name or '-',
+            'branch_id': branch_id,
+            'branch': branch_name or '-',
+            'available': int(available[i]),
+            'requested': int(requested[i]),
+            'issued': int(issued[i]),
+            'returned': int(returned[i]),
+            'demand_per_week': _clean(long_run_rate[i], 2),
+            'current_demand_per_week': _clean(current_rate[i], 2),
+            'peak_demand_per_week': _clean(peak_rate[i], 2),
+            'avg_days_to_issue': _clean(avg_days[i]),
+            'median_days_to_issue': _clean(p50_days[i]),
+            'p90_days_to_issue': _clean(p90_days[i]),
+            'return_rate': _clean(return_rate[i] * 100 if issued[i] else None),
+            'weeks_of_cover': _clean(weeks_of_cover[i]),
+        })
+
+    # -------------------- Branch roll-up -------------------- #
+    branch_keys = np.fromiter(
+        (r[4] if r[4] is not None else -1 for r in device_rows), dtype=np.int64, count=n_dev
+    )
+    branch_ids, branch_idx = np.unique(branch_keys, return_inverse=True)
+    n_br = len(branch_ids)
+    br = {
+        name: np.bincount(branch_idx, weights=arr, minlength=n_br)
+        for name, arr in (
+            ('available', available), ('requested', requested), ('issued', issued),
+            ('returned', returned), ('current_rate', current_rate), ('long_run_rate', long_run_rate),
+        )
+    }
+    br_lead_n = np.bincount(branch_idx, weights=lead_n, minlength=n_br)
+    br_lead_sum = np.bincount(branch_idx, weights=lead_sum, minlength=n_br)
+    branch_names = {r[4]: r[5] for r in device_rows}
+
+    branches = []
+    with np.errstate(invalid='ignore', divide='ignore'):
+        for j, branch_id in enumerate(branch_ids.tolist()):
+            rate = br['current_rate'][j] or br['long_run_rate'][j]
+            branches.append({
+                'branch': branch_names.get(None if branch_id == -1 else branch_id) or '-',
+                'available': int(br['available'][j]),
+                'requested': int(br['requested'][j]),
+                'issued': int(br['issued'][j]),
+                'returned': int(br['returned'][j]),
+                'demand_per_week': _clean(br['long_run_rate'][j], 2),
+                'current_demand_per_week': _clean(br['current_rate'][j], 2),
+                'avg_days_to_issue': _clean(br_lead_sum[j] / br_lead_n[j] if br_lead_n[j] else None),
+                'return_rate': _clean(br['returned'][j] / br['issued'][j] * 100 if br['issued'][j] else None),
+                'weeks_of_cover': _clean(br['available'][j] / rate if rate else None),
+            })
+
+    return {
+        'rows': rows,
+        'branches': branches,
+        'history_days': HISTORY_DAYS,
+        'rolling_weeks': ROLLING_WEEKS,
+        'generated_at': now,
+    }
+
+
+def get_device_analytics(country=None):
+    """Cached wrapper around compute_device_analytics(), keyed by scope and data version."""
+    scope = country.pk if country is not None else 'all'
+    key = f"invent:analytics:{scope}:{get_data_version()}"
+    result = cache.get(key)
+    if result is None:
+        result = compute_device_analytics(country=country)
+        cache.set(key, result, CACHE_TIMEOUT)
+    return result
+
+
+# -------------------- Branch x Device x Month Pivot -------------------- #
+
+PIVOT_MEASURES = ('Requested', 'Issued', 'Returned')
+
+
+def _month_key(dt):
+    return dt.year * 12 + dt.month - 1
+
+
+def build_pivot(country=None, months=12, now=None):
+    """
+    Units requested / issued / returned per (branch, device) and month.
+
+    Each measure is one GROUP BY branch, device, TruncMonth(...) query; the
+    grouped rows are scattered into a dense (measure, branch-device, month) array.
+    Returns (row_labels, month_labels, matrix).
+    """
+    now = timezone.localtime(now or timezone.now())
+    last_month = _month_key(now)
+    first_month = last_month - months + 1
+    start = now.replace(
+        year=first_month // 12, month=first_month % 12 + 1, day=1,
+        hour=0, minute=0, second=0, microsecond=0,
+    )
+
+    requests_qs = DeviceRequest.objects.filter(date_requested__gte=start)
+    issuance_qs = IssuanceRecord.objects.filter(issued_at__gte=start)
+    returns_qs = ReturnRecord.objects.filter(returned_at__gte=start)
+    if country is not None:
+        requests_qs = requests_qs.filter(branch__country=country)
+        issuance_qs = issuance_qs.filter(device__branch__country=country)
+        returns_qs = returns_qs.filter(device__branch__country=country)
+
+    grouped = [
+        requests_qs.annotate(month=TruncMonth('date_requested'))
+        .values_list('branch_id', 'device_id', 'month')
+        .annotate(units=Sum('quantity')).order_by(),
+        issuance_qs.annotate(month=TruncMonth('issued_at'))
+        .values_list('device__branch_id', 'device_id', 'month')
+        .annotate(units=Count('id')).order_by(),
+        returns_qs.annotate(month=TruncMonth('returned_at'))
+        .values_list('device__branch_id', 'device_id', 'month')
+        .annotate(units=Count('id')).order_by(),
+    ]
+
+    measures = []
+    for rows in grouped:
+        rows = list(rows)
+        n = len(rows)
+        measures.append((
+            np.fromiter((r[0] or 0 for r in rows), dtype=np.int64, count=n),
+            np.fromiter((r[1] for r in rows), dtype=np.int64, count=n),
+            np.fromiter((_month_key(r[2]) for r in rows), dtype=np.int64, count=n) - first_month,
+            np.fromiter((r[3] or 0 for r in rows), dtype=np.int64, count=n),
+        ))
+
+    # Row axis: every (branch, device) pair seen in any measure
+    all_branches = np.concatenate([m[0] for m in measures])
+    all_devices = np.concatenate([m[1] for m in measures])
+    stride = int(all_devices.max()) + 1 if len(all_devices) else 1
+    pair_keys, inverse = np.unique(all_branches * stride + all_devices, return_inverse=True)
+
+    matrix = np.zeros((len(PIVOT_MEASURES), len(pair_keys), months), dtype=np.int64)
+    offset = 0
+    for m, (_, _, month_idx, units) in enumerate(measures):
+        rows_idx = inverse[offset:offset + len(units)]
+        offset += len(units)
+        in_window = (month_idx >= 0) & (month_idx < months)
+        np.add.at(matrix[m], (rows_idx[in_window], month_idx[in_window]), units[in_window])
+
+    branch_ids = (pair_keys // stride).tolist()
+    device_ids = (pair_keys % stride).tolist()
+    branches = Branch.objects.in_bulk(set(branch_ids) - {0})
+    devices = {
+        d[0]: d[1:] for d in Device.objects.filter(id__in=set(device_ids))
+        .values_list('id', 'name', 'category', 'oem__name')
+    }
+
+    row_labels = []
+    for branch_id, device_id in zip(branch_ids, device_ids):
+        branch = branches.get(branch_id)
+        name, category, oem_name = devices.get(device_id, ('-', '-', '-'))
+        row_labels.append((branch.name if branch else '-', category or '-', oem_name or '-', name))
+
+    month_labels = [f"{(first_month + i) // 12}-{(first_month + i) % 12 + 1:02d}" for i in range(months)]
+    return row_labels, month_labels, matrix
+
+
+def iter_pivot_rows(row_labels, month_labels, matrix):
+    """Yield the header and one flat row per (branch, device, measure)."""
+    yield ['Branch', 'Category', 'OEM', 'Device', 'Measure'] + month_labels + ['Total']
+    totals = matrix.sum(axis=2)
+    for r, labels in enumerate(row_labels):
+        for m, measure in enumerate(PIVOT_MEASURES):
+            yield list(labels) + [measure] + matrix[m, r].tolist() + [int(totals[m, r])]
@@ -0,0 +1,163 @@
+"""
+In-process membership index over the unit identifiers already in the
+database (imei_number, serial_no, mac_address), used by receiving to find
+duplicates without a database round trip per identifier.
+
+Each identifier is hashed to an int64 key (IMEIs and MACs use their integer
+form instead). Per field, a Bloom filter answers
+"definitely new" for most of an upload in one vectorized pass, and a sorted
+array of every key confirms the filter's hits with searchsorted. Only the
+confirmed hits, which are nearly always real duplicates, are checked
+against the database, so a 100k-row file of new units costs no lookup
+queries at all.
+
+The index is loaded once per process and then topped up from a high-water
+mark on DeviceIMEI.id. Deleted or renumbered units leave stale keys behind,
+which only cost a database check. An edited identifier, or a row committed
+late below the mark, is missed until the next full rebuild, so callers must
+still treat an IntegrityError on insert as "recheck against the database".
+"""
+import threading
+import time
+
+import numpy as np
+
+from .models import DeviceIMEI
+from .validation import imei_ints, mac_ints
+
+FIELDS = ('imei_number', 'serial_no', 'mac_address')
+# IMEIs and MACs are keyed by their integer form (as in DeviceIMEI.imei_key /
+# mac_key), so '35-209900-176148-1' and '352099001761481' are one identifier
+INTEGER_KEYS = {'imei_number': imei_ints, 'mac_address': mac_ints}
+BITS_PER_KEY = 10           # with HASH_COUNT probes: ~1% false positives
+HASH_COUNT = 7
+MIN_CAPACITY = 1 << 16
+REBUILD_SECONDS = 15 * 60   # full reload, dropping deleted and edited identifiers
+LOAD_CHUNK_SIZE = 50000
+
+
+def identifier_keys(values):
+    """
+    int64 keys for a sequence of identifier strings: FNV-1a over the UTF-8
+    bytes, one column of the padded byte matrix at a time, then the
+    MurmurHash3 finalizer so both 32-bit halves are well mixed.
+    """
+    if not len(values):
+        return np.zeros(0, dtype=np.int64)
+    raw = np.array([value.encode() for value in values], dtype=np.bytes_)
+    codes = raw.view(np.uint8).reshape(len(raw), -1)
+    keys = np.full(len(raw), 0xCBF29CE484222325, dtype=np.uint64)
+    for column in codes.T.astype(np.uint64):
+        # Padding bytes are NUL; skipping them keeps a key independent of the batch's widest value
+        keys = np.where(column != 0, (keys ^ column) * np.uint64(0x100000001B3), keys)
+    keys ^= keys >> np.uint64(33)
+    keys *= np.uint64(0xFF51AFD7ED558CCD)
+    keys ^= keys >> np.uint64(33)
+    keys *= np.uint64(0xC4CEB9FE1A85EC53)
+    keys ^= keys >> np.uint64(33)
+    return keys.view(np.int64)
+
+
+def field_keys(field, values):
+    """int64 keys for values of one identifier field."""
+    keys = identifier_keys(values)
+    if field in INTEGER_KEYS and len(keys):
+        ints, has_int = INTEGER_KEYS[field](values)
+        keys[has_int] = ints[has_int]
+    return keys
+
+
+class _FieldIndex:
+    """Bloom filter plus sorted key array for one identifier field."""
+
+    def __init__(self, keys):
+        self._build(keys)
+
+    def _build(self, keys):
+        self.keys = np.unique(keys)
+        self.capacity = max(MIN_CAPACITY, 2 * len(self.keys))
+        self.n_bits = self.capacity * BITS_PER_KEY
+        self.bits = np.zeros((self.n_bits + 7) // 8, dtype=np.uint8)
+        self._set_bits(self.keys)
+
+    def _positions(self, keys):
+        # Double hashing: probe i is h1 + i * h2 (mod n_bits)
+        unsigned = keys.view(np.uint64)
+        h1 = unsigned & np.uint64(0xFFFFFFFF)
+        h2 = (unsigned >> np.uint64(32)) | np.uint64(1)
+        probes = np.arange(HASH_COUNT, dtype=np.uint64)
+        return (h1[:, None] + probes[None, :] * h2[:, None]) % np.uint64(self.n_bits)
+
+    def _set_bits(self, keys):
+        positions = self._positions(keys).ravel()
+        np.bitwise_or.at(self.bits, positions >> np.uint64(3),
+                         np.left_shift(np.uint64(1), positions & np.uint64(7)).astype(np.uint8))
+
+    def add(self, keys):
+        if not len(keys):
+            return
+        self.keys = np.union1d(self.keys, keys)
+        if len(self.keys) > self.capacity:
+            self._build(self.keys)
+        else:
+            self._set_bits(keys)
+
+    def contains(self, keys):
+        """Boolean array: True where the key is (almost certainly) present."""
+        hits = np.zeros(len(keys), dtype=bool)
+        if not len(keys) or not len(self.keys):
+            return hits
+        positions = self._positions(keys)
+        bits = (self.bits[positions >> np.uint64(3)] >> (positions & np.uint64(7)).astype(np.uint8)) & 1
+        maybe = np.flatnonzero(bits.all(axis=1))
+        if len(maybe):
+            candidates = keys[maybe]
+            found = np.searchsorted(self.keys, candidates)
+            found = np.clip(found, 0, len(self.keys) - 1)
+            hits[maybe] = self.keys[found] == candidates
+        return hits
+
+
+class IdentifierIndex:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.fields = None
+        self.high_water = 0
+        self.built_at = 0.0
+
+    def _load(self, after_id):
+        """Keys per field for units with id > after_id, and the highest id seen."""
+        values = {field: [] for field in FIELDS}
+        high_water = after_id
+        rows = DeviceIMEI.objects.filter(id__gt=after_id).order_by('id').values_list('id', *FIELDS)
+        for row in rows.iterator(chunk_size=LOAD_CHUNK_SIZE):
+            high_water = row[0]
+            for field, value in zip(FIELDS, row[1:]):
+                if value:
+                    values[field].append(value)
+        return {field: field_keys(field, v) for field, v in values.items()}, high_water
+
+    def refresh(self):
+        with self.lock:
+            if self.fields is None or time.monotonic() - self.built_at > REBUILD_SECONDS:
+                keys, self.high_water = self._load(0)
+                self.fields = {field: _FieldIndex(keys[field]) for field in FIELDS}
+                self.built_at = time.monotonic()
+            else:
+                keys, self.high_water = self._load(self.high_water)
+                for field in FIELDS:
+                    self.fields[field].add(keys[field])
+        return self
+
+    def contains(self, field, values):
+        """Boolean array over `values`: True where the identifier probably exists in `field`."""
+        return self.fields[field].contains(field_keys(field, values))
+
+
+_index = IdentifierIndex()
+
+
+def identifier_index():
+    """The process-wide index, topped up with units added since it was last used."""
+    return _index.refresh()
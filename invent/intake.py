@@ -0,0 +1,249 @@
+"""
+Request intake: validate and create device requests in batches.
+
+A multi-line request (form or upload) is resolved with one query for all of
+its (OEM, category, name) lines, annotated with available units, validated in
+memory, and then written in one short transaction as one DeviceOrder with a
+DeviceRequest line per device: one conditional promise UPDATE per device, then
+bulk inserts. Mail goes out after commit.
+"""
+import csv
+import io
+import itertools
+from collections import defaultdict
+
+import openpyxl
+from django.contrib.auth.models import User
+from django.core.mail import send_mail
+from django.db import transaction
+from django.db.models import Count
+
+from .models import OEM, Device, DeviceOrder, DeviceRequest, DeviceSelectionGroup, available_unit_q
+from .stock import promise_units
+from .thumbnails import make_thumbnail
+from .sheets import cell_text
+from .utils import bump_data_version, run_after_commit
+
+
+def parse_quantity(value):
+    try:
+        quantity = int(str(value).strip())
+    except (TypeError, ValueError):
+        return None
+    return quantity if quantity >= 1 else None
+
+
+def resolve_lines(lines, country=None):
+    """
+    `lines` is a list of (oem_id, category, name, quantity) as submitted.
+    Returns (resolved, errors): resolved is a list of (line number, device,
+    quantity) in line order, errors a list of (line number, message). Each line goes to the
+    branch device with the most available-to-promise, and quantities for the
+    same device are checked together.
+    """
+    errors = []
+    wanted = []
+    for number, (oem_id, category, name, quantity) in enumerate(lines, start=1):
+        qty = parse_quantity(quantity)
+        if qty is None:
+            errors.append((number, "Quantity must be a whole number of at least 1."))
+            continue
+        key = tuple('' if value is None else str(value).strip() for value in (oem_id, category, name))
+        if not all(key):
+            errors.append((number, "OEM, category and device are all required."))
+            continue
+        wanted.append((number, key, qty))
+
+    devices = Device.objects.select_related('branch')
+    if country is not None:
+        devices = devices.filter(branch__country=country)
+    devices = devices.filter(
+        oem_id__in={key[0] for _, key, _ in wanted if key[0].isdigit()},
+        category__in={key[1] for _, key, _ in wanted},
+        name__in={key[2] for _, key, _ in wanted},
+    ).annotate(in_stock=Count('imeis', filter=available_unit_q('imeis__')))
+
+    best = {}
+    for device in devices:
+        key = (str(device.oem_id), device.category, device.name)
+        device.atp = max(device.in_stock - device.committed_quantity, 0)
+        if key not in best or device.atp > best[key].atp:
+            best[key] = device
+
+    resolved = []
+    asked = defaultdict(int)
+    for number, key, qty in wanted:
+        device = best.get(key)
+        if device is None:
+            errors.append((number, f"Device '{key[2]}' not found."))
+            continue
+        asked[device.pk] += qty
+        resolved.append((number, device, qty))
+
+    for number, device, qty in resolved:
+        if asked[device.pk] > device.atp:
+            errors.append((number, f"Only {device.atp} units of {device.name} are available."))
+
+    errors.sort()
+    return resolved, errors
+
+
+# -------------------- Spreadsheet Upload -------------------- #
+
+UPLOAD_COLUMNS = ('OEM', 'Category', 'Device', 'Quantity')
+MAX_UPLOAD_LINES = 2000
+
+
+def read_request_lines(upload):
+    """
+    Yield (OEM, category, device, quantity) text cells from an XLSX or CSV
+    upload, streamed row by row. A leading header row and blank rows are skipped.
+    """
+    name = upload.name.lower()
+    if name.endswith('.csv'):
+        rows = csv.reader(io.TextIOWrapper(upload.file, encoding='utf-8-sig', newline=''))
+        workbook = None
+    elif name.endswith('.xlsx'):
+        workbook = openpyxl.load_workbook(upload, read_only=True, data_only=True)
+        rows = workbook.active.iter_rows(max_col=len(UPLOAD_COLUMNS), values_only=True)
+    else:
+        raise ValueError("Upload an .xlsx or .csv file.")
+
+    try:
+        for index, row in enumerate(rows):
+            cells = [cell_text(value) for value in list(row)[:len(UPLOAD_COLUMNS)]]
+            cells += [''] * (len(UPLOAD_COLUMNS) - len(cells))
+            if not any(cells):
+                continue
+            if index == 0 and cells[0].lower() == UPLOAD_COLUMNS[0].lower():
+                continue
+            yield tuple(cells)
+    finally:
+        if workbook is not None:
+            workbook.close()
+
+
+def resolve_upload(rows, country=None):
+    """
+    Resolve uploaded rows (OEM given by name or id) the same way as form
+    lines. Returns (lines, resolved, errors) where `lines` are the rows with
+    OEM ids, ready to hand back to resolve_lines when the upload is confirmed.
+    """
+    rows = list(itertools.islice(rows, MAX_UPLOAD_LINES + 1))
+    if len(rows) > MAX_UPLOAD_LINES:
+        raise ValueError(f"An upload can hold at most {MAX_UPLOAD_LINES} lines.")
+
+    oem_ids = {name.casefold(): str(pk) for pk, name in OEM.objects.values_list('id', 'name')}
+    known_ids = set(oem_ids.values())
+    lines, unknown = [], {}
+    for number, (oem, category, name, quantity) in enumerate(rows, start=1):
+        oem_id = oem if oem in known_ids else oem_ids.get(oem.casefold())
+        if oem and oem_id is None:
+            unknown[number] = oem
+            oem_id = '0'  # matches nothing, so the line fails as not found
+        lines.append((oem_id or '', category, name, quantity))
+
+    resolved, errors = resolve_lines(lines, country=country)
+    errors = [
+        (number, f"OEM '{unknown[number]}' not found."
+         if number in unknown and error.startswith("Device '") else error)
+        for number, error in errors
+    ]
+    return lines, resolved, errors
+
+
+def _store_payment_proof(proof_file):
+    """Save an uploaded proof once, outside the transaction, and queue its thumbnail."""
+    field = DeviceOrder._meta.get_field('payment_proof')
+    name = field.storage.save(field.generate_filename(None, proof_file.name), proof_file)
+    run_after_commit(make_thumbnail, name, field.storage)
+    return name
+
+
+def create_requests(user, client, resolved, payment_proof=None):
+    """
+    Promise and create one order holding a Pending request (plus its clerk
+    selection group) per resolved line, and return the order. Raises
+    AllocationError if stock was promised elsewhere in the meantime, in which
+    case nothing is created.
+    """
+    per_device = defaultdict(int)
+    for _, device, qty in resolved:
+        per_device[device.pk] += qty
+
+    proof_name = _store_payment_proof(payment_proof) if payment_proof else None
+    try:
+        with transaction.atomic():
+            # Fixed order so concurrent submissions lock devices consistently
+            for device_id in sorted(per_device):
+                promise_units(device_id, per_device[device_id])
+
+            order = DeviceOrder.objects.create(requestor=user, client=client, payment_proof=proof_name)
+            device_requests = DeviceRequest.objects.bulk_create([
+                DeviceRequest(
+                    order=order,
+                    requestor=user,
+                    client=client,
+                    device=device,
+                    quantity=qty,
+                    branch_id=device.branch_id,
+                    country_id=device.branch.country_id if device.branch_id else device.country_id,
+                    status="Pending",
+                    promised_quantity=qty,
+                )
+                for _, device, qty in resolved
+            ])
+
+            # Selection groups for the clerks, and their device links
+            groups = DeviceSelectionGroup.objects.bulk_create([
+                DeviceSelectionGroup(device_request=dr, store_clerk=None, status="Pending")
+                for dr in device_requests
+            ])
+            Link = DeviceSelectionGroup.devices.through
+            Link.objects.bulk_create([
+                Link(deviceselectiongroup_id=group.pk, device_id=dr.device_id)
+                for group, dr in zip(groups, device_requests)
+            ])
+
+            run_after_commit(notify_clerks, order.pk)
+    except Exception:
+        if proof_name:
+            DeviceOrder._meta.get_field('payment_proof').storage.delete(proof_name)
+        raise
+
+    bump_data_version()
+    return order
+
+
+def notify_clerks(order_id):
+    """One email to the Store Clerk group covering every line of the order."""
+    device_requests = list(
+        DeviceRequest.objects.filter(order_id=order_id)
+        .select_related('requestor', 'client', 'device')
+        .order_by('id')
+    )
+    clerk_emails = list(
+        User.objects.filter(groups__name="Store Clerk").exclude(email="").values_list("email", flat=True)
+    )
+    if not device_requests or not clerk_emails:
+        return
+
+    first = device_requests[0]
+    lines = "\n".join(
+        f"Request ID: {dr.id} | Device: {dr.device.name} | Quantity: {dr.quantity}"
+        for dr in device_requests
+    )
+    send_mail(
+        subject=f"New Device Order #{order_id} ({len(device_requests)} line(s))",
+        message=(
+            f"Hello Store Clerk,\n\n"
+            f"A new device order has been submitted.\n"
+            f"Requestor: {first.requestor.username}\n"
+            f"Client: {first.client.name if first.client else 'N/A'}\n\n"
+            f"{lines}\n\n"
+            f"Please log in to select IMEIs for these requests."
+        ),
+        from_email=None,
+        recipient_list=clerk_emails,
+        fail_silently=False,
+    )
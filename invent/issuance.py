@@ -0,0 +1,380 @@
+"""
+Issuance / return bookkeeping shared by every issue and return path.
+
+Keeps the denormalized holder pointers on DeviceIMEI and Device, and the
+ClientHolding index, in step with IssuanceRecord / ReturnRecord so "who has
+this unit now" and "what does this client hold" are indexed column reads.
+"""
+from collections import defaultdict
+
+from django.db import transaction
+from django.db.models import OuterRef, Subquery
+from django.utils import timezone
+
+from .models import (
+    ClientHolding, Device, DeviceIMEI, DeviceRequest, DeviceRequestSelectedIMEI, IssuanceRecord, ReturnRecord
+)
+from .stock import (
+    allocate_units, classify_picked_units, release_promises, release_reservations, take_picked_units
+)
+from .utils import bump_data_version, generate_delivery_note, generate_order_delivery_note, run_after_commit
+
+HOLDER_FIELDS = ['current_client', 'current_issuance', 'issued_at']
+
+
+def issued_unit_id(record):
+    """IssuanceRecord carries the unit on `imei` or `imei_obj` depending on the path that wrote it."""
+    return record.imei_id or record.imei_obj_id
+
+
+@transaction.atomic
+def record_issuances(records):
+    """Point each issued unit, and its Device, at the issuance that now holds it."""
+    units = {}
+    devices = {}
+    holdings = {}
+    for record in records:
+        unit_id = issued_unit_id(record)
+        if unit_id:
+            units[unit_id] = DeviceIMEI(
+                pk=unit_id,
+                current_client_id=record.client_id,
+                current_issuance_id=record.pk,
+                issued_at=record.issued_at,
+            )
+            if record.client_id:
+                holdings[unit_id] = ClientHolding(
+                    client_id=record.client_id,
+                    imei_id=unit_id,
+                    device_id=record.device_id,
+                    issuance_id=record.pk,
+                    issued_at=record.issued_at,
+                )
+        latest = devices.get(record.device_id)
+        if latest is None or record.issued_at >= latest.issued_at:
+            devices[record.device_id] = Device(
+                pk=record.device_id,
+                current_client_id=record.client_id,
+                current_issuance_id=record.pk,
+                issued_at=record.issued_at,
+            )
+
+    if units:
+        DeviceIMEI.objects.bulk_update(units.values(), HOLDER_FIELDS, batch_size=500)
+    if holdings:
+        # A unit is held by one client at a time: re-issuing moves the holding
+        ClientHolding.objects.bulk_create(
+            holdings.values(),
+            batch_size=500,
+            update_conflicts=True,
+            unique_fields=['imei'],
+            update_fields=['client', 'device', 'issuance', 'issued_at'],
+        )
+    if devices:
+        Device.objects.bulk_update(devices.values(), HOLDER_FIELDS, batch_size=500)
+        bump_data_version()
+
+
+def refresh_device_holders(device_ids):
+    """Re-derive each Device's summary from its most recently issued unit still out."""
+    held = (
+        DeviceIMEI.objects
+        .filter(device=OuterRef('pk'), current_issuance__isnull=False)
+        .order_by('-issued_at')
+    )
+    Device.objects.filter(pk__in=device_ids).update(
+        current_client=Subquery(held.values('current_client')[:1]),
+        current_issuance=Subquery(held.values('current_issuance')[:1]),
+        issued_at=Subquery(held.values('issued_at')[:1]),
+    )
+
+
+@transaction.atomic
+def release_units(imei_ids):
+    """Clear the holder pointers and holdings of returned units and refresh their Devices."""
+    imei_ids = list(imei_ids)
+    if not imei_ids:
+        return
+    units = DeviceIMEI.objects.filter(pk__in=imei_ids)
+    device_ids = set(units.values_list('device_id', flat=True))
+    units.update(current_client=None, current_issuance=None, issued_at=None)
+    ClientHolding.objects.filter(imei_id__in=imei_ids).delete()
+    refresh_device_holders(device_ids)
+    bump_data_version()
+
+
+@transaction.atomic
+def record_return(device, client, reason, imei_ids):
+    """Write one ReturnRecord per returned unit (or one unlinked record) and release the units."""
+    imei_ids = list(imei_ids)
+    if imei_ids:
+        ReturnRecord.objects.bulk_create([
+            ReturnRecord(device=device, client=client, reason=reason, imei_id=imei_id)
+            for imei_id in imei_ids
+        ])
+    else:
+        ReturnRecord.objects.create(device=device, client=client, reason=reason)
+    release_units(imei_ids)
+
+
+def units_held_for_request(device_request, quantity):
+    """Ids of up to `quantity` units issued for this request that are still out, oldest first."""
+    return list(
+        DeviceIMEI.objects
+        .filter(current_issuance__device_request=device_request)
+        .order_by('issued_at')
+        .values_list('id', flat=True)[:quantity]
+    )
+
+
+def _group_by_order(device_requests):
+    """Lines of the same order together, in id order; requests without an order stand alone."""
+    groups = defaultdict(list)
+    for dr in sorted(device_requests, key=lambda dr: dr.pk):
+        groups[dr.order_id or ('request', dr.pk)].append(dr)
+    return groups.values()
+
+
+def send_delivery_notes(request_ids):
+    """One delivery note per order, listing the units issued to each of its lines."""
+    device_requests = list(
+        DeviceRequest.objects
+        .filter(pk__in=request_ids)
+        .select_related('order__client', 'order__requestor', 'client', 'branch', 'requestor')
+    )
+    units = defaultdict(list)
+    for record in (
+        IssuanceRecord.objects
+        .filter(device_request__in=request_ids)
+        .select_related('device', 'imei', 'imei_obj')
+        .order_by('id')
+    ):
+        unit = record.imei or record.imei_obj
+        units[record.device_request_id].append([
+            record.device.name,
+            unit.imei_number if unit else "N/A",
+            unit.serial_no if unit and unit.serial_no else "N/A",
+        ])
+
+    for lines in _group_by_order(device_requests):
+        order = lines[0].order
+        if order is None:
+            generate_delivery_note(lines[0], units[lines[0].pk])
+        else:
+            generate_order_delivery_note(order, lines, [row for dr in lines for row in units[dr.pk]])
+
+
+def issue_requests(request_ids, user):
+    """
+    Issue a batch of Approved requests in one transaction with set-based
+    statements: units picked in select_imeis are confirmed (or re-claimed if
+    their hold lapsed), selections without a unit are filled FIFO per device,
+    issuance records are bulk-created and request statuses set in one UPDATE.
+    Delivery notes are queued once the transaction commits.
+
+    Returns (issued request ids, {request id: error}). A request that cannot
+    be issued in full is skipped and takes nothing.
+    """
+    request_ids = {int(pk) for pk in request_ids}
+    requests = {
+        dr.pk: dr
+        for dr in DeviceRequest.objects
+        .filter(pk__in=request_ids, status='Approved')
+        .select_related('client')
+        .prefetch_related('selected_devices')
+    }
+    errors = {pk: "Not an approved request." for pk in request_ids - requests.keys()}
+    for pk, dr in requests.items():
+        if not dr.selected_devices.all():
+            errors[pk] = "No selected devices found for this request."
+
+    now = timezone.now()
+    with transaction.atomic():
+        # Picked units: each must still be held for its own request, or be free again
+        owner = {
+            sd.imei_id: pk
+            for pk, dr in requests.items() if pk not in errors
+            for sd in dr.selected_devices.all() if sd.imei_id
+        }
+        held, claimable, blocked = classify_picked_units(owner, now)
+        for pk in blocked:
+            errors[pk] = "A selected unit is no longer available."
+
+        # Selections without a unit: one FIFO allocation per device, oldest request first
+        wanted = defaultdict(list)
+        for pk in sorted(requests):
+            if pk in errors:
+                continue
+            per_device = defaultdict(int)
+            for sd in requests[pk].selected_devices.all():
+                if not sd.imei_id:
+                    per_device[sd.device_id] += 1
+            for device_id, count in per_device.items():
+                wanted[device_id].append((pk, count))
+
+        pooled = defaultdict(list)
+        for device_id, claims in wanted.items():
+            units = [u.pk for u in allocate_units(device_id, sum(c for _, c in claims), strict=False)]
+            for pk, count in claims:
+                taken, units = units[:count], units[count:]
+                pooled[pk] += [(device_id, unit_id) for unit_id in taken]
+                if len(taken) < count:
+                    errors[pk] = f"Only {len(taken)} of {count} unselected units are available."
+
+        # Hand back pool units taken for requests that failed along the way
+        give_back = [unit_id for pk in errors for _, unit_id in pooled.pop(pk, [])]
+        if give_back:
+            DeviceIMEI.objects.filter(id__in=give_back).update(is_available=True)
+
+        issued = [pk for pk in sorted(requests) if pk not in errors]
+        held = {unit_id for unit_id in held if owner[unit_id] in issued}
+        claimable = {unit_id for unit_id in claimable if owner[unit_id] in issued}
+        take_picked_units(held, claimable)
+
+        records = []
+        for pk in issued:
+            dr = requests[pk]
+            units = [(sd.device_id, sd.imei_id) for sd in dr.selected_devices.all() if sd.imei_id]
+            for device_id, unit_id in units + pooled.get(pk, []):
+                records.append(IssuanceRecord(
+                    device_id=device_id,
+                    client=dr.client,
+                    logistics_manager=user,
+                    device_request=dr,
+                    imei_obj_id=unit_id,
+                ))
+        IssuanceRecord.objects.bulk_create(records, batch_size=500)
+        record_issuances(records)
+
+        Device.objects.filter(pk__in={r.device_id for r in records}).update(status='issued')
+        DeviceRequest.objects.filter(pk__in=issued).update(status='Issued', date_issued=now)
+        release_promises(issued)
+        bump_data_version()
+
+        if issued:
+            run_after_commit(send_delivery_notes, issued)
+
+    return issued, errors
+
+
+def send_status_notifications(request_ids):
+    """
+    Email requestors about their requests' current status (for bulk status
+    updates): one email per order and status, covering all of its lines.
+    """
+    device_requests = (
+        DeviceRequest.objects.filter(pk__in=request_ids).select_related('order__requestor', 'requestor', 'device')
+    )
+    for lines in _group_by_order(device_requests):
+        by_status = defaultdict(list)
+        for dr in lines:
+            by_status[dr.status].append(dr)
+        for same_status in by_status.values():
+            if len(same_status) == 1 or same_status[0].order is None:
+                for dr in same_status:
+                    dr.send_status_notification()
+            else:
+                same_status[0].order.send_status_notification(same_status)
+
+
+def approve_selected_requests(request_ids, user):
+    """
+    Approve Waiting Approval requests whose admin-reviewed IMEI selections
+    cover their quantity: the selected units are taken and recorded as issued
+    to the client, and the requests set Approved, all with set-based
+    statements. Requestors are notified once per order after commit.
+
+    Returns (approved request ids, {request id: error}).
+    """
+    # Two reads: the requests, then every open selection with its IMEI
+    device_requests = {
+        dr.pk: dr
+        for dr in DeviceRequest.objects.filter(pk__in=request_ids, status='Waiting Approval').select_related('client')
+    }
+    selections = defaultdict(list)
+    for selection in (
+        DeviceRequestSelectedIMEI.objects
+        .filter(device_request__in=device_requests.keys(), approved=False, rejected=False)
+        .select_related('imei')
+    ):
+        selections[selection.device_request_id].append(selection)
+
+    # Quantity enforcement, in memory
+    errors = {}
+    for pk, dr in device_requests.items():
+        if len(selections[pk]) != dr.quantity:
+            errors[pk] = (
+                f"selected IMEIs ({len(selections[pk])}) do not match quantity ({dr.quantity})"
+            )
+
+    owner = {
+        selection.imei_id: pk
+        for pk in device_requests if pk not in errors
+        for selection in selections[pk]
+    }
+    held, claimable, blocked = classify_picked_units(owner)
+    for pk in blocked:
+        errors[pk] = "some selected IMEIs are no longer available"
+
+    approved = [pk for pk in device_requests if pk not in errors]
+    with transaction.atomic():
+        take_picked_units(
+            {imei_id for imei_id in held if owner[imei_id] in approved},
+            {imei_id for imei_id in claimable if owner[imei_id] in approved},
+        )
+        records = [
+            IssuanceRecord(
+                device_id=selection.imei.device_id,
+                imei=selection.imei,
+                client=device_requests[pk].client,
+                logistics_manager=user,
+                device_request=device_requests[pk],
+            )
+            for pk in approved
+            for selection in selections[pk]
+        ]
+        IssuanceRecord.objects.bulk_create(records, batch_size=500)
+        record_issuances(records)
+
+        DeviceRequestSelectedIMEI.objects.filter(
+            id__in=[selection.id for pk in approved for selection in selections[pk]]
+        ).update(approved=True)
+        DeviceRequest.objects.filter(pk__in=approved).update(
+            status='Approved', date_issued=timezone.now()
+        )
+
+        # Their units are taken now, so they no longer need a promise
+        release_promises(approved)
+        bump_data_version()
+        if approved:
+            run_after_commit(send_status_notifications, approved)
+
+    return approved, errors
+
+
+def reject_open_requests(request_ids):
+    """
+    Reject the Pending / Waiting Approval requests among `request_ids` in a few
+    UPDATEs: open IMEI selections are marked rejected and held units and
+    promises handed back. Requestors are notified once per order after commit.
+    Returns the rejected request ids.
+    """
+    with transaction.atomic():
+        rejected = list(
+            DeviceRequest.objects
+            .filter(pk__in=request_ids, status__in=('Pending', 'Waiting Approval'))
+            .values_list('pk', flat=True)
+        )
+        if not rejected:
+            return []
+        DeviceRequest.objects.filter(pk__in=rejected).update(status='Rejected')
+        DeviceRequestSelectedIMEI.objects.filter(
+            device_request__in=rejected, approved=False, rejected=False
+        ).update(rejected=True)
+
+        # Units held and stock promised for these requests go straight back
+        release_reservations(rejected)
+        release_promises(rejected)
+        bump_data_version()
+        run_after_commit(send_status_notifications, rejected)
+    return rejected
@@ -0,0 +1,24 @@
+"""
+Recompute the integer IMEI / MAC key columns of DeviceIMEI.
+
+save() and the receiving path keep them current and migration 0022 fills
+existing rows; run this after writing units any other way (raw SQL,
+QuerySet.update on imei_number or mac_address).
+
+Run:
+    python manage.py backfill_identifier_keys
+"""
+from django.core.management.base import BaseCommand
+
+from invent.models import backfill_identifier_keys
+
+
+class Command(BaseCommand):
+    help = "Recompute DeviceIMEI.imei_key and mac_key from imei_number and mac_address."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=2000)
+
+    def handle(self, *args, **options):
+        corrected = backfill_identifier_keys(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f"Corrected the keys of {corrected} unit(s)."))
@@ -1,86 +1,73 @@
-import csv
-from django.core.management.base import BaseCommand, CommandError
+"""
+Bulk-load an asset register (CSV or .xlsx) into Device and DeviceIMEI.
+
+The first row is the header: an 'IMEI No' and/or 'Serial No' column,
+optionally 'MAC Address', and 'OEM', 'Category' and 'Device' columns naming
+each unit's model (--oem / --category / --device fill them in for the whole
+file). Rows are streamed and inserted in chunks; units already in stock are
+skipped, and rows that fail validation are reported and not imported.
+
+Run:
+    python manage.py import_assets assets.csv --oem Teltonika --category Router
+    python manage.py import_assets assets.xlsx --dry-run
+"""
 from django.contrib.auth.models import User
-from invent.models import InventoryItem
+from django.core.management.base import BaseCommand, CommandError
+
+from invent.receiving import IMPORT_CHUNK_SIZE, import_assets
+
 
 class Command(BaseCommand):
-    help = 'Imports ICT assets from a CSV file into the InventoryItem model.'
+    help = "Bulk-import device units from a CSV or .xlsx asset register."
 
     def add_arguments(self, parser):
-        parser.add_argument('csv_file', type=str, help='The path to the CSV file')
-        parser.add_argument('--created_by_username', type=str, default='admin',
-                            help='Username of the user who created these inventory items (default: admin)')
+        parser.add_argument('path', help="The .csv or .xlsx file")
+        parser.add_argument('--oem', default='', help="OEM for rows without one")
+        parser.add_argument('--category', default='', help="Category for rows without one")
+        parser.add_argument('--device', default='', help="Device name / model for rows without one")
+        parser.add_argument('--user', help="Username whose branch and country new devices are assigned to")
+        parser.add_argument('--chunk-size', type=int, default=IMPORT_CHUNK_SIZE)
+        parser.add_argument('--dry-run', action='store_true', help="Validate and count, then roll everything back")
 
     def handle(self, *args, **options):
-        csv_file_path = options['csv_file']
-        created_by_username = options['created_by_username']
+        user = None
+        if options['user']:
+            try:
+                user = User.objects.get(username=options['user'])
+            except User.DoesNotExist:
+                raise CommandError(f"User '{options['user']}' does not exist.")
+        defaults = {'oem': options['oem'], 'category': options['category'], 'name': options['device']}
 
         try:
-            created_by_user = User.objects.get(username=created_by_username)
-        except User.DoesNotExist:
-            raise CommandError(f"User '{created_by_username}' does not exist. Please create the user or provide an existing one.")
-
-        self.stdout.write(self.style.SUCCESS(f"Starting import from {csv_file_path}..."))
-
-        imported_count = 0
-        skipped_count = 0
-
-        try:
-            with open(csv_file_path, newline='', encoding='utf-8') as csvfile:
-                reader = csv.DictReader(csvfile)
-                for row_num, row in enumerate(reader, 2): # Start from 2 for row number in CSV
-                    asset_description = row.get('Asset Description')
-                    serial_number = row.get('Serial Number')
-                    asset_category_minor = row.get('Asset Category-Minor')
-                    condition = row.get('Condition')
-
-                    if not asset_description or not serial_number:
-                        self.stdout.write(self.style.WARNING(
-                            f"Row {row_num}: Skipping due to missing 'Asset Description' or 'Serial Number': {row}"
-                        ))
-                        skipped_count += 1
-                        continue
-
-                    # Basic data cleaning/mapping if needed
-                    # Ensure condition matches your CONDITION_CHOICES if strict
-                    if condition not in [c[0] for c in InventoryItem.CONDITION_CHOICES]:
-                        condition = "Serviceable" # Default if CSV value doesn't match choices
-
-                    try:
-                        # Use get_or_create to prevent duplicates based on serial_number
-                        item, created = InventoryItem.objects.get_or_create(
-                            serial_number=serial_number,
-                            defaults={
-                                'name': asset_description,
-                                'category': asset_category_minor,
-                                'condition': condition,
-                                'quantity_total': 1, # Each unique serial number is one item
-                                'created_by': created_by_user,
-                                'status': 'In Stock',
-                            }
-                        )
+            stats = import_assets(
+                options['path'], defaults, user=user, dry_run=options['dry_run'],
+                chunk_size=options['chunk_size'], progress=self._progress,
+            )
+        except FileNotFoundError:
+            raise CommandError(f"File not found: '{options['path']}'")
+        except ValueError as e:
+            raise CommandError(str(e))
 
-                        if created:
-                            imported_count += 1
-                            self.stdout.write(self.style.SUCCESS(
-                                f"Row {row_num}: Created '{item.name}' (S/N: {item.serial_number})"
-                            ))
-                        else:
-                            skipped_count += 1
-                            self.stdout.write(self.style.WARNING(
-                                f"Row {row_num}: Skipped. Item with S/N '{serial_number}' already exists. ('{item.name}')"
-                            ))
+        for row, message in stats['rejections']:
+            self.stdout.write(self.style.WARNING(f"Row {row}: {message}"))
+        if stats['rejected'] > len(stats['rejections']):
+            self.stdout.write(self.style.WARNING(
+                f"... and {stats['rejected'] - len(stats['rejections'])} more rejected row(s)."))
 
-                    except Exception as e:
-                        self.stdout.write(self.style.ERROR(
-                            f"Row {row_num}: Error importing '{serial_number}': {e}"
-                        ))
-                        skipped_count += 1
-        except FileNotFoundError:
-            raise CommandError(f"CSV file not found at '{csv_file_path}'")
-        except Exception as e:
-            raise CommandError(f"An error occurred during CSV processing: {e}")
+        rate = stats['rows'] / stats['seconds'] if stats['seconds'] else 0
+        summary = (
+            f"{stats['rows']:,} rows in {stats['seconds']:.1f}s ({rate:,.0f} rows/s): "
+            f"{stats['added']:,} units added, {stats['skipped']:,} skipped as duplicates, "
+            f"{stats['rejected']:,} rejected; {stats['devices_created']:,} new device model(s)."
+        )
+        if options['dry_run']:
+            self.stdout.write(self.style.SUCCESS(f"Dry run, nothing saved. {summary}"))
+        else:
+            self.stdout.write(self.style.SUCCESS(f"Import complete. {summary}"))
 
-        self.stdout.write(self.style.SUCCESS(
-            f"Import complete. Imported {imported_count} items. Skipped {skipped_count} items."
-        ))
\ No newline at end of file
+    def _progress(self, stats):
+        rate = stats['rows'] / stats['seconds'] if stats['seconds'] else 0
+        self.stdout.write(
+            f"  {stats['rows']:,} rows: {stats['added']:,} added, {stats['skipped']:,} skipped, "
+            f"{stats['rejected']:,} rejected ({rate:,.0f} rows/s)"
+        )
@@ -0,0 +1,62 @@
+"""
+Receive a multi-model shipment: one or more .xlsx workbooks, a sheet per
+model, as on the inventory upload page. Each sheet names its device in an
+OEM / Category / Device preamble, or by its title. Sheets are parsed in a
+pool of worker processes (INVENTORY_INGEST_WORKERS, default one per CPU),
+which the web upload does not use, so large shipments belong here.
+
+Run:
+    python manage.py receive_workbooks shipment.xlsx --oem Teltonika --category Router
+    python manage.py receive_workbooks a.xlsx b.xlsx --user clerk --skip-rejected
+"""
+import os
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from invent.receiving import receive_workbooks
+
+
+class Command(BaseCommand):
+    help = "Receive device units from one or more .xlsx workbooks, one sheet per model."
+
+    def add_arguments(self, parser):
+        parser.add_argument('paths', nargs='+', help="The .xlsx files")
+        parser.add_argument('--oem', default='', help="OEM for sheets without one")
+        parser.add_argument('--category', default='', help="Category for sheets without one")
+        parser.add_argument('--user', help="Username whose branch and country new devices are assigned to")
+        parser.add_argument('--skip-rejected', action='store_true', help="Receive the valid rows even if some are rejected")
+        parser.add_argument('--workers', type=int, default=settings.INVENTORY_INGEST_WORKERS or os.cpu_count() or 1)
+
+    def handle(self, *args, **options):
+        user = None
+        if options['user']:
+            try:
+                user = User.objects.get(username=options['user'])
+            except User.DoesNotExist:
+                raise CommandError(f"User '{options['user']}' does not exist.")
+        for path in options['paths']:
+            if not os.path.isfile(path):
+                raise CommandError(f"File not found: '{path}'")
+
+        report = receive_workbooks(
+            user, [(path, os.path.basename(path)) for path in options['paths']],
+            {'oem': options['oem'], 'category': options['category']},
+            skip_rejected=options['skip_rejected'], workers=options['workers'],
+        )
+
+        for sheet in report:
+            for row, message in sheet['rejected']:
+                self.stdout.write(self.style.WARNING(f"{sheet['source']} row {row}: {message}"))
+        if any(sheet['rejected'] for sheet in report) and not options['skip_rejected']:
+            raise CommandError("Rows were rejected, so nothing was received; fix them or pass --skip-rejected.")
+
+        for sheet in report:
+            if sheet['error']:
+                self.stdout.write(self.style.ERROR(f"{sheet['source']}: {sheet['error']}"))
+            else:
+                self.stdout.write(self.style.SUCCESS(
+                    f"{sheet['source']} ({sheet['device'].name}): "
+                    f"{sheet['added']} units added, {sheet['skipped']} skipped."
+                ))
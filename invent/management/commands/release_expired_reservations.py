@@ -0,0 +1,20 @@
+"""
+Return IMEIs whose select_imeis hold has lapsed to the available pool.
+
+Lapsed holds already count as available everywhere; this clears the stale
+reservation columns in one UPDATE. Schedule it, e.g. every 15 minutes:
+
+Run:
+    python manage.py release_expired_reservations
+"""
+from django.core.management.base import BaseCommand
+
+from invent.stock import release_expired_reservations
+
+
+class Command(BaseCommand):
+    help = "Release IMEI reservations whose hold period has expired."
+
+    def handle(self, *args, **options):
+        released = release_expired_reservations()
+        self.stdout.write(self.style.SUCCESS(f"Released {released} expired reservation(s)."))
@@ -0,0 +1,73 @@
+# Generated by Django 5.2.4 on 2026-10-19 00:50
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def backfill_current_holders(apps, schema_editor):
+    """
+    Point unavailable units at their latest issuance, and each device at the
+    latest issuance of a unit still out (as invent.issuance keeps them).
+    """
+    DeviceIMEI = apps.get_model('invent', 'DeviceIMEI')
+    Device = apps.get_model('invent', 'Device')
+    IssuanceRecord = apps.get_model('invent', 'IssuanceRecord')
+
+    out = set(DeviceIMEI.objects.filter(is_available=False).values_list('id', flat=True))
+    units, devices = {}, {}
+    records = IssuanceRecord.objects.order_by('issued_at').values_list(
+        'id', 'device_id', 'client_id', 'issued_at', 'imei_id', 'imei_obj_id'
+    )
+    for pk, device_id, client_id, issued_at, imei_id, imei_obj_id in records.iterator():
+        unit_id = imei_id or imei_obj_id
+        if unit_id not in out:
+            continue
+        units[unit_id] = DeviceIMEI(pk=unit_id, current_client_id=client_id,
+                                    current_issuance_id=pk, issued_at=issued_at)
+        devices[device_id] = Device(pk=device_id, current_client_id=client_id,
+                                    current_issuance_id=pk, issued_at=issued_at)
+
+    fields = ['current_client', 'current_issuance', 'issued_at']
+    DeviceIMEI.objects.bulk_update(units.values(), fields, batch_size=500)
+    Device.objects.bulk_update(devices.values(), fields, batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('invent', '0015_delete_devicereports_devicereports'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='device',
+            name='current_client',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='held_devices', to='invent.client'),
+        ),
+        migrations.AddField(
+            model_name='device',
+            name='current_issuance',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='invent.issuancerecord'),
+        ),
+        migrations.AddField(
+            model_name='device',
+            name='issued_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='deviceimei',
+            name='current_client',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='held_imeis', to='invent.client'),
+        ),
+        migrations.AddField(
+            model_name='deviceimei',
+            name='current_issuance',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='invent.issuancerecord'),
+        ),
+        migrations.AddField(
+            model_name='deviceimei',
+            name='issued_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.RunPython(backfill_current_holders, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,52 @@
+# Generated by Django 5.2.4 on 2026-10-19 00:52
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def backfill_holdings(apps, schema_editor):
+    """Seed holdings from the current-holder pointers on DeviceIMEI."""
+    DeviceIMEI = apps.get_model('invent', 'DeviceIMEI')
+    ClientHolding = apps.get_model('invent', 'ClientHolding')
+    held = DeviceIMEI.objects.filter(current_client__isnull=False).values_list(
+        'id', 'current_client_id', 'device_id', 'current_issuance_id', 'issued_at'
+    )
+    ClientHolding.objects.bulk_create(
+        [
+            ClientHolding(imei_id=pk, client_id=client_id, device_id=device_id,
+                          issuance_id=issuance_id, issued_at=issued_at)
+            for pk, client_id, device_id, issuance_id, issued_at in held.iterator()
+        ],
+        batch_size=500,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('invent', '0016_current_holder'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='returnrecord',
+            name='imei',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='return_records', to='invent.deviceimei'),
+        ),
+        migrations.CreateModel(
+            name='ClientHolding',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('issued_at', models.DateTimeField()),
+                ('client', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='holdings', to='invent.client')),
+                ('device', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='holdings', to='invent.device')),
+                ('imei', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='holding', to='invent.deviceimei')),
+                ('issuance', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='invent.issuancerecord')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['client', 'device'], name='client_holding_device_idx')],
+                'constraints': [models.UniqueConstraint(fields=('client', 'imei'), name='unique_client_holding')],
+            },
+        ),
+        migrations.RunPython(backfill_holdings, migrations.RunPython.noop),
+    ]
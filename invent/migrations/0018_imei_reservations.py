@@ -0,0 +1,31 @@
+# Generated by Django 5.2.4 on 2026-10-19 00:55
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('invent', '0017_client_holdings'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='deviceimei',
+            name='reserved_by',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='reserved_imeis', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddField(
+            model_name='deviceimei',
+            name='reserved_for',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='reserved_imeis', to='invent.devicerequest'),
+        ),
+        migrations.AddField(
+            model_name='deviceimei',
+            name='reserved_until',
+            field=models.DateTimeField(blank=True, db_index=True, null=True),
+        ),
+    ]
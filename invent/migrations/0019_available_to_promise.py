@@ -0,0 +1,46 @@
+# Generated by Django 5.2.4 on 2026-10-19 00:59
+
+from django.db import migrations, models
+from django.db.models import F, OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce
+
+
+def backfill_promises(apps, schema_editor):
+    """Promise the full quantity of every open request that has no units held or issued yet."""
+    Device = apps.get_model('invent', 'Device')
+    DeviceRequest = apps.get_model('invent', 'DeviceRequest')
+    open_requests = DeviceRequest.objects.filter(
+        status__in=['Pending', 'Under Review', 'Approved'],
+        selected_devices__isnull=True,
+        issuances__isnull=True,
+    )
+    DeviceRequest.objects.filter(pk__in=open_requests.values('pk')).update(promised_quantity=F('quantity'))
+    committed = (
+        DeviceRequest.objects
+        .filter(device=OuterRef('pk'), promised_quantity__gt=0)
+        .values('device')
+        .annotate(total=Sum('promised_quantity'))
+        .values('total')
+    )
+    Device.objects.update(committed_quantity=Coalesce(Subquery(committed), 0))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('invent', '0018_imei_reservations'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='device',
+            name='committed_quantity',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='devicerequest',
+            name='promised_quantity',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(backfill_promises, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,51 @@
+# Generated by Django 5.2.4 on 2026-10-19 01:13
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+def backfill_orders(apps, schema_editor):
+    """Give every existing request its own single-line order."""
+    DeviceOrder = apps.get_model('invent', 'DeviceOrder')
+    DeviceRequest = apps.get_model('invent', 'DeviceRequest')
+    requests = list(
+        DeviceRequest.objects.filter(order__isnull=True)
+        .only('id', 'requestor_id', 'client_id', 'payment_proof', 'date_requested')
+    )
+    orders = DeviceOrder.objects.bulk_create([
+        DeviceOrder(requestor_id=dr.requestor_id, client_id=dr.client_id, payment_proof=dr.payment_proof)
+        for dr in requests
+    ], batch_size=500)
+    for dr, order in zip(requests, orders):
+        order.date_requested = dr.date_requested
+        dr.order_id = order.pk
+    DeviceOrder.objects.bulk_update(orders, ['date_requested'], batch_size=500)
+    DeviceRequest.objects.bulk_update(requests, ['order'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('invent', '0019_available_to_promise'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DeviceOrder',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('payment_proof', models.FileField(blank=True, null=True, upload_to='payment_proofs/')),
+                ('date_requested', models.DateTimeField(auto_now_add=True)),
+                ('client', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='orders', to='invent.client')),
+                ('requestor', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='device_orders', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='devicerequest',
+            name='order',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='lines', to='invent.deviceorder'),
+        ),
+        migrations.RunPython(backfill_orders, migrations.RunPython.noop),
+    ]
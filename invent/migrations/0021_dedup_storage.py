@@ -0,0 +1,54 @@
+# Generated by Django 5.2.4 on 2026-10-19 01:16
+
+import invent.storage
+from collections import Counter
+
+from django.db import migrations, models
+
+
+def count_references(apps, schema_editor):
+    """Existing uploads become blobs with one reference per row that points at them."""
+    StoredBlob = apps.get_model('invent', 'StoredBlob')
+    references = Counter()
+    for model, field in (('DeviceOrder', 'payment_proof'), ('DeviceRequest', 'payment_proof'),
+                         ('PurchaseOrder', 'document')):
+        names = apps.get_model('invent', model).objects.exclude(**{field: ''}).exclude(**{f'{field}__isnull': True})
+        references.update(names.values_list(field, flat=True))
+    StoredBlob.objects.bulk_create(
+        [StoredBlob(name=name, refcount=count) for name, count in references.items()],
+        batch_size=500,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('invent', '0020_device_orders'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StoredBlob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255, unique=True)),
+                ('refcount', models.IntegerField(default=0)),
+            ],
+        ),
+        migrations.AlterField(
+            model_name='deviceorder',
+            name='payment_proof',
+            field=models.FileField(blank=True, null=True, storage=invent.storage.DedupStorage(), upload_to='payment_proofs/'),
+        ),
+        migrations.AlterField(
+            model_name='devicerequest',
+            name='payment_proof',
+            field=models.FileField(blank=True, null=True, storage=invent.storage.DedupStorage(), upload_to='payment_proofs/'),
+        ),
+        migrations.AlterField(
+            model_name='purchaseorder',
+            name='document',
+            field=models.FileField(blank=True, null=True, storage=invent.storage.DedupStorage(), upload_to='purchase_orders/'),
+        ),
+        migrations.RunPython(count_references, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,63 @@
+# Generated by Django 5.2.4 on 2026-10-19 01:35
+
+from django.db import migrations, models
+
+# Frozen copies of invent.validation.imei_to_int / mac_to_int as of this migration
+IMEI_SEPARATORS = str.maketrans('', '', ' -/')
+MAC_SEPARATORS = str.maketrans('', '', ' :-.')
+HEX_DIGITS = set('0123456789abcdefABCDEF')
+
+
+def imei_key(value):
+    digits = (value or '').strip().translate(IMEI_SEPARATORS)
+    if len(digits) == 15 and digits.isascii() and digits.isdigit():
+        return int(digits)
+    return None
+
+
+def mac_key(value):
+    digits = (value or '').strip().translate(MAC_SEPARATORS)
+    if len(digits) == 12 and set(digits) <= HEX_DIGITS:
+        return int(digits, 16)
+    return None
+
+
+def backfill_keys(apps, schema_editor):
+    # Keyset batches rather than one iterator: SQLite does not isolate the
+    # open cursor from the updates made through the same connection
+    DeviceIMEI = apps.get_model('invent', 'DeviceIMEI')
+    last_id = 0
+    while True:
+        units = list(
+            DeviceIMEI.objects.filter(id__gt=last_id).order_by('id')
+            .only('id', 'imei_number', 'mac_address')[:2000]
+        )
+        if not units:
+            return
+        last_id = units[-1].id
+        for unit in units:
+            unit.imei_key = imei_key(unit.imei_number)
+            unit.mac_key = mac_key(unit.mac_address)
+        keyed = [unit for unit in units if unit.imei_key is not None or unit.mac_key is not None]
+        DeviceIMEI.objects.bulk_update(keyed, ['imei_key', 'mac_key'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('invent', '0021_dedup_storage'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='deviceimei',
+            name='imei_key',
+            field=models.BigIntegerField(blank=True, db_index=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='deviceimei',
+            name='mac_key',
+            field=models.BigIntegerField(blank=True, db_index=True, editable=False, null=True),
+        ),
+        migrations.RunPython(backfill_keys, migrations.RunPython.noop),
+    ]
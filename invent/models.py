@@ -1,5 +1,5 @@
 from django.db import models
-from django.db.models import Sum, F # Added Sum, F for future aggregation logic
+from django.db.models import Sum, F, Q
 from django.contrib.auth.models import User
 from django.utils import timezone
 from django.core.mail import send_mail, EmailMessage
@@ -7,6 +7,9 @@ from django.conf import settings
 from django.template.loader import render_to_string
 from django.core.mail import EmailMultiAlternatives
 
+from .storage import DedupStorage, THUMBNAIL_SUFFIX
+from .validation import IMEI_LENGTH, MAC_SEPARATORS, imei_to_int, mac_to_int
+
 
 # --- Utility Functions (Keep delivery_note function outside of class definitions) ---
 def delivery_note(self):
@@ -81,7 +84,7 @@ class PurchaseOrder(models.Model):
     order_date = models.DateField()
     expected_delivery = models.DateField()
     status = models.CharField(max_length=50)
-    document = models.FileField(upload_to='purchase_orders/', null=True, blank=True)
+    document = models.FileField(upload_to='purchase_orders/', storage=DedupStorage(), null=True, blank=True)
     def __str__(self): return f"PO #{self.id} - {self.oem.name}"
 
 class Client(models.Model):
@@ -92,7 +95,136 @@ class Client(models.Model):
     def __str__(self): return self.name
 
 
+class StoredBlob(models.Model):
+    """Reference count of one content-addressed upload in DedupStorage."""
+    name = models.CharField(max_length=255, unique=True)
+    refcount = models.IntegerField(default=0)
+
+    def __str__(self): return f"{self.name} ({self.refcount})"
+
+
 # --- UNIQUE INSTANCE TRACKER ---
+def available_unit_q(prefix=''):
+    """
+    Q matching units that can be handed out: available, or held by a reservation
+    that has already lapsed (the sweeper just hasn't released it yet).
+    Pass prefix='imeis__' when filtering/annotating from Device.
+    """
+    return (
+        Q(**{f'{prefix}is_available': True}) |
+        Q(**{f'{prefix}reserved_until__lt': timezone.now()})
+    )
+
+
+# Identifier columns with an integer key column, and how values map to it
+KEYED_IDENTIFIERS = {
+    'imei_number': ('imei_key', imei_to_int),
+    'mac_address': ('mac_key', mac_to_int),
+}
+
+
+def identifier_q(value, prefix=''):
+    """
+    Q matching units whose IMEI or MAC address is `value`, through the key
+    columns; None when `value` is neither a full IMEI nor a MAC address.
+    Pass prefix='imeis__' when filtering from Device.
+    """
+    q = Q()
+    for field, (key_field, to_int) in KEYED_IDENTIFIERS.items():
+        key = to_int(value)
+        if key is not None:
+            q |= Q(**{f'{prefix}{key_field}': key})
+    return q or None
+
+
+def is_exact_identifier(value):
+    """
+    True when a search term can only be a unit identifier: a full 15-digit
+    IMEI, or a MAC address written with separators. Twelve bare hex
+    characters could as well be part of an IMEI or a name ('CAFEBABE0001').
+    """
+    value = (value or '').strip()
+    if imei_to_int(value) is not None:
+        return True
+    return mac_to_int(value) is not None and any(c in MAC_SEPARATORS for c in value)
+
+
+def identifier_search_q(value, substring_q, prefix=''):
+    """
+    Q for a search box: an exact identifier (see is_exact_identifier) is an
+    indexed key lookup, or a serial match; any other term is `substring_q`,
+    widened by a key match when the term also reads as an IMEI or MAC.
+    """
+    keys = identifier_q(value, prefix)
+    if keys is not None and is_exact_identifier(value):
+        return keys | Q(**{f'{prefix}serial_no': value.strip()})
+    return substring_q | keys if keys is not None else substring_q
+
+
+def imei_prefix_q(prefix):
+    """Q for IMEIs starting with `prefix`: a range on imei_key, plus a string match for unkeyed values."""
+    if not (prefix.isascii() and prefix.isdigit() and len(prefix) <= IMEI_LENGTH):
+        return Q(imei_number__startswith=prefix)
+    scale = 10 ** (IMEI_LENGTH - len(prefix))
+    return (
+        Q(imei_key__gte=int(prefix) * scale, imei_key__lt=(int(prefix) + 1) * scale) |
+        Q(imei_key__isnull=True, imei_number__startswith=prefix)
+    )
+
+
+def match_identifiers(queryset, field, values, *columns):
+    """
+    Exact lookup of `values` in a keyed identifier field of DeviceIMEI
+    ('imei_number' or 'mac_address'): {value: values_list(*columns) row} for
+    each value found. Values are matched through the integer key column, so
+    '35-209900-176148-1' finds '352099001761481'; values without a key (e.g.
+    a serial standing in for an IMEI) fall back to the string column.
+    """
+    key_field, to_int = KEYED_IDENTIFIERS[field]
+    by_key, plain = {}, []
+    for value in values:
+        key = to_int(value)
+        if key is None:
+            plain.append(value)
+        else:
+            by_key.setdefault(key, []).append(value)
+
+    queryset = queryset.order_by()
+    found = {}
+    if by_key:
+        for key, *row in queryset.filter(**{f'{key_field}__in': list(by_key)}).values_list(key_field, *columns):
+            for value in by_key[key]:
+                found[value] = tuple(row)
+    if plain:
+        for value, *row in queryset.filter(**{f'{field}__in': plain}).values_list(field, *columns):
+            found[value] = tuple(row)
+    return found
+
+
+def backfill_identifier_keys(batch_size=2000):
+    """
+    Recompute imei_key / mac_key for every unit, for rows written around
+    save() (raw SQL, QuerySet.update). Returns the number of units corrected.
+    """
+    corrected, last_id = 0, 0
+    while True:
+        units = list(
+            DeviceIMEI.objects.filter(id__gt=last_id).order_by('id')
+            .only('id', 'imei_number', 'mac_address', 'imei_key', 'mac_key')[:batch_size]
+        )
+        if not units:
+            return corrected
+        last_id = units[-1].id
+        stale = []
+        for unit in units:
+            keys = (imei_to_int(unit.imei_number), mac_to_int(unit.mac_address))
+            if keys != (unit.imei_key, unit.mac_key):
+                unit.imei_key, unit.mac_key = keys
+                stale.append(unit)
+        DeviceIMEI.objects.bulk_update(stale, ['imei_key', 'mac_key'], batch_size=500)
+        corrected += len(stale)
+
+
 class DeviceIMEI(models.Model):
     """Tracks individual unique physical devices of a product type (Device)."""
     device = models.ForeignKey(
@@ -107,15 +239,47 @@ class DeviceIMEI(models.Model):
     serial_no = models.CharField(max_length=50, unique=True, null=True, blank=True)
     mac_address = models.CharField(max_length=50, unique=True, null=True, blank=True)
 
+    # Integer forms of imei_number (15-digit IMEIs only) and mac_address, for
+    # compact indexed exact and range lookups (see match_identifiers). Set by
+    # save() and invent.receiving; `manage.py backfill_identifier_keys` redoes them.
+    imei_key = models.BigIntegerField(null=True, blank=True, editable=False, db_index=True)
+    mac_key = models.BigIntegerField(null=True, blank=True, editable=False, db_index=True)
+
     is_available = models.BooleanField(default=True)
     added_on = models.DateTimeField(auto_now_add=True)
 
+    # Denormalized "who has this unit now" pointer, maintained by invent.issuance
+    current_client = models.ForeignKey(
+        'Client', on_delete=models.SET_NULL, null=True, blank=True, related_name='held_imeis'
+    )
+    current_issuance = models.ForeignKey(
+        'IssuanceRecord', on_delete=models.SET_NULL, null=True, blank=True, related_name='+'
+    )
+    issued_at = models.DateTimeField(null=True, blank=True)
+
+    # Time-limited hold placed by select_imeis; released by release_expired_reservations
+    reserved_until = models.DateTimeField(null=True, blank=True, db_index=True)
+    reserved_by = models.ForeignKey(
+        User, on_delete=models.SET_NULL, null=True, blank=True, related_name='reserved_imeis'
+    )
+    reserved_for = models.ForeignKey(
+        'DeviceRequest', on_delete=models.SET_NULL, null=True, blank=True, related_name='reserved_imeis'
+    )
+
     class Meta:
         ordering = ['-added_on']
 
     def __str__(self):
         return f"{self.device.name} - {self.imei_number} ({'available' if self.is_available else 'unavailable'})"
 
+    def save(self, *args, **kwargs):
+        self.imei_key = imei_to_int(self.imei_number)
+        self.mac_key = mac_to_int(self.mac_address)
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and {'imei_number', 'mac_address'} & set(update_fields):
+            kwargs['update_fields'] = {*update_fields, 'imei_key', 'mac_key'}
+        super().save(*args, **kwargs)
+
     def mark_unavailable(self):
         if self.is_available:
             self.is_available = False
@@ -126,6 +290,10 @@ class DeviceIMEI(models.Model):
             self.is_available = True
             self.save(update_fields=['is_available'])
 
+    @property
+    def is_reserved(self):
+        return self.reserved_until is not None and self.reserved_until >= timezone.now()
+
 
 # --- PRODUCT TYPE MODEL ---
 class Device(models.Model):
@@ -150,6 +318,18 @@ class Device(models.Model):
     country = models.ForeignKey(Country, on_delete=models.SET_NULL, null=True, blank=True)
     status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='available')
 
+    # Denormalized summary of the most recent issuance still out with a client (see invent.issuance)
+    current_client = models.ForeignKey(
+        Client, on_delete=models.SET_NULL, null=True, blank=True, related_name='held_devices'
+    )
+    current_issuance = models.ForeignKey(
+        'IssuanceRecord', on_delete=models.SET_NULL, null=True, blank=True, related_name='+'
+    )
+    issued_at = models.DateTimeField(null=True, blank=True)
+
+    # Units promised to open requests but not yet held or issued (see invent.stock.promise_units)
+    committed_quantity = models.PositiveIntegerField(default=0)
+
     class Meta:
         permissions = [
             ("can_issue_item", "Can issue device to client"),
@@ -163,8 +343,8 @@ class Device(models.Model):
 
     @property
     def quantity_issued(self):
-        """Calculated property: Number of instances currently marked as unavailable."""
-        return self.imeis.filter(is_available=False).count()
+        """Calculated property: Number of instances currently out of the available pool."""
+        return self.imeis.exclude(available_unit_q()).count()
 
     def quantity_remaining(self):
         """Method: The total available quantity."""
@@ -172,8 +352,13 @@ class Device(models.Model):
 
     @property
     def available_quantity(self):
-        """Calculated property: Number of instances currently marked as available."""
-        return self.imeis.filter(is_available=True).count()
+        """Calculated property: Number of instances that can be handed out (see available_unit_q)."""
+        return self.imeis.filter(available_unit_q()).count()
+
+    @property
+    def available_to_promise(self):
+        """Calculated property: Available units not already promised to open requests."""
+        return max(self.available_quantity - self.committed_quantity, 0)
 
     def __str__(self):
         return f"{self.name} (Total: {self.total_quantity}, Avail: {self.available_quantity})"
@@ -203,7 +388,43 @@ class DeviceSelectionGroup(models.Model):
 
 
 
+class DeviceOrder(models.Model):
+    """
+    One customer submission: the header shared by its DeviceRequest lines
+    (requestor, client, payment proof). Approval, issuance, delivery notes and
+    notifications are handled once per order rather than once per line.
+    """
+    requestor = models.ForeignKey(User, on_delete=models.CASCADE, related_name="device_orders")
+    client = models.ForeignKey("Client", on_delete=models.CASCADE, related_name="orders", null=True, blank=True)
+    payment_proof = models.FileField(upload_to="payment_proofs/", storage=DedupStorage(), null=True, blank=True)
+    date_requested = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self): return f"Order #{self.id}"
+
+    def send_status_notification(self, lines):
+        """Email the requestor once about lines of this order that share a status."""
+        status = lines[0].status
+        verbs = {
+            'Rejected': "been rejected",
+            'Approved': "been approved",
+            'Issued': "been issued to you",
+            'Cancelled': "been cancelled",
+        }
+        if status not in verbs:
+            return
+
+        items = "\n".join(f"- {dr.device} x {dr.quantity} (Request #{dr.id})" for dr in lines)
+        send_mail(
+            f"Device Order #{self.id} {status}",
+            f"Hello,\n\nThe following items of your order #{self.id} have {verbs[status]}:\n\n{items}",
+            from_email=None,
+            recipient_list=[self.requestor.email],
+            fail_silently=False
+        )
+
+
 class DeviceRequest(models.Model):
+    order = models.ForeignKey(DeviceOrder, on_delete=models.CASCADE, related_name="lines", null=True, blank=True)
     device = models.ForeignKey("Device", on_delete=models.CASCADE, related_name="requests")
     requestor = models.ForeignKey(User, on_delete=models.CASCADE, related_name="device_requests")
     client = models.ForeignKey("Client", on_delete=models.CASCADE, related_name="client_requests", null=True, blank=True)
@@ -213,7 +434,7 @@ class DeviceRequest(models.Model):
     quantity = models.PositiveIntegerField(default=1)
     reason = models.TextField(blank=True, null=True)
     application_date = models.DateField(default=timezone.now)
-    payment_proof = models.FileField(upload_to="payment_proofs/", null=True, blank=True)
+    payment_proof = models.FileField(upload_to="payment_proofs/", storage=DedupStorage(), null=True, blank=True)
 
     STATUS_CHOICES = [
         ('Pending', 'Pending'),
@@ -229,6 +450,8 @@ class DeviceRequest(models.Model):
     date_requested = models.DateTimeField(auto_now_add=True)
     date_issued = models.DateTimeField(null=True, blank=True)
     returned_quantity = models.PositiveIntegerField(default=0)
+    # Share of this request still counted in Device.committed_quantity
+    promised_quantity = models.PositiveIntegerField(default=0)
 
     _original_status = None
 
@@ -251,33 +474,49 @@ class DeviceRequest(models.Model):
                 super().save(update_fields=['date_issued'])
 
             # Optional: send simple notifications
-            user = self.requestor
-            subject, message = None, None
-
-            if self.status == 'Rejected':
-                subject = f"Device Request #{self.id} Rejected"
-                message = f"Hello,\n\nYour request for {self.device} has been rejected."
-            elif self.status == 'Approved':
-                subject = f"Device Request #{self.id} Approved"
-                message = f"Hello,\n\nYour request for {self.device} has been approved."
-            elif self.status == 'Issued':
-                subject = f"Device Request #{self.id} Issued"
-                message = f"Hello,\n\nThe device {self.device} has been issued to you."
-            elif self.status == 'Cancelled':
-                subject = f"Device Request #{self.id} Cancelled"
-                message = f"Hello,\n\nYour request for {self.device} has been cancelled."
-
-            if subject and message:
-                send_mail(
-                    subject,
-                    message,
-                    from_email=None,
-                    recipient_list=[user.email],
-                    fail_silently=False
-                )
+            self.send_status_notification()
 
             self._original_status = self.status
 
+    @property
+    def proof(self):
+        """The payment proof: the order's, or this request's own for requests from before orders."""
+        if self.order_id and self.order.payment_proof:
+            return self.order.payment_proof
+        return self.payment_proof
+
+    @property
+    def proof_thumbnail_url(self):
+        proof = self.proof
+        return f"{proof.url}{THUMBNAIL_SUFFIX}" if proof else ""
+
+    def send_status_notification(self):
+        """Email the requestor about the request's current status."""
+        user = self.requestor
+        subject, message = None, None
+
+        if self.status == 'Rejected':
+            subject = f"Device Request #{self.id} Rejected"
+            message = f"Hello,\n\nYour request for {self.device} has been rejected."
+        elif self.status == 'Approved':
+            subject = f"Device Request #{self.id} Approved"
+            message = f"Hello,\n\nYour request for {self.device} has been approved."
+        elif self.status == 'Issued':
+            subject = f"Device Request #{self.id} Issued"
+            message = f"Hello,\n\nThe device {self.device} has been issued to you."
+        elif self.status == 'Cancelled':
+            subject = f"Device Request #{self.id} Cancelled"
+            message = f"Hello,\n\nYour request for {self.device} has been cancelled."
+
+        if subject and message:
+            send_mail(
+                subject,
+                message,
+                from_email=None,
+                recipient_list=[user.email],
+                fail_silently=False
+            )
+
 
 class DeviceRequestSelectedIMEI(models.Model):
     device_request = models.ForeignKey(DeviceRequest, on_delete=models.CASCADE, related_name='selected_imeis')
@@ -339,6 +578,13 @@ class IssuanceRecord(models.Model):
 
 class ReturnRecord(models.Model):
     device = models.ForeignKey(Device, on_delete=models.CASCADE)
+    imei = models.ForeignKey(
+        'DeviceIMEI',
+        null=True,
+        blank=True,
+        on_delete=models.SET_NULL,
+        related_name='return_records'
+    )
     client = models.ForeignKey(Client, on_delete=models.CASCADE)
     returned_at = models.DateTimeField(auto_now_add=True)
     reason = models.TextField(blank=True)
@@ -347,6 +593,31 @@ class ReturnRecord(models.Model):
         return f"{self.device} returned by {self.client.name} on {self.returned_at.strftime('%Y-%m-%d')}"
 
 
+class ClientHolding(models.Model):
+    """
+    Materialized index of what each client currently holds: one row per (client, unit).
+    Rows are inserted on issuance and deleted on return by invent.issuance.
+    """
+    client = models.ForeignKey(Client, on_delete=models.CASCADE, related_name='holdings')
+    imei = models.OneToOneField('DeviceIMEI', on_delete=models.CASCADE, related_name='holding')
+    device = models.ForeignKey(Device, on_delete=models.CASCADE, related_name='holdings')
+    issuance = models.ForeignKey(
+        IssuanceRecord, on_delete=models.SET_NULL, null=True, blank=True, related_name='+'
+    )
+    issued_at = models.DateTimeField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['client', 'imei'], name='unique_client_holding'),
+        ]
+        indexes = [
+            models.Index(fields=['client', 'device'], name='client_holding_device_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.imei.imei_number} held by {self.client.name}"
+
+
 class Profile(models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE)
     branch = models.ForeignKey(Branch, on_delete=models.SET_NULL, null=True, blank=True)
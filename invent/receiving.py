@@ -0,0 +1,431 @@
+"""
+Receiving: bulk intake of device units (IMEI / serial / MAC) from supplier spreadsheets.
+
+Rows are streamed from the workbook in openpyxl read-only mode and
+validated as whole columns (see invent.sheets and invent.validation), checked for duplicates against the database a chunk at a
+time (screened by the in-process identifier index, invent.dedupe), and
+written with bulk_create, so a shipment of new units costs a few
+queries per thousand instead of several per row. A multi-model shipment (several
+workbooks, or a sheet per model) is parsed sheet by sheet and inserted in
+one deduplicated pass at the end; manage.py receive_workbooks parses the
+sheets in a process pool instead, which is kept out of web requests. Consecutive units
+listed as ranges ("SN000100-SN002099") are expanded lazily and go through
+the same chunked insert. Whole asset registers are loaded the same way by
+import_assets (manage.py import_assets).
+"""
+import contextlib
+import itertools
+import re
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+
+from django.db import IntegrityError, connection, transaction
+
+from .dedupe import identifier_index
+from .models import KEYED_IDENTIFIERS, OEM, Device, DeviceIMEI, match_identifiers
+from .sheets import INVALID_WORKBOOK, WORKBOOK_ERRORS, parse_unit_sheet, read_asset_chunks, sheet_names
+from .utils import bump_data_version
+from .validation import IMEI_LENGTH, MAX_IDENTIFIER_LENGTH, imei_to_int, luhn_check_digit, mac_to_int, validate_units
+
+INGEST_CHUNK_SIZE = 2000
+INSERT_ATTEMPTS = 3         # exact rechecks after a conflict before inserting unit by unit
+IDENTIFIERS = ('imei_number', 'serial_no', 'mac_address')
+
+
+def _known(field, values, maybe=None):
+    """The `values` already present in `field`; `maybe` limits the database check to index hits."""
+    if maybe is not None:
+        values = [value for value, hit in zip(values, maybe) if hit]
+    if not values:
+        return set()
+    if field in KEYED_IDENTIFIERS:
+        return set(match_identifiers(DeviceIMEI.objects, field, values))
+    return set(DeviceIMEI.objects.filter(**{f'{field}__in': values}).values_list(field, flat=True))
+
+
+def _new_units(candidates, known, seen):
+    """
+    Split candidates into units to insert and the keys of skipped duplicates.
+    `known` and `seen` hold one set per identifier field, in IDENTIFIERS order.
+    """
+    units, duplicates = [], []
+    batch = tuple(set() for _ in IDENTIFIERS)
+    for key, device, *identifiers in candidates:
+        if any(value and (value in k or value in s or value in b)
+               for value, k, s, b in zip(identifiers, known, seen, batch)):
+            duplicates.append(key)
+            continue
+        for value, b in zip(identifiers, batch):
+            if value:
+                b.add(value)
+        units.append((key, device, *identifiers))
+    return units, duplicates
+
+
+def _insert(units):
+    DeviceIMEI.objects.bulk_create(
+        [DeviceIMEI(device=device, imei_number=imei, serial_no=serial, mac_address=mac, is_available=True,
+                    imei_key=imei_to_int(imei), mac_key=mac_to_int(mac))
+         for _, device, imei, serial, mac in units],
+        batch_size=500,
+    )
+
+
+def _insert_each(units):
+    """Insert units one at a time; returns (inserted, keys of the units that conflicted)."""
+    inserted, conflicts = [], []
+    for unit in units:
+        try:
+            with transaction.atomic():
+                _insert([unit])
+        except IntegrityError:
+            conflicts.append(unit[0])
+        else:
+            inserted.append(unit)
+    return inserted, conflicts
+
+
+def _ingest(items):
+    """
+    Insert (key, device, imei_number, serial_no, mac_address) items as
+    available units. An item without an IMEI or serial, or with any
+    identifier already known (in the database or earlier in `items`), is
+    skipped. A unit with
+    only a serial number uses it as its primary identifier.
+    Returns (added, skipped) Counters by key.
+
+    Existing identifiers are screened with the in-process index (see
+    invent.dedupe); only its hits are confirmed against the database.
+    """
+    added, skipped = Counter(), Counter()
+    seen = tuple(set() for _ in IDENTIFIERS)
+    index = identifier_index()
+    items = iter(items)
+    while True:
+        chunk = list(itertools.islice(items, INGEST_CHUNK_SIZE))
+        if not chunk:
+            break
+
+        candidates = []
+        for key, device, imei_number, serial_no, mac_address in chunk:
+            if not imei_number and not serial_no:
+                skipped[key] += 1
+                continue
+            candidates.append((key, device, imei_number or serial_no, serial_no or None, mac_address or None))
+
+        columns = [[c[2 + i] for c in candidates if c[2 + i]] for i in range(len(IDENTIFIERS))]
+        units, duplicates = _new_units(
+            candidates,
+            [_known(field, values, index.contains(field, values)) for field, values in zip(IDENTIFIERS, columns)],
+            seen,
+        )
+        for attempt in range(INSERT_ATTEMPTS):
+            try:
+                with transaction.atomic():
+                    _insert(units)
+                break
+            except IntegrityError:
+                # The index missed an identifier (edited, or inserted concurrently); recheck exactly
+                units, duplicates = _new_units(
+                    candidates, [_known(field, values) for field, values in zip(IDENTIFIERS, columns)], seen,
+                )
+        else:
+            # Still racing another writer: insert one by one, counting each conflict as a duplicate
+            units, conflicts = _insert_each(units)
+            duplicates += conflicts
+
+        for key in duplicates:
+            skipped[key] += 1
+        for key, _, *identifiers in units:
+            added[key] += 1
+            for value, s in zip(identifiers, seen):
+                if value:
+                    s.add(value)
+
+    if added:
+        bump_data_version()
+    return added, skipped
+
+
+def ingest_units(device, rows):
+    """Add (imei_number, serial_no, mac_address) rows as available units of `device`. Returns (added, skipped)."""
+    added, skipped = _ingest((None, device, *row) for row in rows)
+    return added[None], skipped[None]
+
+
+def _new_device_fields(user):
+    """Fields of a Device created while receiving: staff receive into their own branch and country."""
+    return {
+        "status": "available",
+        "branch": user.profile.branch if user and not user.is_superuser else None,
+        "country": user.profile.country if user and not user.is_superuser else None,
+    }
+
+
+def receiving_device(user, oem_name, category, name):
+    """Get or create the Device a shipment is received into."""
+    oem_obj, _ = OEM.objects.get_or_create(name=oem_name)
+    device, _ = Device.objects.get_or_create(
+        oem=oem_obj,
+        name=name,
+        category=category,
+        defaults=_new_device_fields(user),
+    )
+    return device
+
+
+def receive_workbooks(user, workbooks, defaults, skip_rejected=False, workers=1):
+    """
+    Receive a multi-model shipment. `workbooks` is a list of (path, filename);
+    every sheet of every workbook is parsed and validated, in a pool of
+    `workers` processes when there are several, and mapped to a device (see
+    invent.sheets.parse_unit_sheet), then all units are inserted in one
+    deduplicated pass, so a unit listed on two sheets is only added once.
+    Nothing is written while any row is rejected, unless `skip_rejected` is set.
+
+    Returns one dict per sheet (or unreadable workbook): source, device,
+    added, skipped, rejected, error.
+    """
+    tasks, unreadable = [], []
+    for path, filename in workbooks:
+        try:
+            tasks.extend((path, filename, sheet, defaults) for sheet in sheet_names(path))
+        except WORKBOOK_ERRORS:
+            unreadable.append({'source': filename, 'units': [], 'rejected': [], 'error': INVALID_WORKBOOK})
+    workers = min(len(tasks), workers)
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            sheets = list(pool.map(parse_unit_sheet, *zip(*tasks)))
+    else:
+        sheets = [parse_unit_sheet(*task) for task in tasks]
+    sheets += unreadable
+
+    added, skipped = Counter(), Counter()
+    if skip_rejected or not any(sheet['rejected'] for sheet in sheets):
+        devices = {}
+        for sheet in sheets:
+            if not sheet['error']:
+                key = (sheet['oem'], sheet['category'], sheet['name'])
+                if key not in devices:
+                    devices[key] = receiving_device(user, *key)
+                sheet['device'] = devices[key]
+
+        added, skipped = _ingest(
+            (index, sheet['device'], *unit)
+            for index, sheet in enumerate(sheets) if not sheet['error']
+            for unit in sheet['units']
+        )
+    return [
+        {
+            'source': sheet['source'],
+            'device': sheet.get('device'),
+            'added': added[index],
+            'skipped': skipped[index],
+            'rejected': sheet['rejected'],
+            'error': sheet['error'],
+        }
+        for index, sheet in enumerate(sheets)
+    ]
+
+
+# --- Range receiving ---
+# Packing lists give consecutive units as "SN000100-SN002099": a prefix and a
+# zero-padded number. Ranges are expanded lazily and received like a sheet.
+
+MAX_RANGE_UNITS = 100000
+RANGE_SEPARATORS = ('–', '—', '..', ' to ', ' - ')
+TRAILING_NUMBER = re.compile(r'^(.*?)(\d+)$')
+RANGE_KINDS = ('serial', 'imei')
+
+
+def _split_range(text):
+    text = text.strip()
+    for separator in RANGE_SEPARATORS:
+        if separator in text:
+            first, _, last = text.partition(separator)
+            return first.strip(), last.strip()
+    if text.count('-') == 1:
+        first, _, last = text.partition('-')
+        return first.strip(), last.strip()
+    raise ValueError(f"'{text}' is not a range like SN000100-SN002099.")
+
+
+def parse_range(text, kind='serial', check_digit=True):
+    """
+    'SN000100-SN002099' -> {'prefix': 'SN', 'start': 100, 'end': 2099, 'width': 6}.
+    The number is the trailing run of digits; both ends share the prefix. For
+    IMEI ranges with check_digit, 15-digit ends lose their check digit, which
+    is recomputed for every unit.
+    """
+    first, last = _split_range(text)
+    if kind == 'imei':
+        first, last = (''.join(value.split()) for value in (first, last))
+        if check_digit:
+            first, last = (value[:-1] if len(value) == IMEI_LENGTH else value for value in (first, last))
+
+    ends = [TRAILING_NUMBER.match(value) for value in (first, last)]
+    if not all(ends):
+        raise ValueError(f"'{text}': both ends must end in a number.")
+    (prefix, first_digits), (last_prefix, last_digits) = (end.groups() for end in ends)
+    if prefix != last_prefix:
+        raise ValueError(f"'{text}': both ends must share the prefix ('{prefix}' vs '{last_prefix}').")
+    if len(first_digits) != len(last_digits) and first_digits.startswith('0'):
+        raise ValueError(f"'{text}': both ends must have the same number of digits.")
+    width = len(first_digits) if len(first_digits) == len(last_digits) else 0
+    return {'prefix': prefix, 'start': int(first_digits), 'end': int(last_digits), 'width': width}
+
+
+def check_ranges(ranges, kind, check_digit):
+    """Raise ValueError unless every range is well formed and the total is within MAX_RANGE_UNITS."""
+    if kind not in RANGE_KINDS:
+        raise ValueError("Choose whether the ranges are serial numbers or IMEIs.")
+    if not ranges:
+        raise ValueError("Enter at least one range.")
+    total = 0
+    for unit_range in ranges:
+        prefix, start, end, width = (unit_range[k] for k in ('prefix', 'start', 'end', 'width'))
+        label = f"{prefix}{start:0{width}d}"
+        if start < 0 or end < start:
+            raise ValueError(f"Range starting at {label}: the end comes before the start.")
+        length = len(prefix) + max(width, len(str(end)))
+        if kind == 'imei':
+            expected = IMEI_LENGTH - 1 if check_digit else IMEI_LENGTH
+            if (prefix and not prefix.isdigit()) or length != expected:
+                raise ValueError(
+                    f"Range starting at {label}: IMEIs need {expected} digits"
+                    f"{' before the check digit' if check_digit else ''}.")
+        elif length > MAX_IDENTIFIER_LENGTH:
+            raise ValueError(f"Range starting at {label}: serials are limited to {MAX_IDENTIFIER_LENGTH} characters.")
+        total += end - start + 1
+    if total > MAX_RANGE_UNITS:
+        raise ValueError(f"{total} units requested; at most {MAX_RANGE_UNITS} can be received at once.")
+    return total
+
+
+def expand_ranges(ranges, kind, check_digit):
+    """Lazily yield (imei, serial, mac) rows for every unit in the ranges."""
+    for unit_range in ranges:
+        prefix, width = unit_range['prefix'], unit_range['width']
+        for number in range(unit_range['start'], unit_range['end'] + 1):
+            value = f"{prefix}{number:0{width}d}"
+            if kind == 'imei':
+                yield (value + luhn_check_digit(value) if check_digit else value, '', '')
+            else:
+                yield ('', value, '')
+
+
+def invalid_range_imeis(ranges, check_digit):
+    """IMEIs in the ranges that fail the check digit (none when it is recomputed)."""
+    if check_digit:
+        return []
+    return [imei for imei, _, _ in expand_ranges(ranges, 'imei', False) if imei[-1] != luhn_check_digit(imei[:-1])]
+
+
+def receive_ranges(device, ranges, kind, check_digit):
+    """Receive every unit in the (checked) ranges into `device`. Returns (added, skipped)."""
+    return ingest_units(device, expand_ranges(ranges, kind, check_digit))
+
+
+# --- Asset register import (manage.py import_assets) ---
+
+IMPORT_CHUNK_SIZE = 20000
+MAX_REPORTED_REJECTIONS = 20
+
+
+class _DeviceCache:
+    """
+    (oem name, category, name) -> Device for a whole import, loaded in two
+    queries; the devices (and OEMs) a chunk needs that do not exist yet are
+    created together.
+    """
+
+    def __init__(self, user=None):
+        self.fields = _new_device_fields(user)
+        self.oems = {oem.name: oem for oem in OEM.objects.all()}
+        self.devices = {}
+        # Newest first, so the oldest of any duplicate models wins, as with get_or_create's first match
+        for device in Device.objects.select_related('oem').order_by('-id'):
+            self.devices[(device.oem.name if device.oem else '', device.category, device.name)] = device
+        self.created = 0
+
+    def resolve(self, keys):
+        missing = sorted(set(keys) - self.devices.keys())
+        if not missing:
+            return self.devices
+        new_oems = {oem_name for oem_name, _, _ in missing} - self.oems.keys()
+        if new_oems:
+            OEM.objects.bulk_create([OEM(name=oem_name) for oem_name in new_oems], ignore_conflicts=True)
+            self.oems.update((oem.name, oem) for oem in OEM.objects.filter(name__in=new_oems))
+
+        devices = [Device(oem=self.oems[oem_name], category=category, name=name, **self.fields)
+                   for oem_name, category, name in missing]
+        if connection.features.can_return_rows_from_bulk_insert:
+            Device.objects.bulk_create(devices)
+        else:
+            for device in devices:
+                device.save()
+        self.devices.update(zip(missing, devices))
+        self.created += len(devices)
+        return self.devices
+
+
+def import_assets(path, defaults=None, user=None, dry_run=False, chunk_size=IMPORT_CHUNK_SIZE, progress=None):
+    """
+    Load an asset register (CSV or .xlsx, see invent.sheets.read_asset_chunks)
+    into Device / DeviceIMEI, `chunk_size` rows at a time: each chunk is
+    validated as columns, mapped to devices through in-memory caches and
+    inserted through the screened, deduplicated chunk insert. Rows that fail
+    validation or name no device are skipped and reported. `defaults` fills
+    a missing OEM, category or device name. With dry_run the whole import
+    runs in a transaction that is rolled back.
+
+    `progress(stats)` is called after every chunk. Returns stats: rows, added,
+    skipped, rejected (a count), rejections (the first few (row, message)
+    pairs), devices_created and seconds.
+    """
+    defaults = defaults or {}
+    stats = {'rows': 0, 'added': 0, 'skipped': 0, 'rejected': 0, 'rejections': [], 'devices_created': 0}
+    started = time.monotonic()
+
+    with transaction.atomic() if dry_run else contextlib.nullcontext():
+        devices = _DeviceCache(user)
+        for first_row, columns in read_asset_chunks(path, chunk_size):
+            units, rejected = validate_units(columns['imei'], columns['serial'], columns['mac'], first_row)
+            dropped = {row - first_row for row, _ in rejected}
+            keys = [
+                (oem_name or defaults.get('oem', ''), category or defaults.get('category', ''),
+                 name or defaults.get('name', ''))
+                for i, (oem_name, category, name) in enumerate(zip(columns['oem'], columns['category'], columns['name']))
+                if i not in dropped
+            ]
+            kept = [i for i in range(len(columns['imei'])) if i not in dropped]
+            items = []
+            for i, unit, key in zip(kept, units, keys):
+                if not any(unit):
+                    continue
+                if all(key):
+                    items.append((key, unit))
+                else:
+                    rejected.append((first_row + i, "No OEM, category or device name."))
+
+            by_key = devices.resolve(key for key, _ in items)
+            added, skipped = _ingest((None, by_key[key], *unit) for key, unit in items)
+
+            stats['rows'] += len(columns['imei'])
+            stats['added'] += added[None]
+            stats['skipped'] += skipped[None]
+            stats['rejected'] += len(rejected)
+            room = MAX_REPORTED_REJECTIONS - len(stats['rejections'])
+            stats['rejections'].extend(sorted(rejected)[:max(room, 0)])
+            stats['devices_created'] = devices.created
+            stats['seconds'] = time.monotonic() - started
+            if progress:
+                progress(stats)
+
+        if dry_run:
+            # Also drops the on-commit data version bumps, so cached reports stay valid
+            transaction.set_rollback(True)
+
+    stats['seconds'] = time.monotonic() - started
+    return stats
@@ -0,0 +1,182 @@
+"""
+Spreadsheet parsing for receiving, kept free of Django imports so it can run
+in worker processes (see manage.py receive_workbooks).
+
+A unit sheet is an optional preamble of "OEM | Teltonika", "Category |
+Router", "Device | RUT240" rows, then a header row naming an 'IMEI No' and/or
+'Serial No' column (and optionally 'MAC Address'), then one unit per row.
+Other columns are ignored. Identifiers are normalized and validated by
+invent.validation before anything is written.
+
+An asset register (manage.py import_assets) is a plain table instead: a
+header row, then one unit per row naming its own OEM, category and device.
+"""
+import csv
+import itertools
+import os
+import re
+from xml.etree.ElementTree import ParseError
+from zipfile import BadZipFile
+
+import openpyxl
+from openpyxl.utils.exceptions import InvalidFileException
+
+from .validation import validate_units
+
+UNIT_COLUMNS = ('imei no', 'serial no', 'mac address')
+REQUIRED_COLUMNS = ('imei no', 'serial no')
+PREAMBLE_KEYS = {'oem': 'oem', 'category': 'category', 'device': 'name', 'model': 'name', 'name': 'name'}
+MAX_PREAMBLE_ROWS = 20
+DEFAULT_SHEET_TITLE = re.compile(r'^sheet\s*\d*$', re.IGNORECASE)
+# What openpyxl raises for a file that is not a readable .xlsx workbook
+WORKBOOK_ERRORS = (InvalidFileException, BadZipFile, KeyError, ParseError)
+INVALID_WORKBOOK = "Invalid Excel file. Upload a valid .xlsx file."
+# Asset register columns and the header spellings accepted for each
+ASSET_COLUMNS = {
+    'oem': ('oem', 'manufacturer', 'make'),
+    'category': ('category', 'asset category-minor', 'asset category'),
+    'name': ('device', 'device name', 'model', 'name', 'asset description'),
+    'imei': ('imei no', 'imei', 'imei number'),
+    'serial': ('serial no', 'serial number', 'serial'),
+    'mac': ('mac address', 'mac'),
+}
+
+
+def cell_text(value):
+    """Text of a spreadsheet cell; whole-number floats (how Excel stores long IDs) lose the '.0'."""
+    if value is None:
+        return ''
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return str(value).strip()
+
+
+def _split_sheet(rows):
+    """
+    Consume the preamble and header from `rows`; return (preamble dict, column
+    positions, sheet row number of the first unit).
+    """
+    preamble = {}
+    for row_number in range(1, MAX_PREAMBLE_ROWS + 1):
+        row = next(rows, None)
+        if row is None:
+            break
+        cells = [cell_text(value) for value in row]
+        header = [cell.lower() for cell in cells]
+        if any(column in header for column in REQUIRED_COLUMNS):
+            positions = [header.index(column) if column in header else None for column in UNIT_COLUMNS]
+            return preamble, positions, row_number + 1
+        key = header[0].rstrip(':').strip() if header else ''
+        if key in PREAMBLE_KEYS and len(cells) > 1 and cells[1]:
+            preamble[PREAMBLE_KEYS[key]] = cells[1]
+    raise ValueError("Excel must contain at least 'IMEI No' or 'Serial No' column.")
+
+
+def _unit_columns(rows, positions):
+    """Cell text per unit column (empty for a column the sheet lacks), one entry per row."""
+    columns = tuple([] for _ in positions)
+    for row in rows:
+        for column, position in zip(columns, positions):
+            column.append(cell_text(row[position]) if position is not None and position < len(row) else '')
+    return columns
+
+
+def sheet_names(path):
+    workbook = openpyxl.load_workbook(path, read_only=True)
+    try:
+        return workbook.sheetnames
+    finally:
+        workbook.close()
+
+
+def parse_unit_sheet(source, filename, sheet=None, defaults=None):
+    """
+    Parse one sheet (the active one when `sheet` is None) of an .xlsx path or
+    file into a plain dict, picklable for a process pool: source, oem,
+    category, name, units [(imei, serial, mac)] that passed validation,
+    rejected [(row number, message)], and error.
+
+    The device comes from the preamble, falling back to `defaults` and then,
+    for the name, to the sheet title (or the file name, for a default
+    "Sheet1" title).
+    """
+    defaults = defaults or {}
+    result = {'source': filename, 'oem': '', 'category': '', 'name': '', 'units': [], 'rejected': [], 'error': None}
+
+    try:
+        workbook = openpyxl.load_workbook(source, read_only=True, data_only=True)
+    except Exception:
+        result['error'] = INVALID_WORKBOOK
+        return result
+    try:
+        worksheet = workbook[sheet] if sheet is not None else workbook.active
+        title = worksheet.title
+        if sheet is not None:
+            result['source'] = f"{filename} / {title}"
+        rows = worksheet.iter_rows(values_only=True)
+        preamble, positions, first_row = _split_sheet(rows)
+        result['units'], result['rejected'] = validate_units(*_unit_columns(rows, positions), first_row)
+        result.update(
+            oem=preamble.get('oem') or defaults.get('oem', ''),
+            category=preamble.get('category') or defaults.get('category', ''),
+            name=preamble.get('name') or defaults.get('name') or (
+                os.path.splitext(filename)[0] if DEFAULT_SHEET_TITLE.match(title) else title),
+        )
+    except ValueError as e:
+        result['error'] = str(e)
+    except Exception:
+        result['error'] = "Could not read this sheet."
+    finally:
+        workbook.close()
+
+    if not result['error'] and not all((result['oem'], result['category'], result['name'])):
+        result['error'] = "No OEM, category or device name for this sheet."
+    return result
+
+
+def _table_rows(path):
+    """Rows of a .csv file or of the first sheet of an .xlsx workbook, streamed."""
+    extension = os.path.splitext(path)[1].lower()
+    if extension == '.csv':
+        with open(path, newline='', encoding='utf-8-sig') as f:
+            yield from csv.reader(f)
+        return
+    if extension not in ('.xlsx', '.xlsm'):
+        raise ValueError("Asset registers must be .csv or .xlsx files.")
+    try:
+        workbook = openpyxl.load_workbook(path, read_only=True, data_only=True)
+    except FileNotFoundError:
+        raise
+    except Exception:
+        raise ValueError("Invalid Excel file. Use a valid .xlsx file.")
+    try:
+        yield from workbook.active.iter_rows(values_only=True)
+    finally:
+        workbook.close()
+
+
+def read_asset_chunks(path, chunk_size):
+    """
+    Stream an asset register as (sheet row number of the first row, columns)
+    chunks of up to `chunk_size` rows; columns maps every ASSET_COLUMNS key to
+    a list of cell text ('' where the file lacks the column).
+    """
+    rows = _table_rows(path)
+    header = [cell_text(value).lower() for value in next(rows, ())]
+    positions = {
+        key: next((header.index(alias) for alias in aliases if alias in header), None)
+        for key, aliases in ASSET_COLUMNS.items()
+    }
+    if positions['imei'] is None and positions['serial'] is None:
+        raise ValueError("The file must contain at least an 'IMEI No' or 'Serial No' column.")
+
+    first_row = 2
+    while True:
+        chunk = list(itertools.islice(rows, chunk_size))
+        if not chunk:
+            return
+        yield first_row, {
+            key: [cell_text(row[position]) if position is not None and position < len(row) else '' for row in chunk]
+            for key, position in positions.items()
+        }
+        first_row += len(chunk)
@@ -1,7 +1,12 @@
-from django.db.models.signals import post_save
+from django.db import transaction
+from django.db.models.signals import post_init, post_save, post_delete
 from django.dispatch import receiver
 from django.contrib.auth.models import User
-from .models import Profile
+from .models import (
+    Profile, Device, DeviceIMEI, DeviceOrder, DeviceRequest, IssuanceRecord, PurchaseOrder, ReturnRecord
+)
+from .utils import bump_data_version
+from .stock import PROMISED_STATUSES, release_promises
 
 @receiver(post_save, sender=User)
 def create_or_ensure_user_profile(sender, instance, created, **kwargs):
@@ -9,4 +14,71 @@ def create_or_ensure_user_profile(sender, instance, created, **kwargs):
     Ensure a Profile exists for each User. Use get_or_create to avoid integrity errors.
     This is defensive — admin add flow will not try to create an inline profile thanks to admin.get_inline_instances override.
     """
-    Profile.objects.get_or_create(user=instance)
\ No newline at end of file
+    Profile.objects.get_or_create(user=instance)
+
+
+def bump_inventory_data_version(sender, **kwargs):
+    """
+    Invalidate cached reports whenever stock or request history changes.
+    Bulk paths (update()/bulk_create()) do not send signals and call bump_data_version() themselves.
+    """
+    bump_data_version()
+
+
+for _model in (Device, DeviceIMEI, DeviceRequest, IssuanceRecord, ReturnRecord):
+    post_save.connect(bump_inventory_data_version, sender=_model,
+                      dispatch_uid=f"bump_data_version_save_{_model.__name__}")
+    post_delete.connect(bump_inventory_data_version, sender=_model,
+                        dispatch_uid=f"bump_data_version_delete_{_model.__name__}")
+
+
+@receiver(post_save, sender=DeviceRequest)
+def release_closed_request_promise(sender, instance, created, **kwargs):
+    """
+    A request stops counting against available-to-promise once it leaves the
+    open statuses: its units are now held (Waiting Approval), issued, or it was
+    rejected/cancelled. Bulk status updates call release_promises() themselves.
+    """
+    if instance.promised_quantity and instance.status not in PROMISED_STATUSES:
+        release_promises([instance.pk])
+        instance.promised_quantity = 0
+
+
+# Uploaded documents live in DedupStorage, which counts references per blob.
+# A row drops its reference when it is deleted or its file is replaced.
+DOCUMENT_FIELDS = {DeviceOrder: 'payment_proof', DeviceRequest: 'payment_proof', PurchaseOrder: 'document'}
+
+
+def _release_document(field, name):
+    if name:
+        transaction.on_commit(lambda: field.storage.delete(name))
+
+
+def remember_document(sender, instance, **kwargs):
+    value = instance.__dict__.get(DOCUMENT_FIELDS[sender])  # deferred fields stay unloaded
+    instance._stored_document = getattr(value, 'name', value)
+
+
+def release_replaced_document(sender, instance, **kwargs):
+    field = sender._meta.get_field(DOCUMENT_FIELDS[sender])
+    if field.attname not in instance.__dict__:
+        return
+    name = getattr(instance, field.attname).name
+    old = getattr(instance, '_stored_document', None)
+    if old != name:
+        _release_document(field, old)
+    instance._stored_document = name
+
+
+def release_deleted_document(sender, instance, **kwargs):
+    field = sender._meta.get_field(DOCUMENT_FIELDS[sender])
+    if field.attname in instance.__dict__:
+        _release_document(field, getattr(instance, field.attname).name)
+
+
+for _model in DOCUMENT_FIELDS:
+    post_init.connect(remember_document, sender=_model, dispatch_uid=f"remember_document_{_model.__name__}")
+    post_save.connect(release_replaced_document, sender=_model,
+                      dispatch_uid=f"release_replaced_document_{_model.__name__}")
+    post_delete.connect(release_deleted_document, sender=_model,
+                        dispatch_uid=f"release_deleted_document_{_model.__name__}")
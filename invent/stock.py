@@ -0,0 +1,435 @@
+"""
+Stock allocation for issuance.
+
+Units leave the available pool through a single check-and-set statement, so
+two clerks issuing the same model can never be handed the same IMEI: row locks
+(SELECT ... FOR UPDATE [SKIP LOCKED]) where the backend has them, otherwise one
+atomic UPDATE ... WHERE id IN (SELECT ... LIMIT n) RETURNING id, which SQLite
+runs under its single writer lock.
+
+Units picked in select_imeis are held rather than taken: reserved_until marks
+a time-limited hold that still counts as out of stock while it is live. Once it
+lapses the unit is treated as available again everywhere (available_unit_q),
+and release_expired_reservations sweeps the stale hold columns in one UPDATE.
+
+Open requests are promised stock before any unit is picked: Device keeps a
+running committed_quantity, and available-to-promise is what is available
+minus that. promise_units checks and bumps it in one conditional UPDATE, so
+concurrent submissions can never promise the same last units twice.
+"""
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.db.models import Count, F, OuterRef, Subquery
+from django.db.models.functions import Coalesce, Greatest
+from django.utils import timezone
+
+from .models import Device, DeviceIMEI, DeviceRequest, SelectedDevice, available_unit_q, match_identifiers
+from .utils import bump_data_version, get_data_version
+
+RESERVATION_CLEARED = {'reserved_until': None, 'reserved_by': None, 'reserved_for': None}
+
+# Units resolved/reserved per statement when selecting from a long IMEI list
+SELECT_CHUNK_SIZE = 1000
+
+# Request statuses whose quantity stays promised until units are held or issued
+PROMISED_STATUSES = ('Pending', 'Under Review', 'Approved')
+
+
+class AllocationError(Exception):
+    """The pool could not satisfy an allocation in full; nothing was taken."""
+
+
+def reservation_expiry():
+    return timezone.now() + timedelta(hours=getattr(settings, 'IMEI_RESERVATION_HOURS', 48))
+
+
+def _take_fifo(device_id, quantity):
+    if connection.features.has_select_for_update:
+        ids = list(
+            DeviceIMEI.objects
+            .select_for_update(skip_locked=connection.features.has_select_for_update_skip_locked)
+            .filter(available_unit_q(), device_id=device_id)
+            .order_by('added_on', 'id')
+            .values_list('id', flat=True)[:quantity]
+        )
+        DeviceIMEI.objects.filter(id__in=ids).update(is_available=False, **RESERVATION_CLEARED)
+        return ids
+
+    # A lapsed hold is fair game; taking the unit clears it
+    table = connection.ops.quote_name(DeviceIMEI._meta.db_table)
+    now = timezone.now()
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"UPDATE {table} SET is_available = %s, reserved_until = NULL, "
+            f"reserved_by_id = NULL, reserved_for_id = NULL "
+            f"WHERE (is_available = %s OR reserved_until < %s) AND id IN ("
+            f"SELECT id FROM {table} WHERE device_id = %s "
+            f"AND (is_available = %s OR reserved_until < %s) "
+            f"ORDER BY added_on, id LIMIT %s"
+            f") RETURNING id",
+            [False, True, now, device_id, True, now, quantity],
+        )
+        return [row[0] for row in cursor.fetchall()]
+
+
+def allocate_units(device, quantity, strict=True):
+    """
+    Take `quantity` available units of `device`, oldest (added_on) first, and
+    return them as DeviceIMEI rows. With strict=True a short pool raises
+    AllocationError and rolls the allocation back; otherwise whatever is
+    available is returned.
+    """
+    if quantity <= 0:
+        return []
+    device_id = getattr(device, 'pk', device)
+
+    with transaction.atomic():
+        ids = _take_fifo(device_id, quantity)
+        if strict and len(ids) < quantity:
+            raise AllocationError(
+                f"Only {len(ids)} of {quantity} requested units are available."
+            )
+
+    if ids:
+        bump_data_version()
+    return list(
+        DeviceIMEI.objects.filter(id__in=ids).select_related('device').order_by('added_on', 'id')
+    )
+
+
+def allocate_unpromised_units(device, quantity):
+    """
+    allocate_units() for an issue outside any request: the units must come
+    out of stock not already promised to open requests (available_to_promise),
+    otherwise AllocationError is raised and nothing is taken.
+    """
+    device_id = getattr(device, 'pk', device)
+    with transaction.atomic():
+        units = allocate_units(device_id, quantity)
+        device = Device.objects.select_for_update().get(pk=device_id)
+        if device.committed_quantity > device.available_quantity:
+            unpromised = max(device.available_quantity + quantity - device.committed_quantity, 0)
+            raise AllocationError(
+                f"Only {unpromised} units of {device.name} are not promised to open requests."
+            )
+    return units
+
+
+def claim_units(imei_ids):
+    """
+    Take these specific units if, and only if, every one of them is still
+    available. Raises AllocationError (and takes nothing) otherwise.
+    """
+    imei_ids = set(imei_ids)
+    if not imei_ids:
+        return 0
+
+    with transaction.atomic():
+        claimed = (
+            DeviceIMEI.objects
+            .filter(available_unit_q(), id__in=imei_ids)
+            .update(is_available=False, **RESERVATION_CLEARED)
+        )
+        if claimed != len(imei_ids):
+            raise AllocationError(
+                f"{len(imei_ids) - claimed} of the selected units are no longer available."
+            )
+
+    bump_data_version()
+    return claimed
+
+
+def reserve_units(imei_ids, device_request, user):
+    """
+    Hold whichever of these units are still available for `device_request`
+    until reservation_expiry(). Returns the set of ids actually reserved; the
+    rest were taken or held by someone else in the meantime.
+    """
+    imei_ids = set(imei_ids)
+    if not imei_ids:
+        return set()
+
+    # Check-and-set first, then read back what this call stamped
+    until = reservation_expiry()
+    with transaction.atomic():
+        DeviceIMEI.objects.filter(available_unit_q(), id__in=imei_ids).update(
+            is_available=False,
+            reserved_until=until,
+            reserved_by=user,
+            reserved_for=device_request,
+        )
+        reserved = set(
+            DeviceIMEI.objects
+            .filter(id__in=imei_ids, reserved_for=device_request, reserved_until=until)
+            .values_list('id', flat=True)
+        )
+
+    if reserved:
+        bump_data_version()
+    return reserved
+
+
+def select_units(device_request, user, imei_numbers=None, imei_ids=None):
+    """
+    Hold units of the requested model for `device_request` and record them as
+    SelectedDevice rows, given either IMEI numbers (e.g. from a spreadsheet)
+    or DeviceIMEI ids (from the picker). The input is consumed lazily in
+    chunks of SELECT_CHUNK_SIZE: one lookup, one reserving UPDATE and one
+    bulk_create per chunk, all in one transaction.
+
+    Returns a dict: selected (count), unmatched and duplicates (offending
+    input values) and taken (IMEI numbers already held or issued).
+    """
+    key, values = ('imei_number', imei_numbers) if imei_numbers is not None else ('id', imei_ids)
+    candidates = DeviceIMEI.objects.filter(
+        device__name=device_request.device.name,
+        device__oem_id=device_request.device.oem_id,
+    )
+    result = {'selected': 0, 'unmatched': [], 'duplicates': [], 'taken': []}
+    seen = set()
+
+    def chunks():
+        chunk = []
+        for value in values:
+            if value in seen:
+                result['duplicates'].append(value)
+                continue
+            seen.add(value)
+            chunk.append(value)
+            if len(chunk) == SELECT_CHUNK_SIZE:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    with transaction.atomic():
+        for chunk in chunks():
+            if key == 'imei_number':
+                found = match_identifiers(candidates, 'imei_number', chunk, 'id', 'device_id', 'imei_number')
+            else:
+                found = {
+                    value: (pk, device_id, imei_number)
+                    for value, pk, device_id, imei_number in candidates
+                    .filter(id__in=chunk)
+                    .values_list('id', 'id', 'device_id', 'imei_number')
+                }
+            result['unmatched'] += [value for value in chunk if value not in found]
+
+            # Two spellings of one IMEI ('35-...' and '35...') find the same unit
+            units = {}
+            for value, (pk, device_id, imei_number) in found.items():
+                if pk in units:
+                    result['duplicates'].append(value)
+                else:
+                    units[pk] = (device_id, imei_number)
+
+            reserved = reserve_units(units, device_request, user)
+            result['taken'] += [number for pk, (_, number) in units.items() if pk not in reserved]
+            SelectedDevice.objects.bulk_create([
+                SelectedDevice(imei_id=pk, device_id=device_id, request=device_request, selected_by=user)
+                for pk, (device_id, _) in units.items() if pk in reserved
+            ])
+            result['selected'] += len(reserved)
+
+    return result
+
+
+def confirm_reservations(device_request, imei_ids):
+    """
+    Turn this request's holds on these units into a permanent take. Units whose
+    hold lapsed are re-claimed if still free; otherwise AllocationError is
+    raised and nothing changes.
+    """
+    imei_ids = set(imei_ids)
+    if not imei_ids:
+        return
+
+    with transaction.atomic():
+        held = DeviceIMEI.objects.filter(
+            id__in=imei_ids,
+            reserved_for=device_request,
+            reserved_until__gte=timezone.now(),
+        )
+        held_ids = set(held.values_list('id', flat=True))
+        DeviceIMEI.objects.filter(id__in=held_ids).update(**RESERVATION_CLEARED)
+        claim_units(imei_ids - held_ids)
+
+
+def classify_picked_units(owner, now=None):
+    """
+    `owner` maps picked unit id -> id of the request it was picked for. Split
+    the units into those still held for their own request and those free to
+    claim again (hold lapsed or released); return (held, claimable, blocked)
+    where `blocked` holds the ids of requests with a unit lost to someone else.
+    """
+    now = now or timezone.now()
+    held, claimable, blocked = set(), set(), set()
+    for unit_id, reserved_for, reserved_until, is_available in (
+        DeviceIMEI.objects.filter(id__in=owner)
+        .values_list('id', 'reserved_for_id', 'reserved_until', 'is_available')
+    ):
+        request_id = owner[unit_id]
+        if reserved_until and reserved_until >= now and reserved_for == request_id:
+            held.add(unit_id)
+        elif is_available or (reserved_until and reserved_until < now):
+            claimable.add(unit_id)
+        else:
+            blocked.add(request_id)
+    return held, claimable, blocked
+
+
+def take_picked_units(held, claimable):
+    """
+    Make `held` units' holds permanent and check-and-set `claimable` ones, in
+    two statements. Raises AllocationError if a claim lost a race; call inside
+    a transaction so that rolls everything back.
+    """
+    DeviceIMEI.objects.filter(id__in=held).update(**RESERVATION_CLEARED)
+    claimed = (
+        DeviceIMEI.objects
+        .filter(available_unit_q(), id__in=claimable)
+        .update(is_available=False, **RESERVATION_CLEARED)
+    )
+    if claimed != len(claimable):
+        raise AllocationError("Stock changed while processing; nothing was taken, please retry.")
+
+
+def release_reservations(device_requests):
+    """Hand back every unit still held for these requests (rejected or cancelled)."""
+    released = (
+        DeviceIMEI.objects
+        .filter(reserved_for__in=device_requests, reserved_until__isnull=False)
+        .update(is_available=True, **RESERVATION_CLEARED)
+    )
+    if released:
+        bump_data_version()
+    return released
+
+
+def release_expired_reservations(now=None):
+    """Return every unit whose hold has lapsed to the pool in one set-based UPDATE."""
+    released = (
+        DeviceIMEI.objects
+        .filter(reserved_until__lt=now or timezone.now())
+        .update(is_available=True, **RESERVATION_CLEARED)
+    )
+    if released:
+        bump_data_version()
+    return released
+
+
+def promise_units(device, quantity):
+    """
+    Promise `quantity` units of `device` to a new request, or raise
+    AllocationError if fewer than that are available to promise.
+    """
+    device_id = getattr(device, 'pk', device)
+    in_stock = Coalesce(
+        Subquery(
+            DeviceIMEI.objects
+            .filter(available_unit_q(), device=OuterRef('pk'))
+            .values('device')
+            .annotate(n=Count('pk'))
+            .values('n')
+        ),
+        0,
+    )
+    promised = (
+        Device.objects
+        .filter(pk=device_id, committed_quantity__lte=in_stock - quantity)
+        .update(committed_quantity=F('committed_quantity') + quantity)
+    )
+    if promised:
+        bump_data_version()
+    else:
+        device = Device.objects.get(pk=device_id)
+        raise AllocationError(
+            f"Only {device.available_to_promise} units of {device.name} are available to promise."
+        )
+
+
+def release_promises(device_requests):
+    """Hand back whatever these requests still have promised (they are now held, issued or closed)."""
+    ids = [getattr(r, 'pk', r) for r in device_requests]
+    if not ids:
+        return
+
+    with transaction.atomic():
+        owed = list(
+            DeviceRequest.objects
+            .select_for_update()
+            .filter(pk__in=ids, promised_quantity__gt=0)
+            .values_list('pk', 'device_id', 'promised_quantity')
+        )
+        if not owed:
+            return
+        per_device = {}
+        for _, device_id, quantity in owed:
+            per_device[device_id] = per_device.get(device_id, 0) + quantity
+        for device_id, quantity in per_device.items():
+            Device.objects.filter(pk=device_id).update(
+                committed_quantity=Greatest(F('committed_quantity') - quantity, 0)
+            )
+        DeviceRequest.objects.filter(pk__in=[pk for pk, _, _ in owed]).update(promised_quantity=0)
+    bump_data_version()
+
+
+# -------------------- Request Catalog -------------------- #
+
+def build_catalog(country=None):
+    """
+    OEM -> category -> device name tree of everything requestable in `country`
+    (all countries when None), from one grouped query. A request is filled
+    from a single Device row (one branch), so each name carries the device
+    with the most available-to-promise and that figure.
+    """
+    devices = Device.objects.all()
+    if country is not None:
+        devices = devices.filter(branch__country=country)
+    rows = (
+        devices
+        .values('id', 'oem_id', 'oem__name', 'category', 'name', 'committed_quantity')
+        .annotate(in_stock=Count('imeis', filter=available_unit_q('imeis__')))
+        .order_by('oem__name', 'category', 'name')
+    )
+
+    oems = {}
+    for row in rows:
+        if row['oem_id'] is None:
+            continue
+        oem = oems.setdefault(row['oem_id'], {'id': row['oem_id'], 'name': row['oem__name'], 'categories': {}})
+        names = oem['categories'].setdefault(row['category'] or '', {})
+        available = max(row['in_stock'] - row['committed_quantity'], 0)
+        best = names.get(row['name'])
+        if best is None or available > best['available']:
+            names[row['name']] = {'name': row['name'], 'device_id': row['id'], 'available': available}
+
+    return [
+        {
+            'id': oem['id'],
+            'name': oem['name'],
+            'categories': [
+                {'name': category, 'devices': list(names.values())}
+                for category, names in oem['categories'].items()
+            ],
+        }
+        for oem in oems.values()
+    ]
+
+
+def catalog_etag(country=None):
+    scope = country.pk if country is not None else 'all'
+    return f"catalog-{scope}-{get_data_version()}"
+
+
+def get_catalog(country=None):
+    """Cached build_catalog(), keyed by scope and data version."""
+    key = f"invent:{catalog_etag(country)}"
+    catalog = cache.get(key)
+    if catalog is None:
+        catalog = build_catalog(country)
+        cache.set(key, catalog, 60 * 60)
+    return catalog
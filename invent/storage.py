@@ -0,0 +1,96 @@
+"""
+Content-addressed storage for uploaded documents (payment proofs, PO documents).
+
+An upload is hashed while it streams to a temporary file and then renamed to
+`<upload_to>/<aa>/<sha256><ext>`, so identical files share one blob on disk
+however many orders or re-uploads point at them. StoredBlob counts the
+references: every save adds one, every delete drops one, and the blob is
+removed when the last reference goes.
+"""
+import hashlib
+import os
+import posixpath
+import tempfile
+
+from django.core.files.storage import FileSystemStorage
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from django.utils.deconstruct import deconstructible
+
+CHUNK_SIZE = 64 * 1024
+# Derived files cached beside a blob (see invent.thumbnails); they go with it
+THUMBNAIL_SUFFIX = '.thumb.jpg'
+
+
+@deconstructible
+class DedupStorage(FileSystemStorage):
+
+    def get_available_name(self, name, max_length=None):
+        # The stored name is the digest, decided in _save(); equal names are the same content
+        return name
+
+    def _save(self, name, content):
+        directory = posixpath.dirname(name)
+        extension = os.path.splitext(name)[1].lower()
+        os.makedirs(self.path(directory or '.'), exist_ok=True)
+
+        # Hash while streaming to a temporary file beside the final location
+        digest = hashlib.sha256()
+        handle, temp_path = tempfile.mkstemp(dir=self.path(directory or '.'), suffix='.part')
+        try:
+            with os.fdopen(handle, 'wb') as temp:
+                if hasattr(content, 'seek'):
+                    content.seek(0)
+                for chunk in content.chunks(CHUNK_SIZE):
+                    digest.update(chunk)
+                    temp.write(chunk)
+
+            hexdigest = digest.hexdigest()
+            stored = posixpath.join(directory, hexdigest[:2], hexdigest + extension)
+            os.makedirs(os.path.dirname(self.path(stored)), exist_ok=True)
+
+            # Count the reference before the blob appears, so a concurrent
+            # delete of the last old reference can never remove it afterwards
+            add_reference(stored)
+            if os.path.exists(self.path(stored)):
+                os.remove(temp_path)
+            else:
+                os.replace(temp_path, self.path(stored))
+                if self.file_permissions_mode is not None:
+                    os.chmod(self.path(stored), self.file_permissions_mode)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        return stored
+
+    def delete(self, name):
+        """Drop one reference; the blob itself goes with the last one."""
+        if not name:
+            return
+        if drop_reference(name):
+            super().delete(name)
+            super().delete(name + THUMBNAIL_SUFFIX)
+
+
+def add_reference(name):
+    from .models import StoredBlob
+
+    if StoredBlob.objects.filter(name=name).update(refcount=F('refcount') + 1):
+        return
+    try:
+        with transaction.atomic():
+            StoredBlob.objects.create(name=name, refcount=1)
+    except IntegrityError:
+        # Created concurrently by another upload of the same content
+        StoredBlob.objects.filter(name=name).update(refcount=F('refcount') + 1)
+
+
+def drop_reference(name):
+    """Returns True when no references to `name` remain (or it was never counted)."""
+    from .models import StoredBlob
+
+    if not StoredBlob.objects.filter(name=name).update(refcount=F('refcount') - 1):
+        return True
+    deleted, _ = StoredBlob.objects.filter(name=name, refcount__lte=0).delete()
+    return bool(deleted)
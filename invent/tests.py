@@ -1,3 +1,738 @@
-from django.test import TestCase
+import io
+import os
+import shutil
+import tempfile
+from datetime import datetime, timedelta
+from unittest import mock
+
+import numpy as np
+import openpyxl
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.urls import Resolver404, resolve, reverse
+from django.utils import timezone
+
+from .analytics import build_pivot, compute_device_analytics, iter_pivot_rows
+from .dedupe import IdentifierIndex, MIN_CAPACITY, _FieldIndex, field_keys, identifier_keys
+from .issuance import approve_selected_requests, issue_requests, reject_open_requests, send_delivery_notes
+from .models import (
+    Branch, Client, ClientHolding, Country, Device, DeviceIMEI, DeviceRequest, DeviceRequestSelectedIMEI,
+    IssuanceRecord, OEM, ReturnRecord, SelectedDevice, StoredBlob,
+)
+from .receiving import check_ranges, expand_ranges, import_assets, parse_range, receive_ranges
+from .storage import DedupStorage, THUMBNAIL_SUFFIX
+from .stock import (
+    AllocationError, allocate_unpromised_units, allocate_units, promise_units, release_expired_reservations,
+    release_promises, reserve_units,
+)
+from .uploads import UploadError, load_upload
+from .validation import (
+    BAD_CHECK_DIGIT, NOT_A_MAC, NOT_NUMERIC, SCIENTIFIC_NOTATION, WRONG_LENGTH,
+    imei_to_int, luhn_check_digit, luhn_valid, mac_to_int, normalize_imeis, normalize_macs, validate_units,
+)
+from .utils import bump_data_version, get_data_version
+
+
+TEST_CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+
+
+@override_settings(CACHES=TEST_CACHES)
+class ProtectedMediaTests(TestCase):
+    """invent.views.protected_media: scope check, ranges, conditional GET and sendfile headers."""
+
+    body = b'0123456789' * 10
+    name = 'payment_proofs/scan ü 1.pdf'
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.kenya = Country.objects.create(name='Kenya')
+        cls.uganda = Country.objects.create(name='Uganda')
+        cls.nairobi = Branch.objects.create(name='Nairobi', address='x', country=cls.kenya)
+        cls.kampala = Branch.objects.create(name='Kampala', address='y', country=cls.uganda)
+        device = Device.objects.create(name='RUT240', oem=OEM.objects.create(name='Teltonika'), category='Router')
+        cls.requestor = User.objects.create_user('requestor', password='pw')
+        cls.clerk = cls._staff('clerk', cls.nairobi)
+        cls.outsider = cls._staff('outsider', cls.kampala)
+        request = DeviceRequest.objects.create(device=device, requestor=cls.requestor, branch=cls.nairobi)
+        # Stored names are normally digests; set one with a space and non-ASCII to exercise quoting
+        DeviceRequest.objects.filter(pk=request.pk).update(payment_proof=cls.name)
+
+    @classmethod
+    def _staff(cls, username, branch):
+        user = User.objects.create_user(username, password='pw')
+        user.profile.branch = branch
+        user.profile.country = branch.country
+        user.profile.save()
+        return user
+
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root, ignore_errors=True)
+        settings_override = override_settings(MEDIA_ROOT=self.media_root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        path = os.path.join(self.media_root, self.name)
+        os.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as f:
+            f.write(self.body)
+        self.url = reverse('protected_media', args=[self.name])
+        self.client.force_login(self.clerk)
+
+    def test_requestor_and_branch_staff_can_read(self):
+        for user in (self.requestor, self.clerk):
+            self.client.force_login(user)
+            response = self.client.get(self.url)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(b''.join(response.streaming_content), self.body)
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+        self.assertEqual(response['Content-Disposition'], "inline; filename*=utf-8''scan%20%C3%BC%201.pdf")
+
+    def test_out_of_scope_is_not_found(self):
+        self.client.force_login(self.outsider)
+        self.assertEqual(self.client.get(self.url).status_code, 404)
+        self.client.force_login(self.clerk)
+        self.assertEqual(self.client.get(reverse('protected_media', args=['payment_proofs/other.pdf'])).status_code, 404)
+
+    def test_anonymous_is_redirected_to_login(self):
+        self.client.logout()
+        self.assertEqual(self.client.get(self.url).status_code, 302)
+
+    def test_range_request(self):
+        response = self.client.get(self.url, HTTP_RANGE='bytes=10-19')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], f'bytes 10-19/{len(self.body)}')
+        self.assertEqual(b''.join(response.streaming_content), self.body[10:20])
+
+        response = self.client.get(self.url, HTTP_RANGE='bytes=-5')
+        self.assertEqual(b''.join(response.streaming_content), self.body[-5:])
+
+    def test_unsatisfiable_range(self):
+        response = self.client.get(self.url, HTTP_RANGE=f'bytes={len(self.body)}-')
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response['Content-Range'], f'bytes */{len(self.body)}')
+
+    def test_stale_if_range_sends_whole_file(self):
+        response = self.client.get(self.url, HTTP_RANGE='bytes=0-4', HTTP_IF_RANGE='"stale"')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), self.body)
+
+    def test_not_modified(self):
+        etag = self.client.get(self.url)['ETag']
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b'')
+
+    def test_only_document_folders_are_protected(self):
+        self.assertEqual(resolve(self.url).url_name, 'protected_media')
+        # Other media (logos, images) falls through to the DEBUG static route or the web server
+        with self.assertRaises(Resolver404):
+            resolve('/media/images/logo.png')
+        with self.assertRaises(Resolver404):
+            resolve('/media/payment_proofs_old/scan.pdf')
+
+    @override_settings(PROTECTED_MEDIA_SENDFILE='x-accel-redirect', PROTECTED_MEDIA_INTERNAL_URL='/protected-media/')
+    def test_x_accel_redirect_is_quoted(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['X-Accel-Redirect'], '/protected-media/payment_proofs/scan%20%C3%BC%201.pdf')
+        self.assertEqual(response.content, b'')
+
+    @override_settings(PROTECTED_MEDIA_SENDFILE='x-sendfile')
+    def test_x_sendfile(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response['X-Sendfile'], os.path.join(self.media_root, self.name))
+        self.assertEqual(response.content, b'')
+
+
+class DedupStorageTests(TestCase):
+
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root, ignore_errors=True)
+        self.storage = DedupStorage(location=media_root)
+
+    def refcount(self, name):
+        return StoredBlob.objects.filter(name=name).values_list('refcount', flat=True).first()
+
+    def test_identical_uploads_share_one_blob(self):
+        first = self.storage.save('payment_proofs/a.PDF', ContentFile(b'same bytes'))
+        second = self.storage.save('payment_proofs/b.pdf', ContentFile(b'same bytes'))
+        other = self.storage.save('payment_proofs/c.pdf', ContentFile(b'other bytes'))
+
+        self.assertEqual(first, second)
+        self.assertNotEqual(first, other)
+        self.assertRegex(first, r'^payment_proofs/[0-9a-f]{2}/[0-9a-f]{64}\.pdf$')
+        self.assertEqual((self.refcount(first), self.refcount(other)), (2, 1))
+        # Only the digest folders remain; no temporary .part files
+        self.assertEqual(sorted(os.listdir(self.storage.path('payment_proofs'))), sorted({first[15:17], other[15:17]}))
+
+    def test_blob_goes_with_the_last_reference(self):
+        name = self.storage.save('payment_proofs/a.pdf', ContentFile(b'same bytes'))
+        self.storage.save('payment_proofs/b.pdf', ContentFile(b'same bytes'))
+        with open(self.storage.path(name + THUMBNAIL_SUFFIX), 'wb') as f:
+            f.write(b'jpeg')
+
+        self.storage.delete(name)
+        self.assertTrue(self.storage.exists(name))
+        self.assertEqual(self.refcount(name), 1)
+
+        self.storage.delete(name)
+        self.assertFalse(self.storage.exists(name))
+        self.assertFalse(self.storage.exists(name + THUMBNAIL_SUFFIX))
+        self.assertIsNone(self.refcount(name))
+
+
+@override_settings(CACHES=TEST_CACHES)
+class StockTestCase(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.device = Device.objects.create(name='RUT240', oem=OEM.objects.create(name='Teltonika'), category='Router')
+        cls.user = User.objects.create_user('clerk', password='pw')
+        # Added newest first, so FIFO order (added_on) differs from id order
+        now = timezone.now()
+        cls.units = []
+        for i in range(5):
+            unit = DeviceIMEI.objects.create(device=cls.device, imei_number=f'UNIT{i}')
+            DeviceIMEI.objects.filter(pk=unit.pk).update(added_on=now - timedelta(days=i))
+            cls.units.append(unit)
+
+    def available(self):
+        return set(DeviceIMEI.objects.filter(is_available=True).values_list('imei_number', flat=True))
+
+
+class AllocateUnitsTests(StockTestCase):
+
+    def test_oldest_units_first(self):
+        units = allocate_units(self.device, 2)
+        self.assertEqual([unit.imei_number for unit in units], ['UNIT4', 'UNIT3'])
+        self.assertEqual(self.available(), {'UNIT0', 'UNIT1', 'UNIT2'})
+
+    def test_strict_short_allocation_takes_nothing(self):
+        with self.assertRaises(AllocationError):
+            allocate_units(self.device, 6)
+        self.assertEqual(len(self.available()), 5)
+
+    def test_lenient_short_allocation_takes_what_is_left(self):
+        allocate_units(self.device, 3)
+        units = allocate_units(self.device.pk, 3, strict=False)
+        self.assertEqual([unit.imei_number for unit in units], ['UNIT1', 'UNIT0'])
+        self.assertEqual(self.available(), set())
+
+
+class ReservationTests(StockTestCase):
+
+    def setUp(self):
+        self.request = DeviceRequest.objects.create(device=self.device, requestor=self.user)
+
+    def test_reserved_units_are_out_of_stock_until_they_lapse(self):
+        held = reserve_units([self.units[0].pk, self.units[1].pk], self.request, self.user)
+        self.assertEqual(held, {self.units[0].pk, self.units[1].pk})
+        self.assertEqual([unit.imei_number for unit in allocate_units(self.device, 5, strict=False)],
+                         ['UNIT4', 'UNIT3', 'UNIT2'])
+
+    def test_units_held_elsewhere_are_not_reserved_again(self):
+        reserve_units([self.units[0].pk], self.request, self.user)
+        other = DeviceRequest.objects.create(device=self.device, requestor=self.user)
+        self.assertEqual(reserve_units([self.units[0].pk, self.units[1].pk], other, self.user), {self.units[1].pk})
+
+    def test_expired_reservations_are_released(self):
+        reserve_units([self.units[0].pk, self.units[1].pk], self.request, self.user)
+        DeviceIMEI.objects.filter(pk=self.units[0].pk).update(reserved_until=timezone.now() - timedelta(minutes=1))
+
+        self.assertEqual(release_expired_reservations(), 1)
+        released = DeviceIMEI.objects.get(pk=self.units[0].pk)
+        self.assertTrue(released.is_available)
+        self.assertIsNone(released.reserved_for)
+        self.assertIsNone(released.reserved_until)
+        self.assertFalse(DeviceIMEI.objects.get(pk=self.units[1].pk).is_available)
+
+    def test_lapsed_hold_can_be_allocated_before_the_sweep(self):
+        reserve_units([self.units[4].pk], self.request, self.user)
+        DeviceIMEI.objects.filter(pk=self.units[4].pk).update(reserved_until=timezone.now() - timedelta(minutes=1))
+        self.assertEqual([unit.imei_number for unit in allocate_units(self.device, 1)], ['UNIT4'])
+        self.assertIsNone(DeviceIMEI.objects.get(pk=self.units[4].pk).reserved_until)
+
+    def test_rejecting_a_request_awaiting_approval_releases_its_units(self):
+        DeviceRequest.objects.filter(pk=self.request.pk).update(status='Waiting Approval')
+        reserve_units([self.units[0].pk, self.units[1].pk], self.request, self.user)
+        DeviceRequestSelectedIMEI.objects.create(device_request=self.request, imei=self.units[0])
+
+        self.assertEqual(reject_open_requests([self.request.pk]), [self.request.pk])
+        self.assertEqual(len(self.available()), 5)
+        self.assertFalse(DeviceIMEI.objects.filter(reserved_for__isnull=False).exists())
+        self.assertEqual(DeviceRequest.objects.get(pk=self.request.pk).status, 'Rejected')
+        self.assertTrue(DeviceRequestSelectedIMEI.objects.get(device_request=self.request).rejected)
+
+    def test_closed_requests_are_not_rejected(self):
+        DeviceRequest.objects.filter(pk=self.request.pk).update(status='Approved')
+        self.assertEqual(reject_open_requests([self.request.pk]), [])
+        self.assertEqual(DeviceRequest.objects.get(pk=self.request.pk).status, 'Approved')
+
+
+class PromiseTests(StockTestCase):
+
+    def committed(self):
+        return Device.objects.get(pk=self.device.pk).committed_quantity
+
+    def test_promises_up_to_available_to_promise(self):
+        promise_units(self.device, 3)
+        promise_units(self.device.pk, 2)
+        self.assertEqual(self.committed(), 5)
+        self.assertEqual(Device.objects.get(pk=self.device.pk).available_to_promise, 0)
+
+    def test_promise_beyond_available_to_promise_is_rejected(self):
+        promise_units(self.device, 4)
+        with self.assertRaises(AllocationError):
+            promise_units(self.device, 2)
+        self.assertEqual(self.committed(), 4)
+
+    def test_held_units_do_not_count_as_promisable(self):
+        request = DeviceRequest.objects.create(device=self.device, requestor=self.user)
+        reserve_units([self.units[0].pk, self.units[1].pk], request, self.user)
+        with self.assertRaises(AllocationError):
+            promise_units(self.device, 4)
+        promise_units(self.device, 3)
+        self.assertEqual(self.committed(), 3)
+
+    def test_released_promise_can_be_made_again(self):
+        promise_units(self.device, 5)
+        request = DeviceRequest.objects.create(device=self.device, requestor=self.user, promised_quantity=5)
+        release_promises([request])
+        self.assertEqual(self.committed(), 0)
+        promise_units(self.device, 5)
+
+    def test_direct_allocation_leaves_promised_stock_alone(self):
+        promise_units(self.device, 4)
+        self.assertEqual([unit.imei_number for unit in allocate_unpromised_units(self.device, 1)], ['UNIT4'])
+        with self.assertRaises(AllocationError):
+            allocate_unpromised_units(self.device, 1)
+        self.assertEqual(len(self.available()), 4)
+
+
+class CatalogTests(StockTestCase):
+
+    def setUp(self):
+        # The cached catalog and data version outlive each test's rolled-back rows
+        cache.clear()
+        self.client.force_login(User.objects.create_superuser('admin', 'a@x.com', 'pw'))
+        self.url = reverse('device_catalog')
+
+    def devices(self, response):
+        return [
+            device
+            for oem in response.json()['oems'] for category in oem['categories'] for device in category['devices']
+        ]
+
+    def test_unchanged_catalog_is_not_modified(self):
+        response = self.client.get(self.url)
+        self.assertEqual(self.devices(response), [{'name': 'RUT240', 'device_id': self.device.pk, 'available': 5}])
+        self.assertEqual(response['Cache-Control'], 'private, no-cache')
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+
+    def test_new_data_version_changes_the_etag(self):
+        etag = self.client.get(self.url)['ETag']
+        with self.captureOnCommitCallbacks(execute=True):
+            promise_units(self.device, 2)
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(self.devices(response)[0]['available'], 3)
+
+    def test_staff_see_their_country_only(self):
+        staff = User.objects.create_user('staff', password='pw')
+        staff.profile.country = Country.objects.create(name='Kenya')
+        staff.profile.save()
+        self.client.force_login(staff)
+        self.assertEqual(self.client.get(self.url).json(), {'oems': []})
+
+
+class IdentifierIndexTests(StockTestCase):
+    """invent.dedupe: keys, the Bloom filter / sorted array pair and top-ups from the database."""
+
+    def test_keys(self):
+        self.assertEqual(identifier_keys(['SN-1'])[0], identifier_keys(['SN-1', 'a much longer serial'])[0])
+        self.assertNotEqual(identifier_keys(['SN-1'])[0], identifier_keys(['sn-1'])[0])
+        imei = field_keys('imei_number', ['35-209900-176148-1', '352099001761481'])
+        mac = field_keys('mac_address', ['aa:bb:cc:dd:ee:ff', 'AABB.CCDD.EEFF'])
+        self.assertEqual((imei[0], mac[0]), (imei[1], mac[1]))
+        self.assertEqual(imei[0], 352099001761481)
+
+    def test_field_index_has_no_false_positives(self):
+        rng = np.random.default_rng(0)
+        present = rng.integers(-2**62, 2**62, size=5000)
+        index = _FieldIndex(present)
+        self.assertTrue(index.contains(present).all())
+        # The Bloom filter lets ~1% through; the sorted array turns those away
+        self.assertFalse(index.contains(rng.integers(-2**62, 2**62, size=20000)).any())
+
+    def test_field_index_grows(self):
+        index = _FieldIndex(np.arange(10, dtype=np.int64))
+        added = np.arange(10, MIN_CAPACITY + 10, dtype=np.int64)
+        index.add(added)
+        self.assertGreater(index.capacity, MIN_CAPACITY)
+        self.assertTrue(index.contains(added).all())
+        self.assertFalse(index.contains(np.array([-1, MIN_CAPACITY + 10], dtype=np.int64)).any())
+
+    def test_refresh_tops_up_from_the_database(self):
+        index = IdentifierIndex().refresh()
+        self.assertEqual(index.contains('imei_number', ['UNIT0', 'UNIT9']).tolist(), [True, False])
+        DeviceIMEI.objects.create(device=self.device, imei_number='UNIT9', mac_address='AA:BB:CC:DD:EE:FF')
+        index.refresh()
+        self.assertEqual(index.contains('imei_number', ['UNIT9']).tolist(), [True])
+        self.assertEqual(index.contains('mac_address', ['aabb.ccdd.eeff']).tolist(), [True])
+
+
+class IssuanceTests(StockTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.client_obj = Client.objects.create(name='ACME', phone_no='1', email='c@x.com', address='y')
+
+    def approved_request(self, quantity, picked=()):
+        """An Approved request with `picked` units selected and the rest of `quantity` left to FIFO."""
+        request = DeviceRequest.objects.create(
+            device=self.device, requestor=self.user, client=self.client_obj, quantity=quantity, status='Approved',
+        )
+        reserve_units([unit.pk for unit in picked], request, self.user)
+        for i in range(quantity):
+            SelectedDevice.objects.create(
+                request=request, device=self.device, selected_by=self.user, imei=picked[i] if i < len(picked) else None,
+            )
+        return request
+
+    def issued_units(self, request):
+        return sorted(
+            IssuanceRecord.objects.filter(device_request=request).values_list('imei_obj__imei_number', flat=True)
+        )
+
+    def test_picked_units_and_fifo_fill(self):
+        request = self.approved_request(2, picked=[self.units[0]])
+        Device.objects.filter(pk=self.device.pk).update(committed_quantity=2)
+        DeviceRequest.objects.filter(pk=request.pk).update(promised_quantity=2)
+
+        self.assertEqual(issue_requests([request.pk], self.user), ([request.pk], {}))
+        self.assertEqual(self.issued_units(request), ['UNIT0', 'UNIT4'])
+        self.assertEqual(self.available(), {'UNIT1', 'UNIT2', 'UNIT3'})
+        self.assertEqual(
+            set(ClientHolding.objects.filter(client=self.client_obj).values_list('imei__imei_number', flat=True)),
+            {'UNIT0', 'UNIT4'},
+        )
+        request.refresh_from_db()
+        self.assertEqual(request.status, 'Issued')
+        self.assertEqual(Device.objects.get(pk=self.device.pk).committed_quantity, 0)
+
+    def test_short_request_takes_nothing(self):
+        first, second = self.approved_request(3), self.approved_request(3)
+        issued, errors = issue_requests([first.pk, second.pk], self.user)
+
+        self.assertEqual((issued, list(errors)), ([first.pk], [second.pk]))
+        self.assertEqual(self.issued_units(first), ['UNIT2', 'UNIT3', 'UNIT4'])
+        self.assertEqual(self.issued_units(second), [])
+        # The units the short request was given back are in stock again
+        self.assertEqual(self.available(), {'UNIT0', 'UNIT1'})
+        self.assertEqual(DeviceRequest.objects.get(pk=second.pk).status, 'Approved')
+
+    def test_picked_unit_taken_elsewhere_blocks_the_request(self):
+        request = self.approved_request(2, picked=[self.units[0]])
+        other = DeviceRequest.objects.create(device=self.device, requestor=self.user)
+        DeviceIMEI.objects.filter(pk=self.units[0].pk).update(reserved_for=other)
+
+        issued, errors = issue_requests([request.pk], self.user)
+        self.assertEqual((issued, list(errors)), ([], [request.pk]))
+        self.assertFalse(IssuanceRecord.objects.exists())
+        self.assertEqual(self.available(), {'UNIT1', 'UNIT2', 'UNIT3', 'UNIT4'})
+
+    def test_approve_selected_requests(self):
+        requests = [
+            DeviceRequest.objects.create(
+                device=self.device, requestor=self.user, client=self.client_obj, quantity=2, status='Waiting Approval',
+            )
+            for _ in range(2)
+        ]
+        for request, units in ((requests[0], self.units[:2]), (requests[1], self.units[2:3])):
+            reserve_units([unit.pk for unit in units], request, self.user)
+            for unit in units:
+                DeviceRequestSelectedIMEI.objects.create(device_request=request, imei=unit)
+
+        approved, errors = approve_selected_requests([request.pk for request in requests], self.user)
+        self.assertEqual((approved, list(errors)), ([requests[0].pk], [requests[1].pk]))
+        self.assertEqual(
+            sorted(IssuanceRecord.objects.values_list('device_request', 'imei__imei_number')),
+            [(requests[0].pk, 'UNIT0'), (requests[0].pk, 'UNIT1')],
+        )
+        self.assertEqual(ClientHolding.objects.filter(client=self.client_obj).count(), 2)
+        self.assertEqual(DeviceRequest.objects.get(pk=requests[0].pk).status, 'Approved')
+        self.assertEqual(DeviceRequest.objects.get(pk=requests[1].pk).status, 'Waiting Approval')
+        self.assertFalse(DeviceRequestSelectedIMEI.objects.filter(device_request=requests[0], approved=False).exists())
+
+    def test_delivery_note_lists_the_issued_units(self):
+        request = self.approved_request(2, picked=[self.units[1]])
+        issue_requests([request.pk], self.user)
+        with mock.patch('invent.issuance.generate_delivery_note') as generate:
+            send_delivery_notes([request.pk])
+        (device_request, rows), _ = generate.call_args
+        self.assertEqual(device_request.pk, request.pk)
+        self.assertEqual(sorted(row[1] for row in rows), ['UNIT1', 'UNIT4'])
+
+
+@override_settings(CACHES=TEST_CACHES)
+class HistoryTestCase(TestCase):
+    """Two requests, 10 and 1 days before `now`, each issued once, and one return."""
+
+    now = timezone.make_aware(datetime(2026, 6, 20, 12, 0))
+
+    @classmethod
+    def setUpTestData(cls):
+        branch = Branch.objects.create(name='Nairobi', address='x', country=Country.objects.create(name='Kenya'))
+        cls.device = Device.objects.create(
+            name='RUT240', oem=OEM.objects.create(name='Teltonika'), category='Router', branch=branch,
+        )
+        for i in range(5):
+            DeviceIMEI.objects.create(device=cls.device, imei_number=f'UNIT{i}')
+        user = User.objects.create_user('clerk', password='pw')
+        client = Client.objects.create(name='ACME', phone_no='1', email='c@x.com', address='y')
+        for quantity, requested, issued in ((2, 10, 8), (4, 1, 0)):
+            request = DeviceRequest.objects.create(device=cls.device, requestor=user, branch=branch, quantity=quantity)
+            DeviceRequest.objects.filter(pk=request.pk).update(date_requested=cls.now - timedelta(days=requested))
+            record = IssuanceRecord.objects.create(device=cls.device, logistics_manager=user, device_request=request)
+            IssuanceRecord.objects.filter(pk=record.pk).update(issued_at=cls.now - timedelta(days=issued))
+        record = ReturnRecord.objects.create(device=cls.device, client=client)
+        ReturnRecord.objects.filter(pk=record.pk).update(returned_at=cls.now - timedelta(days=5))
+
+
+class AnalyticsTests(HistoryTestCase):
+
+    def test_device_metrics(self):
+        row, = compute_device_analytics(now=self.now)['rows']
+        self.assertEqual((row['available'], row['requested'], row['issued'], row['returned']), (5, 6, 2, 1))
+        # 6 units over the two weeks since the first request; 6 units in the 4-week window
+        self.assertEqual(row['demand_per_week'], 3.0)
+        self.assertEqual(row['current_demand_per_week'], 1.5)
+        # Lead times of 2 and 1 days
+        self.assertEqual((row['avg_days_to_issue'], row['median_days_to_issue'], row['p90_days_to_issue']),
+                         (1.5, 1.5, 1.9))
+        self.assertEqual(row['return_rate'], 50.0)
+        self.assertEqual(row['weeks_of_cover'], 3.3)
+
+    def test_branch_roll_up(self):
+        branch, = compute_device_analytics(now=self.now)['branches']
+        self.assertEqual(branch['branch'], 'Nairobi')
+        self.assertEqual((branch['requested'], branch['avg_days_to_issue'], branch['weeks_of_cover']), (6, 1.5, 3.3))
+
+    def test_data_version_changes_on_commit(self):
+        version = get_data_version()
+        with self.captureOnCommitCallbacks(execute=True):
+            bump_data_version()
+            self.assertEqual(get_data_version(), version)
+        self.assertNotEqual(get_data_version(), version)
+
+
+class PivotTests(HistoryTestCase):
+
+    def test_units_per_measure_and_month(self):
+        row_labels, month_labels, matrix = build_pivot(months=2, now=self.now)
+        self.assertEqual(row_labels, [('Nairobi', 'Router', 'Teltonika', 'RUT240')])
+        self.assertEqual(month_labels, ['2026-05', '2026-06'])
+        self.assertEqual(matrix[:, 0].tolist(), [[0, 6], [0, 2], [0, 1]])
+
+    def test_flat_rows(self):
+        rows = list(iter_pivot_rows(*build_pivot(months=2, now=self.now)))
+        self.assertEqual(rows[0][-3:], ['2026-05', '2026-06', 'Total'])
+        self.assertEqual([row[4:] for row in rows[1:]], [['Requested', 0, 6, 6], ['Issued', 0, 2, 2], ['Returned', 0, 1, 1]])
+
+    def test_other_country_is_excluded(self):
+        row_labels, _, matrix = build_pivot(country=Country.objects.create(name='Uganda'), now=self.now)
+        self.assertEqual((row_labels, matrix.sum()), ([], 0))
+
+
+class ValidationTests(SimpleTestCase):
+    """invent.validation: Luhn, normalization and per-row rejection messages."""
+
+    def test_luhn(self):
+        self.assertEqual(luhn_check_digit('49015420323751'), '8')
+        self.assertEqual(list(luhn_valid(['490154203237518', '490154203237519'])), [True, False])
+
+    def test_imeis_are_normalized_or_rejected(self):
+        values = ['490154203237518', ' 49-0154 203237518 ', '490154203237518.0', '4.9E+14',
+                  '49015420323751', '490154203237519', '49015420323751X', '']
+        normalized, reasons = normalize_imeis(values)
+        self.assertEqual(list(normalized[:3]), ['490154203237518'] * 3)
+        self.assertEqual(list(reasons), [0, 0, 0, SCIENTIFIC_NOTATION, WRONG_LENGTH, BAD_CHECK_DIGIT, NOT_NUMERIC, 0])
+
+    def test_macs_are_normalized_or_rejected(self):
+        normalized, reasons = normalize_macs(['aa-bb-cc-dd-ee-ff', 'AABB.CCDD.EEFF', 'GGBBCCDDEEFF', 'AA:BB', ''])
+        self.assertEqual(list(normalized[:2]), ['AA:BB:CC:DD:EE:FF'] * 2)
+        self.assertEqual(list(reasons), [0, 0, NOT_A_MAC, NOT_A_MAC, 0])
+
+    def test_validate_units(self):
+        units, rejected = validate_units(
+            ['490154203237518', '490154203237519', ''],
+            ['Sn-1', 'SN-2', 'sn-3'],
+            ['', '', 'aa:bb:cc:dd:ee:ff'],
+        )
+        self.assertEqual(units, [('490154203237518', 'Sn-1', ''), ('', 'sn-3', 'AA:BB:CC:DD:EE:FF')])
+        self.assertEqual(rejected, [(3, "IMEI '490154203237519' fails the check digit (Luhn)")])
+
+    def test_integer_keys(self):
+        self.assertEqual(imei_to_int(' 49-0154 203237518 '), 490154203237518)
+        self.assertIsNone(imei_to_int('49015420323751'))
+        self.assertEqual(mac_to_int('aa:bb:cc:dd:ee:ff'), 0xAABBCCDDEEFF)
+        for value in ('+aabbccddeef', '-aabbccddeef', 'aa_bbccddeef', '0xaabbccddee', 'aabbccddeefg'):
+            self.assertIsNone(mac_to_int(value), value)
+
+
+class RangeTests(StockTestCase):
+
+    def test_parse_range(self):
+        self.assertEqual(parse_range('SN000100-SN002099'), {'prefix': 'SN', 'start': 100, 'end': 2099, 'width': 6})
+        self.assertEqual(parse_range('AB-7 to AB-12'), {'prefix': 'AB-', 'start': 7, 'end': 12, 'width': 0})
+        # 15-digit IMEI ends lose their check digit
+        self.assertEqual(parse_range('490154203237518-490154203237526', 'imei'),
+                         {'prefix': '', 'start': 49015420323751, 'end': 49015420323752, 'width': 14})
+        for text in ('SN1', 'SN1-XY2', 'SN1-SN', 'SN001-SN10'):
+            with self.assertRaises(ValueError):
+                parse_range(text)
+
+    def test_check_ranges(self):
+        self.assertEqual(check_ranges([parse_range('SN1-SN10'), parse_range('SN20-SN29')], 'serial', True), 20)
+        with self.assertRaises(ValueError):
+            check_ranges([parse_range('SN10-SN1')], 'serial', True)
+        with self.assertRaises(ValueError):
+            check_ranges([parse_range('3501-3509')], 'imei', True)
+
+    def test_expand_ranges(self):
+        self.assertEqual(list(expand_ranges([parse_range('SN08-SN10')], 'serial', True)),
+                         [('', 'SN08', ''), ('', 'SN09', ''), ('', 'SN10', '')])
+        ranges = [parse_range('49015420323751-49015420323752', 'imei')]
+        imeis = [imei for imei, _, _ in expand_ranges(ranges, 'imei', True)]
+        self.assertEqual(imeis, ['490154203237518', '490154203237526'])
+
+    def test_overlapping_ranges_add_each_unit_once(self):
+        DeviceIMEI.objects.create(device=self.device, imei_number='SN3', serial_no='SN3')
+        ranges = [parse_range('SN1-SN4'), parse_range('SN3-SN6')]
+        self.assertEqual(receive_ranges(self.device, ranges, 'serial', True), (5, 3))
+        self.assertEqual(
+            sorted(DeviceIMEI.objects.filter(serial_no__startswith='SN').values_list('serial_no', flat=True)),
+            ['SN1', 'SN2', 'SN3', 'SN4', 'SN5', 'SN6'],
+        )
+
+
+@override_settings(CACHES=TEST_CACHES)
+class ImportAssetsTests(TestCase):
+
+    rows = [
+        'IMEI No,Serial No,OEM,Category,Device',
+        '490154203237518,SN-1,Teltonika,Router,RUT240',
+        ',SN-2,Teltonika,Router,RUT955',
+        '490154203237519,SN-3,Teltonika,Router,RUT240',
+        '490154203237518,SN-4,Teltonika,Router,RUT240',
+        ',SN-5,,,',
+    ]
+
+    def setUp(self):
+        handle, self.path = tempfile.mkstemp(suffix='.csv')
+        with os.fdopen(handle, 'w') as f:
+            f.write('\n'.join(self.rows) + '\n')
+        self.addCleanup(os.remove, self.path)
+
+    def test_dry_run_counts_and_saves_nothing(self):
+        version = get_data_version()
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            stats = import_assets(self.path, dry_run=True)
+        self.assertEqual((stats['rows'], stats['added'], stats['skipped'], stats['rejected']), (5, 2, 1, 2))
+        self.assertEqual(stats['devices_created'], 2)
+        self.assertFalse(Device.objects.exists())
+        self.assertFalse(DeviceIMEI.objects.exists())
+        self.assertEqual(callbacks, [])
+        self.assertEqual(get_data_version(), version)
+
+    def test_import(self):
+        stats = import_assets(self.path)
+        self.assertEqual(stats['added'], 2)
+        self.assertEqual(
+            sorted(DeviceIMEI.objects.values_list('device__name', 'imei_number', 'serial_no')),
+            [('RUT240', '490154203237518', 'SN-1'), ('RUT955', 'SN-2', 'SN-2')],
+        )
+        self.assertEqual([row for row, _ in stats['rejections']], [4, 6])
+
+
+@override_settings(CACHES=TEST_CACHES)
+class ChunkedUploadTests(TestCase):
+    """init -> PUT chunks (resuming after a gap) -> finalize, through the views."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_superuser('admin', 'a@x.com', 'pw')
+
+    def setUp(self):
+        upload_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, upload_dir, ignore_errors=True)
+        settings_override = override_settings(CHUNKED_UPLOAD_DIR=upload_dir)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        chunk_size = mock.patch('invent.uploads.CHUNK_SIZE', 2048)
+        chunk_size.start()
+        self.addCleanup(chunk_size.stop)
+        self.client.force_login(self.user)
+
+        workbook = openpyxl.Workbook()
+        workbook.active.append(['IMEI No', 'Serial No'])
+        for i in range(300):
+            body = f'35{i:012d}'
+            workbook.active.append([body + luhn_check_digit(body), f'SN{i:04d}'])
+        buffer = io.BytesIO()
+        workbook.save(buffer)
+        self.body = buffer.getvalue()
+        self.chunks = [self.body[i:i + 2048] for i in range(0, len(self.body), 2048)]
+
+        response = self.client.post(
+            reverse('upload_inventory_chunked_init'), {'filename': 'units.xlsx', 'size': len(self.body)})
+        self.assertEqual(response.status_code, 201)
+        self.upload_id = response.json()['upload_id']
+
+    def put(self, number, data=None):
+        return self.client.put(
+            reverse('upload_inventory_chunk', args=[self.upload_id, number]),
+            data=self.chunks[number] if data is None else data, content_type='application/octet-stream',
+        )
+
+    def finalize(self):
+        return self.client.post(
+            reverse('upload_inventory_chunked_finalize', args=[self.upload_id]),
+            {'oem': 'Teltonika', 'category': 'Router', 'name': 'RUT240'},
+        )
+
+    def test_resume_and_finalize(self):
+        self.assertGreater(len(self.chunks), 2)
+        for number in range(0, len(self.chunks), 2):
+            self.assertEqual(self.put(number).status_code, 200)
+        received = self.client.get(reverse('upload_inventory_chunk_status', args=[self.upload_id])).json()['received']
+        self.assertEqual(received, list(range(0, len(self.chunks), 2)))
+        self.assertEqual(self.finalize().status_code, 400)
+
+        # Resume: send only what is missing
+        for number in range(1, len(self.chunks), 2):
+            self.put(number)
+        response = self.finalize()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual((response.json()['added'], response.json()['skipped']), (300, 0))
+        self.assertEqual(DeviceIMEI.objects.filter(device__name='RUT240').count(), 300)
+        with self.assertRaises(UploadError):
+            load_upload(self.user, self.upload_id)
+
+    def test_short_chunk_is_refused(self):
+        response = self.put(0, self.chunks[0][:-1])
+        self.assertEqual(response.status_code, 400)
+        status = self.client.get(reverse('upload_inventory_chunk_status', args=[self.upload_id])).json()
+        self.assertEqual(status['received'], [])
+
+    def test_session_belongs_to_its_user(self):
+        other = User.objects.create_superuser('other', 'o@x.com', 'pw')
+        self.client.force_login(other)
+        self.assertEqual(self.put(0).status_code, 400)
 
-# Create your tests here.
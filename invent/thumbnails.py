@@ -0,0 +1,90 @@
+"""
+Preview thumbnails for payment proofs.
+
+A small JPEG is rendered in the background when a proof is uploaded and
+cached beside the blob as `<name>.thumb.jpg`, so approval screens load a few
+KB instead of the full scan. Images are decoded at reduced size (JPEG draft
+mode) and PDFs have their first page rasterized when PyMuPDF or poppler's
+`pdftoppm` is available; otherwise a PDF simply has no thumbnail.
+"""
+import logging
+import os
+import shutil
+import subprocess
+import tempfile
+
+from PIL import Image, ImageOps
+
+from .storage import THUMBNAIL_SUFFIX
+
+try:
+    import fitz  # PyMuPDF
+except ImportError:
+    fitz = None
+
+logger = logging.getLogger(__name__)
+
+THUMBNAIL_SIZE = (320, 320)
+
+
+def thumbnail_name(name):
+    return f"{name}{THUMBNAIL_SUFFIX}"
+
+
+def _pdf_first_page(path):
+    if fitz is not None:
+        with fitz.open(path) as document:
+            pixmap = document[0].get_pixmap(matrix=fitz.Matrix(0.5, 0.5))
+            return Image.frombytes("RGB", (pixmap.width, pixmap.height), pixmap.samples)
+
+    if shutil.which("pdftoppm"):
+        with tempfile.TemporaryDirectory() as workdir:
+            prefix = os.path.join(workdir, "page")
+            subprocess.run(
+                ["pdftoppm", "-f", "1", "-l", "1", "-singlefile", "-jpeg",
+                 "-scale-to", str(max(THUMBNAIL_SIZE)), path, prefix],
+                check=True, timeout=30, capture_output=True,
+            )
+            with Image.open(prefix + ".jpg") as page:
+                return page.copy()
+    return None
+
+
+def _open_image(path):
+    image = Image.open(path)
+    image.draft("RGB", THUMBNAIL_SIZE)  # JPEG: decode at a fraction of full size
+    return ImageOps.exif_transpose(image)
+
+
+def make_thumbnail(name, storage=None):
+    """
+    Render (or reuse) the cached thumbnail of an uploaded proof. Returns the
+    thumbnail's storage name, or None when the file cannot be previewed.
+    """
+    from .models import DeviceOrder
+
+    storage = storage or DeviceOrder._meta.get_field("payment_proof").storage
+    target = thumbnail_name(name)
+    if storage.exists(target):
+        return target
+
+    path = storage.path(name)
+    try:
+        image = _pdf_first_page(path) if name.lower().endswith(".pdf") else _open_image(path)
+        if image is None:
+            return None
+        image.thumbnail(THUMBNAIL_SIZE)
+
+        # Write beside the original, then rename so readers never see a partial file
+        handle, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".part")
+        try:
+            with os.fdopen(handle, "wb") as temp:
+                image.convert("RGB").save(temp, "JPEG", quality=80, optimize=True)
+            os.replace(temp_path, storage.path(target))
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+    except (OSError, ValueError, RuntimeError, subprocess.SubprocessError, Image.DecompressionBombError):
+        logger.warning("Could not render a thumbnail for %s", name, exc_info=True)
+        return None
+    return target
@@ -0,0 +1,159 @@
+"""
+Resumable chunked uploads for large spreadsheets.
+
+The client calls init with the file's name and size, PUTs numbered chunks,
+then finalizes. Each session is a directory under settings.CHUNKED_UPLOAD_DIR
+with meta.json and one file per received chunk. A chunk is written under a
+temporary name and renamed into place, so it is either complete or absent:
+after a dropped connection the client asks which chunks arrived and sends only
+the rest. Finalize concatenates the chunks into one file on disk, which
+ingestion then streams from.
+"""
+import json
+import os
+import re
+import shutil
+import tempfile
+import time
+import uuid
+
+from django.conf import settings
+
+CHUNK_SIZE = 4 * 1024 * 1024
+MAX_UPLOAD_SIZE = 500 * 1024 * 1024
+SESSION_TTL = 24 * 60 * 60
+COPY_BUFFER = 64 * 1024
+
+
+class UploadError(Exception):
+    """The upload session is unknown, not the caller's, or was sent bad data."""
+
+
+def _root():
+    return settings.CHUNKED_UPLOAD_DIR
+
+
+def _session_dir(upload_id):
+    if not re.fullmatch(r'[0-9a-f]{32}', upload_id or ''):
+        raise UploadError("Unknown upload.")
+    return os.path.join(_root(), upload_id)
+
+
+def _chunk_path(meta, number):
+    return os.path.join(_session_dir(meta['upload_id']), f'{number:06d}.chunk')
+
+
+def _assembled_path(meta):
+    # Not the client's file name, which could collide with meta.json
+    return os.path.join(_session_dir(meta['upload_id']), 'assembled' + os.path.splitext(meta['filename'])[1])
+
+
+def start_upload(user, filename, size):
+    """Open a session for a file of `size` bytes and return its status."""
+    try:
+        size = int(size)
+    except (TypeError, ValueError):
+        raise UploadError("File size is required.")
+    if not 0 < size <= MAX_UPLOAD_SIZE:
+        raise UploadError(f"Files must be between 1 byte and {MAX_UPLOAD_SIZE // (1024 * 1024)} MB.")
+
+    purge_stale_uploads()
+    meta = {
+        'upload_id': uuid.uuid4().hex,
+        'user_id': user.pk,
+        'filename': os.path.basename(filename or 'upload'),
+        'size': size,
+        'chunk_size': CHUNK_SIZE,
+        'total_chunks': -(-size // CHUNK_SIZE),
+    }
+    os.makedirs(_session_dir(meta['upload_id']))
+    with open(os.path.join(_session_dir(meta['upload_id']), 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+    return upload_status(meta)
+
+
+def load_upload(user, upload_id):
+    try:
+        with open(os.path.join(_session_dir(upload_id), 'meta.json')) as f:
+            meta = json.load(f)
+    except FileNotFoundError:
+        raise UploadError("Unknown upload.")
+    if meta['user_id'] != user.pk:
+        raise UploadError("Unknown upload.")
+    return meta
+
+
+def upload_status(meta):
+    """Session settings plus the chunk numbers received so far (all of them once assembled)."""
+    assembled = os.path.exists(_assembled_path(meta))
+    return {
+        'upload_id': meta['upload_id'],
+        'chunk_size': meta['chunk_size'],
+        'total_chunks': meta['total_chunks'],
+        'received': [
+            n for n in range(meta['total_chunks']) if assembled or os.path.exists(_chunk_path(meta, n))
+        ],
+    }
+
+
+def write_chunk(meta, number, stream):
+    """Stream chunk `number` from a file-like body to disk; it must be exactly its expected length."""
+    if not 0 <= number < meta['total_chunks']:
+        raise UploadError("Chunk number out of range.")
+    expected = min(meta['chunk_size'], meta['size'] - number * meta['chunk_size'])
+
+    handle, temp_path = tempfile.mkstemp(dir=_session_dir(meta['upload_id']), suffix='.part')
+    try:
+        received = 0
+        with os.fdopen(handle, 'wb') as temp:
+            while received <= expected:
+                piece = stream.read(min(COPY_BUFFER, expected + 1 - received))
+                if not piece:
+                    break
+                temp.write(piece)
+                received += len(piece)
+        if received != expected:
+            raise UploadError(f"Chunk {number} should be {expected} bytes, got {received}.")
+        os.replace(temp_path, _chunk_path(meta, number))
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
+def assemble_upload(meta):
+    """
+    Concatenate every chunk into the final file and return its path. The file
+    is kept until discard_upload, so a finalize that was turned down (e.g. for
+    rejected rows) can be retried without sending the chunks again.
+    """
+    path = _assembled_path(meta)
+    if os.path.exists(path):
+        return path
+    missing = [n for n in range(meta['total_chunks']) if not os.path.exists(_chunk_path(meta, n))]
+    if missing:
+        raise UploadError(f"{len(missing)} chunk(s) still missing, starting at chunk {missing[0]}.")
+
+    with open(path + '.part', 'wb') as out:
+        for n in range(meta['total_chunks']):
+            with open(_chunk_path(meta, n), 'rb') as chunk:
+                shutil.copyfileobj(chunk, out, COPY_BUFFER)
+    os.replace(path + '.part', path)
+    for n in range(meta['total_chunks']):
+        os.remove(_chunk_path(meta, n))
+    return path
+
+
+def discard_upload(meta):
+    shutil.rmtree(_session_dir(meta['upload_id']), ignore_errors=True)
+
+
+def purge_stale_uploads(now=None):
+    """Remove sessions nobody has touched for SESSION_TTL seconds."""
+    if not os.path.isdir(_root()):
+        return
+    cutoff = (now or time.time()) - SESSION_TTL
+    for entry in os.scandir(_root()):
+        if entry.is_dir() and max(
+            (f.stat().st_mtime for f in os.scandir(entry.path)), default=entry.stat().st_mtime
+        ) < cutoff:
+            shutil.rmtree(entry.path, ignore_errors=True)
@@ -1,4 +1,5 @@
-from django.urls import path
+from django.conf import settings
+from django.urls import path, re_path
 from . import views
 
 urlpatterns = [
@@ -9,6 +10,8 @@ urlpatterns = [
     # Requestor Paths
     path('requestor_dashboard', views.requestor_dashboard, name='requestor_dashboard'),
     path('request_device/', views.request_device, name='request_device'),
+    path('request_device/catalog/', views.device_catalog, name='device_catalog'),
+    path('request_device/upload/confirm/', views.confirm_request_upload, name='confirm_request_upload'),
     path('request_summary/', views.request_summary, name='request_summary'),
     path('client_list/', views.client_list, name='client_list'),
     path('requests/<str:status>/', views.request_list, name='request_list'),
@@ -21,6 +24,8 @@ urlpatterns = [
     path('manage_stock/', views.manage_stock, name='manage_stock'),
     path('edit_item/<int:item_id>/', views.edit_item, name='edit_item'),
     path('select_imeis/<int:request_id>/', views.select_imeis, name='select_imeis'),
+    path('select_imeis/<int:request_id>/candidates/', views.select_imei_candidates,
+         name='select_imei_candidates'),
 
 
 
@@ -28,6 +33,15 @@ urlpatterns = [
     path('inventory_list/', views.inventory_list_view, name='inventory_list'),
     path('adjust_stock/', views.adjust_stock, name='adjust_stock'),
     path('upload-inventory/', views.upload_inventory, name='upload_inventory'),
+    path('upload-inventory/batch/', views.upload_inventory_batch, name='upload_inventory_batch'),
+    path('upload-inventory/chunked/', views.upload_inventory_chunked_init, name='upload_inventory_chunked_init'),
+    path('upload-inventory/chunked/<str:upload_id>/', views.upload_inventory_chunk, name='upload_inventory_chunk_status'),
+    path('upload-inventory/chunked/<str:upload_id>/<int:number>/', views.upload_inventory_chunk,
+         name='upload_inventory_chunk'),
+    path('upload-inventory/chunked/<str:upload_id>/finalize/', views.upload_inventory_chunked_finalize,
+         name='upload_inventory_chunked_finalize'),
+    path('receive-range/', views.receive_range, name='receive_range'),
+    path('receive-range/api/', views.receive_range_api, name='receive_range_api'),
 
     # Device Deletion
     path('devices/delete/', views.delete_device,
@@ -40,6 +54,10 @@ urlpatterns = [
 
     # Reports
     path('reports/', views.reports_view, name='reports'),
+    path('reports/analytics/', views.analytics_view, name='analytics'),
+    path('reports/export/analytics/',
+         views.export_analytics, name='export_analytics'),
+    path('reports/export/pivot/', views.export_pivot, name='export_pivot'),
     path('reports/export/inventory-items/',
          views.export_inventory_items, name='export_inventory_items'),
     path('reports/total-requests/', views.total_requests, name='total_requests'),
@@ -64,6 +82,12 @@ urlpatterns = [
     path('issue-approved-devices/', views.issue_approved_devices,
          name='issue_approved_devices'),
 
+    # Client Holdings
+    path('clients/holdings/', views.client_holdings, name='client_holdings_index'),
+    path('clients/<int:client_id>/holdings/', views.client_holdings, name='client_holdings'),
+    path('clients/<int:client_id>/holdings.json', views.client_holdings_json,
+         name='client_holdings_json'),
+
     # Return Processing
     path('returns/', views.list_issued_requests_for_return,
          name='list_issued_requests_for_return'),
@@ -78,4 +102,10 @@ urlpatterns = [
          views.approve_request, name='approve_request'),
     path('reject-request/<int:request_id>/',
          views.reject_request, name='reject_request'),
+
+    # Uploaded documents (payment proofs, PO documents), scope-checked
+    re_path(
+        rf"^{settings.MEDIA_URL.strip('/')}/(?P<name>(?:{'|'.join(settings.PROTECTED_MEDIA_DIRS)})/.+)$",
+        views.protected_media, name='protected_media',
+    ),
 ]
@@ -1,8 +1,10 @@
 from functools import wraps
 from django.shortcuts import redirect
 from django.core.exceptions import PermissionDenied
-import io, os
+import io, os, uuid, logging, threading
 from django.conf import settings
+from django.db import connections, transaction
+from django.core.cache import cache
 from reportlab.pdfgen import canvas
 from reportlab.lib.pagesizes import A4
 from reportlab.lib import colors
@@ -10,11 +12,67 @@ from reportlab.platypus import Table, TableStyle
 from django.core.mail import EmailMessage
 from datetime import datetime
 
-def generate_delivery_note(device_request):
+logger = logging.getLogger(__name__)
+
+def issued_unit_rows(device_request):
+    """(device name, IMEI, serial no) for every unit issued against this request."""
+    from .models import IssuanceRecord
+
+    rows = []
+    for record in (
+        IssuanceRecord.objects
+        .filter(device_request=device_request)
+        .select_related('device', 'imei', 'imei_obj')
+        .order_by('id')
+    ):
+        unit = record.imei or record.imei_obj
+        rows.append([
+            record.device.name,
+            unit.imei_number if unit else "N/A",
+            unit.serial_no if unit and unit.serial_no else "N/A",
+        ])
+    return rows
+
+
+def generate_delivery_note(device_request, rows=None):
     """
     Generate a PDF delivery note with company logo and list all issued devices/IMEIs.
-    Sends the PDF via email to the requestor.
+    Sends the PDF via email to the requestor. `rows` are (device name, IMEI,
+    serial no) for the units issued; by default they are read from the
+    request's issuance records.
     """
+    if rows is None:
+        rows = issued_unit_rows(device_request)
+
+    _send_delivery_note(
+        f"Request #{device_request.id}",
+        f"delivery_note_{device_request.id}.pdf",
+        device_request.client,
+        device_request.branch,
+        device_request.date_issued,
+        rows,
+        device_request.requestor.email,
+    )
+
+
+def generate_order_delivery_note(order, device_requests, rows):
+    """
+    One delivery note for every issued line of an order. `rows` are
+    (device name, IMEI, serial no) for the units issued.
+    """
+    branches = {dr.branch for dr in device_requests}
+    _send_delivery_note(
+        f"Order #{order.id}",
+        f"delivery_note_order_{order.id}.pdf",
+        order.client,
+        branches.pop() if len(branches) == 1 else None,
+        max((dr.date_issued for dr in device_requests if dr.date_issued), default=None),
+        rows,
+        order.requestor.email,
+    )
+
+
+def _send_delivery_note(heading, filename, client, branch, date_issued, rows, recipient):
     buffer = io.BytesIO()
     pdf = canvas.Canvas(buffer, pagesize=A4)
     width, height = A4
@@ -36,59 +94,103 @@ def generate_delivery_note(device_request):
 
     # -------------------- Delivery Note Title -------------------- #
     pdf.setFont("Helvetica-Bold", 16)
-    pdf.drawString(50, height - 110, f"Delivery Note - Request #{device_request.id}")
+    pdf.drawString(50, height - 110, f"Delivery Note - {heading}")
 
     # -------------------- Request Info -------------------- #
     pdf.setFont("Helvetica", 12)
     y = height - 140
-    pdf.drawString(50, y, f"Client: {device_request.client.name if device_request.client else 'N/A'}")
+    pdf.drawString(50, y, f"Client: {client.name if client else 'N/A'}")
     y -= 20
-    pdf.drawString(50, y, f"Branch: {device_request.branch.name if device_request.branch else 'N/A'}")
+    pdf.drawString(50, y, f"Branch: {branch.name if branch else 'N/A'}")
     y -= 20
-    pdf.drawString(50, y, f"Date Issued: {device_request.date_issued.strftime('%Y-%m-%d %H:%M') if device_request.date_issued else datetime.now().strftime('%Y-%m-%d %H:%M')}")
+    pdf.drawString(50, y, f"Date Issued: {date_issued.strftime('%Y-%m-%d %H:%M') if date_issued else datetime.now().strftime('%Y-%m-%d %H:%M')}")
     y -= 30
 
     # -------------------- Devices Table -------------------- #
-    data = [["Device Name", "IMEI", "Serial No"]]
-
-    # List all selected devices for this request
-    for sd in device_request.selected_devices.all():
-        device = sd.device
-        # Pick the assigned IMEI (must be marked unavailable already)
-        imei_obj = device.imeis.filter(is_available=False).first()
-        imei_number = imei_obj.imei_number if imei_obj else "N/A"
-        serial_no = imei_obj.serial_no if imei_obj and imei_obj.serial_no else "N/A"
-        data.append([device.name, imei_number, serial_no])
-
-    table = Table(data, colWidths=[200, 150, 150])
-    table.setStyle(TableStyle([
-        ("BACKGROUND", (0,0), (-1,0), colors.lightgrey),
-        ("TEXTCOLOR", (0,0), (-1,0), colors.black),
-        ("ALIGN", (0,0), (-1,-1), "LEFT"),
-        ("GRID", (0,0), (-1,-1), 0.5, colors.black),
-        ("FONTNAME", (0,0), (-1,0), "Helvetica-Bold"),
-    ]))
-
-    # Draw table
-    table.wrapOn(pdf, width, height)
-    table.drawOn(pdf, 50, y - (20 * len(data)))
+    # Long orders continue on further pages, repeating the header row
+    header = ["Device Name", "IMEI", "Serial No"]
+    rows = list(rows)
+    while True:
+        per_page = max(int((y - 50) // 20) - 1, 1)
+        chunk, rows = rows[:per_page], rows[per_page:]
+        data = [header] + chunk
+
+        table = Table(data, colWidths=[200, 150, 150])
+        table.setStyle(TableStyle([
+            ("BACKGROUND", (0,0), (-1,0), colors.lightgrey),
+            ("TEXTCOLOR", (0,0), (-1,0), colors.black),
+            ("ALIGN", (0,0), (-1,-1), "LEFT"),
+            ("GRID", (0,0), (-1,-1), 0.5, colors.black),
+            ("FONTNAME", (0,0), (-1,0), "Helvetica-Bold"),
+        ]))
+
+        # Draw table
+        table.wrapOn(pdf, width, height)
+        table.drawOn(pdf, 50, y - (20 * len(data)))
+        pdf.showPage()
+        if not rows:
+            break
+        y = height - 50
 
     # -------------------- Finalize PDF -------------------- #
-    pdf.showPage()
     pdf.save()
     buffer.seek(0)
 
     # -------------------- Send PDF via Email -------------------- #
     email = EmailMessage(
-        subject=f"Delivery Note - Request #{device_request.id}",
+        subject=f"Delivery Note - {heading}",
         body="Please find attached your delivery note.",
         from_email=None,
-        to=[device_request.requestor.email],
+        to=[recipient],
     )
-    email.attach(f"delivery_note_{device_request.id}.pdf", buffer.read(), "application/pdf")
+    email.attach(filename, buffer.read(), "application/pdf")
     email.send(fail_silently=False)
 
 
+# -------------------- Background Work -------------------- #
+def run_after_commit(func, *args, **kwargs):
+    """
+    Run func(*args, **kwargs) in a background thread once the current
+    transaction commits, so slow work (PDFs, mail) never holds up the request.
+    """
+    def _run():
+        try:
+            func(*args, **kwargs)
+        except Exception:
+            logger.exception("Background task %s failed", getattr(func, "__name__", func))
+        finally:
+            connections.close_all()
+
+    transaction.on_commit(lambda: threading.Thread(target=_run, daemon=True).start())
+
+
+# -------------------- Data Version -------------------- #
+# A token replaced whenever inventory/request history changes.
+# Cached reports embed it in their cache keys, so a new token invalidates them all.
+DATA_VERSION_KEY = "invent:data_version"
+
+
+def get_data_version():
+    version = cache.get(DATA_VERSION_KEY)
+    if version is None:
+        cache.add(DATA_VERSION_KEY, uuid.uuid4().hex, timeout=None)
+        version = cache.get(DATA_VERSION_KEY)
+    return version
+
+
+def bump_data_version():
+    """
+    Replace the data version once the current transaction commits.
+
+    A fresh random token is set rather than the counter incremented: incr is
+    a read-modify-write on the file and database caches, while set is atomic
+    on every backend, and any unused token invalidates the old keys no matter
+    which concurrent bump lands last. Waiting for the commit keeps a report
+    computed from the pre-commit rows from being cached under the new token.
+    """
+    transaction.on_commit(lambda: cache.set(DATA_VERSION_KEY, uuid.uuid4().hex, timeout=None))
+
+
 def is_branch_admin(user):
     """
     Returns True if user is superuser OR belongs to 'Branch Admin' group.
@@ -1,11 +1,13 @@
 import csv
+import itertools
+import json
 from django.utils.dateparse import parse_date
 from .forms import (
     CustomCreationForm, OEMForm, DeviceForm, DeviceRequestForm, ClientForm
 )
 from .models import (
     Device, OEM, DeviceRequest, Client, IssuanceRecord, ReturnRecord, Branch, Profile, DeviceSelection, DeviceIMEI,
-    SelectedDevice
+    SelectedDevice, ClientHolding, DeviceOrder, available_unit_q, identifier_search_q, imei_prefix_q
 )
 from django.contrib.auth.models import User
 from django.shortcuts import render, redirect, get_object_or_404
@@ -13,13 +15,20 @@ from django.contrib.auth.forms import AuthenticationForm
 from django.contrib.auth import login, logout
 from django.contrib.auth.decorators import login_required, permission_required
 from django.contrib import messages
-from django.db.models import Q, F, Count, Sum, Value, IntegerField
+from django.db.models import Q, F, Count, Sum, Value, IntegerField, Prefetch
 from django.db import transaction
 from django.core.mail import send_mail
-from django.http import HttpResponse, JsonResponse
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse, FileResponse, Http404
+from django.conf import settings
+from django.core.exceptions import PermissionDenied
+from django.utils.http import content_disposition_header, http_date, quote_etag
+import mimetypes
+import os
+import posixpath
+from urllib.parse import quote
 from django.urls import reverse
 from django.core.paginator import Paginator
-from django.views.decorators.http import require_POST
+from django.views.decorators.http import require_POST, condition
 from collections import defaultdict
 import openpyxl
 from openpyxl import Workbook
@@ -33,7 +42,23 @@ from .models import DeviceSelectionGroup  # add import at top
 logger = logging.getLogger(__name__)
 from django.template.loader import render_to_string
 import tempfile
-from invent.utils import generate_delivery_note
+from .analytics import get_device_analytics, build_pivot, iter_pivot_rows
+from .issuance import record_issuances, record_return, units_held_for_request, issue_requests
+from .intake import resolve_lines, create_requests, read_request_lines, resolve_upload, MAX_UPLOAD_LINES
+from .stock import (
+    allocate_units, allocate_unpromised_units, AllocationError, select_units, release_reservations,
+    get_catalog, catalog_etag
+)
+from .storage import THUMBNAIL_SUFFIX
+from .thumbnails import make_thumbnail
+from .receiving import (
+    check_ranges, ingest_units, invalid_range_imeis, parse_range, receive_ranges, receiving_device, receive_workbooks,
+)
+from .sheets import cell_text, parse_unit_sheet
+from .validation import NOT_NUMERIC, REASONS, normalize_imeis
+from .uploads import (
+    CHUNK_SIZE, UploadError, start_upload, load_upload, upload_status, write_chunk, assemble_upload, discard_upload
+)
 
 
 def custom_login(request):
@@ -64,7 +89,7 @@ def logout_view(request):
 @login_required
 def requestor_dashboard(request):
     user_requests = DeviceRequest.objects.filter(
-        requestor=request.user).order_by('-id') # Order by -id for most recent first
+        requestor=request.user).select_related('device').order_by('-id') # Order by -id for most recent first
     
     # Labeling logic (as-is, but using negative index for reverse numbering)
     labeled_requests = list(user_requests) # Convert to list to iterate twice
@@ -142,23 +167,29 @@ def request_device(request):
             names = devices_qs.values_list("name", flat=True).distinct()
             return JsonResponse({"device_names": list(names)})
 
-        # 4️⃣ Return available quantity
-        device = devices_qs.filter(name=device_name).first()
+        # 4️⃣ Return available-to-promise (in stock minus units promised to open requests)
+        device = (
+            devices_qs.filter(name=device_name)
+            .annotate(in_stock=Count('imeis', filter=available_unit_q('imeis__')))
+            .first()
+        )
         if not device:
             return JsonResponse({"available_quantity": 0})
 
-        imei_qs = DeviceIMEI.objects.filter(device=device, is_available=True)
-        if not user.is_superuser:
-            user_country = getattr(user.profile, "country", None)
-            if user_country:
-                imei_qs = imei_qs.filter(device__branch__country=user_country)
-
-        return JsonResponse({"available_quantity": imei_qs.count()})
+        return JsonResponse({
+            "available_quantity": max(device.in_stock - device.committed_quantity, 0),
+            "in_stock": device.in_stock,
+            "committed": device.committed_quantity,
+        })
 
     # =====================================================
     # POST — Multiple Device Request Submission
     # =====================================================
     if request.method == "POST":
+        # Spreadsheet of lines: validate and show a preview before anything is written
+        if "lines_file" in request.FILES:
+            return _preview_request_upload(request)
+
         client_id = request.POST.get("client_id")
         proof_file = request.FILES.get("payment_proof")
 
@@ -183,101 +214,121 @@ def request_device(request):
             messages.error(request, "Incomplete device request.")
             return redirect("request_device")
 
-        try:
-            with transaction.atomic():
-                for i in range(len(oems)):
-                    oem_id = oems[i]
-                    category_name = categories[i]
-                    device_name = devices[i]
-                    qty = int(quantities[i])
-
-                    if qty < 1:
-                        messages.error(request, "Quantity must be at least 1.")
-                        return redirect("request_device")
-
-                    # Fetch device
-                    device = Device.objects.filter(
-                        oem_id=oem_id,
-                        category=category_name,
-                        name=device_name
-                    ).first()
-
-                    if not device:
-                        messages.error(request, f"Device '{device_name}' not found.")
-                        return redirect("request_device")
-
-                    # Enforce max quantity using available IMEIs
-                    imei_qs = DeviceIMEI.objects.filter(device=device, is_available=True)
-                    if not user.is_superuser:
-                        user_country = getattr(user.profile, "country", None)
-                        if user_country:
-                            imei_qs = imei_qs.filter(device__branch__country=user_country)
-
-                    available_qty = imei_qs.count()
-                    if qty > available_qty:
-                        messages.error(
-                            request,
-                            f"Only {available_qty} units of {device.name} are available."
-                        )
-                        return redirect("request_device")
-
-                    # --- Create DeviceRequest ---
-                    dr = DeviceRequest.objects.create(
-                        requestor=user,
-                        client=client,
-                        device=device,
-                        quantity=qty,
-                        branch=device.branch,
-                        country=device.branch.country,
-                        payment_proof=proof_file,
-                        status="Pending"
-                    )
+        # Validate every line at once: one device lookup with grouped availability
+        resolved, errors = resolve_lines(
+            list(itertools.zip_longest(oems, categories, devices, quantities)),
+            country=_catalog_country(user),
+        )
+        if errors:
+            for number, error in errors:
+                messages.error(request, f"Line {number}: {error}")
+            return redirect("request_device")
 
-                    # --- Create a DeviceSelectionGroup for the clerks ---
-                    selection_group = DeviceSelectionGroup.objects.create(
-                        device_request=dr,
-                        store_clerk=None,  # To be assigned later
-                        status="Pending"
-                    )
-                    selection_group.devices.set([device])  # Attach the device
-
-                    # Notify Store Clerks to select IMEIs
-                    clerks = User.objects.filter(groups__name="Store Clerk")
-                    clerk_emails = [u.email for u in clerks if u.email]
-                    if clerk_emails:
-                        send_mail(
-                            subject=f"New Device Request #{dr.id}",
-                            message=(
-                                f"Hello Store Clerk,\n\n"
-                                f"A new device request has been submitted.\n"
-                                f"Request ID: {dr.id}\n"
-                                f"Requestor: {user.username}\n"
-                                f"Client: {client.name}\n"
-                                f"Device: {device.name}\n"
-                                f"Quantity: {qty}\n\n"
-                                f"Please log in to select IMEIs for this request."
-                            ),
-                            from_email=None,
-                            recipient_list=clerk_emails,
-                            fail_silently=False,
-                        )
-
-            messages.success(request, "Device request submitted successfully.")
-            return redirect("requestor_dashboard")
-
-        except Exception as e:
-            messages.error(request, f"Error occurred: {str(e)}")
+        try:
+            order = create_requests(user, client, resolved, payment_proof=proof_file)
+        except AllocationError as e:
+            messages.error(request, str(e))
             return redirect("request_device")
 
+        messages.success(request, f"Order #{order.id} submitted successfully.")
+        return redirect("requestor_dashboard")
+
     # =====================================================
-    # GET — Load Form
+    # GET — Load Form (options come from device_catalog)
     # =====================================================
     return render(request, "invent/request_item.html", {
         "clients": Client.objects.all(),
-        "oems": OEM.objects.all(),
     })
 
 
+REQUEST_UPLOAD_SESSION_KEY = "invent:request_upload"
+
+
+def _preview_request_upload(request):
+    """Validate an uploaded sheet of request lines and show every line with its problems."""
+    client = Client.objects.filter(id=request.POST.get("client_id")).first()
+    if not client:
+        messages.error(request, "Please select a client.")
+        return redirect("request_device")
+
+    try:
+        rows = list(itertools.islice(read_request_lines(request.FILES["lines_file"]), MAX_UPLOAD_LINES + 1))
+        lines, resolved, errors = resolve_upload(rows, country=_catalog_country(request.user))
+    except Exception as e:
+        messages.error(request, f"Error reading upload: {e}")
+        return redirect("request_device")
+
+    if not rows:
+        messages.error(request, "The upload has no request lines.")
+        return redirect("request_device")
+
+    devices = {number: device for number, device, _ in resolved}
+    line_errors = defaultdict(list)
+    for number, error in errors:
+        line_errors[number].append(error)
+    preview = [
+        {"number": number, "cells": cells, "device": devices.get(number), "errors": line_errors.get(number, [])}
+        for number, cells in enumerate(rows, start=1)
+    ]
+
+    # Confirming re-validates these lines against current stock, then creates them in one batch
+    if not errors:
+        request.session[REQUEST_UPLOAD_SESSION_KEY] = {"client_id": client.id, "lines": lines}
+
+    return render(request, "invent/request_upload_preview.html", {
+        "client": client,
+        "preview": preview,
+        "error_count": len(line_errors),
+        "total_quantity": sum(qty for _, _, qty in resolved),
+    })
+
+
+@login_required
+@require_POST
+def confirm_request_upload(request):
+    upload = request.session.pop(REQUEST_UPLOAD_SESSION_KEY, None)
+    if not upload:
+        messages.error(request, "Nothing to submit; please upload the sheet again.")
+        return redirect("request_device")
+
+    client = get_object_or_404(Client, id=upload["client_id"])
+    resolved, errors = resolve_lines(upload["lines"], country=_catalog_country(request.user))
+    if errors:
+        for number, error in errors:
+            messages.error(request, f"Line {number}: {error}")
+        return redirect("request_device")
+
+    try:
+        order = create_requests(
+            request.user, client, resolved, payment_proof=request.FILES.get("payment_proof")
+        )
+    except AllocationError as e:
+        messages.error(request, str(e))
+        return redirect("request_device")
+
+    messages.success(request, f"Order #{order.id} submitted with {len(resolved)} line(s).")
+    return redirect("requestor_dashboard")
+
+
+def _catalog_country(user):
+    if user.is_superuser:
+        return None
+    return getattr(user.profile, "country", None)
+
+
+@login_required
+@condition(etag_func=lambda request: catalog_etag(_catalog_country(request.user)))
+def device_catalog(request):
+    """
+    Whole OEM → category → device tree with available-to-promise quantities
+    for the user's country, so the request form needs a single fetch.
+    Revalidated with ETag; unchanged data answers 304.
+    """
+    response = JsonResponse({"oems": get_catalog(_catalog_country(request.user))})
+    response["Cache-Control"] = "private, no-cache"
+    return response
+
+
 
 # --- Cancel Request ---
 
@@ -290,6 +341,7 @@ def cancel_request(request, request_id):
         if request.method == 'POST':
             device_request.status = 'Cancelled'
             device_request.save()
+            release_reservations([device_request])
             messages.success(
                 request, f"Request for '{device_request.device.name}' (ID: {request_id}) has been cancelled.")
             return redirect('requestor_dashboard')
@@ -317,14 +369,10 @@ def store_clerk_dashboard(request):
     if user.is_superuser:
         requests_qs = DeviceRequest.objects.all()
         devices_qs = Device.objects.all()
-        issuance_qs = IssuanceRecord.objects.all()
     else:
         user_country = getattr(user.profile, "country", None)
         requests_qs = DeviceRequest.objects.filter(branch__country=user_country)
         devices_qs = Device.objects.filter(branch__country=user_country)
-        issuance_qs = IssuanceRecord.objects.filter(
-            device__branch__country=user_country
-        )
 
     # =========================
     # REQUEST LISTS
@@ -350,26 +398,14 @@ def store_clerk_dashboard(request):
     # =========================
     # RECENT ISSUANCES
     # =========================
-    recent_issuances = (
-        issuance_qs
-        .select_related('device', 'client')
-        .order_by('-issued_at')[:10]
+    # Device.current_client / issued_at hold the latest issuance still out
+    recent_devices = (
+        devices_qs
+        .filter(issued_at__isnull=False)
+        .select_related('current_client')
+        .order_by('-issued_at')[:5]
     )
 
-    # Deduplicate devices (latest issuance per device)
-    seen = set()
-    recent_devices = []
-
-    for record in recent_issuances:
-        if record.device.id not in seen:
-            record.device.current_client = record.client
-            record.device.issued_at = record.issued_at
-            recent_devices.append(record.device)
-            seen.add(record.device.id)
-
-        if len(recent_devices) >= 5:
-            break
-
     # =========================
     # CONTEXT
     # =========================
@@ -466,6 +502,7 @@ def reject_request(request, request_id):
     device_request = get_object_or_404(DeviceRequest, id=request_id)
     device_request.status = "Rejected"
     device_request.save()
+    release_reservations([device_request])
     messages.warning(request, f"Request {device_request.id} rejected.")
     return redirect("store_clerk_dashboard")
 
@@ -485,10 +522,10 @@ def inventory_list_view(request):
     # Base queryset
     # =========================
     if user.is_superuser:
-        devices = Device.objects.select_related('oem', 'branch')
+        devices = Device.objects.select_related('oem', 'branch', 'current_client')
     else:
         user_country = getattr(user.profile, "country", None)
-        devices = Device.objects.select_related('oem', 'branch').filter(
+        devices = Device.objects.select_related('oem', 'branch', 'current_client').filter(
             branch__country=user_country
         )
 
@@ -499,7 +536,7 @@ def inventory_list_view(request):
         total_units=Count('imeis', distinct=True),
         available_units=Count(
             'imeis',
-            filter=Q(imeis__is_available=True),
+            filter=available_unit_q('imeis__'),
             distinct=True
         )
     )
@@ -516,13 +553,16 @@ def inventory_list_view(request):
     # Search (FIXED)
     # =========================
     if query:
-        devices = devices.filter(
+        # A full IMEI / MAC address is an indexed key lookup instead of a substring scan
+        devices = devices.filter(identifier_search_q(
+            query,
             Q(name__icontains=query) |
             Q(category__icontains=query) |
             Q(oem__name__icontains=query) |
             Q(imeis__imei_number__icontains=query) |
-            Q(imeis__serial_no__icontains=query)
-        ).distinct()
+            Q(imeis__serial_no__icontains=query),
+            'imeis__',
+        )).distinct()
 
     devices = devices.order_by('category', 'oem__name', 'id')
 
@@ -643,7 +683,6 @@ from django.contrib import messages
 from django.contrib.auth.decorators import login_required, permission_required
 from django.db import transaction
 from invent.models import Device, DeviceRequest, Client, IssuanceRecord
-from invent.utils import generate_delivery_note  # Utility handles PDF/email with logo
 
 @login_required
 @permission_required('invent.can_issue_item', raise_exception=True)
@@ -661,7 +700,12 @@ def issue_device(request):
     clients = Client.objects.all()
     pending_requests = DeviceRequest.objects.filter(status='Pending').select_related('device', 'client', 'requestor')
     waiting_requests = DeviceRequest.objects.filter(status='Waiting Approval').select_related('device', 'client', 'requestor')
-    approved_requests = DeviceRequest.objects.filter(status='Approved').select_related('device', 'client', 'requestor')
+    approved_requests = (
+        DeviceRequest.objects.filter(status='Approved')
+        .select_related('device', 'client', 'requestor')
+        .prefetch_related('selected_devices__imei')
+        .order_by('order_id', 'id')
+    )
     all_requests = DeviceRequest.objects.all().select_related('device', 'client', 'requestor')
 
     # -------------------- Handle POST Actions -------------------- #
@@ -680,29 +724,31 @@ def issue_device(request):
             device = get_object_or_404(Device, id=device_id, status='available')
             client = get_object_or_404(Client, id=client_id)
 
-            with transaction.atomic():
-                # Pick first available IMEI for this device
-                imei_obj = device.imeis.filter(is_available=True).first()
-                if imei_obj:
-                    imei_obj.mark_unavailable()
+            try:
+                with transaction.atomic():
+                    # Oldest available unit, as long as it is not promised to an open request
+                    imei_obj = allocate_unpromised_units(device, 1)[0]
 
-                # Mark device as issued
-                device.status = 'issued'
-                device.save()
-
-                # Create issuance record
-                IssuanceRecord.objects.create(
-                    device=device,
-                    client=client,
-                    logistics_manager=user,
-                    device_request=None,
-                    imei_obj=imei_obj
-                )
+                    # Mark device as issued
+                    device.status = 'issued'
+                    device.save()
 
-            # Generate delivery note (with logo)
-            generate_delivery_note(device, client, imei_obj)
+                    # Create issuance record
+                    record = IssuanceRecord.objects.create(
+                        device=device,
+                        client=client,
+                        logistics_manager=user,
+                        device_request=None,
+                        imei_obj=imei_obj
+                    )
+                    record_issuances([record])
+            except AllocationError as e:
+                messages.error(request, f"{device.name} could not be issued: {e}")
+                return redirect('issue_device')
+
+            # Delivery notes are generated per request; a direct issue has none
 
-            messages.success(request, f"Device {device.name} (IMEI: {imei_obj.imei_number if imei_obj else 'N/A'}) issued to {client.name}.")
+            messages.success(request, f"Device {device.name} (IMEI: {imei_obj.imei_number}) issued to {client.name}.")
             return redirect('issue_device')
 
         # ---------------- Issue Approved Request ---------------- #
@@ -710,45 +756,69 @@ def issue_device(request):
             request_id = request.POST.get('device_request_id')
             device_request = get_object_or_404(DeviceRequest, id=request_id, status='Approved')
 
-            selected_devices = device_request.selected_devices.all()
-            if not selected_devices.exists():
-                messages.error(request, "No selected devices found for this request.")
+            # Same path as bulk issue: picked units confirmed, the rest filled FIFO, records bulk-created
+            try:
+                issued, errors = issue_requests([device_request.id], user)
+            except AllocationError as e:
+                messages.error(request, f"Request #{device_request.id} could not be issued: {e}")
                 return redirect('issue_device')
 
-            with transaction.atomic():
-                for sd in selected_devices:
-                    device = sd.device
+            if not issued:
+                messages.error(
+                    request, f"Request #{device_request.id} could not be issued: {errors.get(device_request.id)}"
+                )
+                return redirect('issue_device')
 
-                    # Pick first available IMEI for this device
-                    imei_obj = device.imeis.filter(is_available=True).first()
-                    if not imei_obj:
-                        messages.warning(request, f"No available IMEIs for device {device.name}. Skipped.")
-                        continue
+            messages.success(
+                request, f"Devices for Request #{device_request.id} issued successfully. The delivery note is being sent."
+            )
+            return redirect('issue_device')
 
-                    # Mark IMEI as unavailable
-                    imei_obj.mark_unavailable()
+        # ---------------- Bulk Issue Approved Requests ---------------- #
+        elif action == 'bulk_issue':
+            request_ids = [pk for pk in request.POST.getlist('device_request_ids') if pk.isdigit()]
+            if not request_ids:
+                messages.error(request, "Select at least one approved request to issue.")
+                return redirect('issue_device')
 
-                    # Mark device as issued
-                    device.status = 'issued'
-                    device.save()
+            try:
+                issued, errors = issue_requests(request_ids, user)
+            except AllocationError as e:
+                messages.error(request, str(e))
+                return redirect('issue_device')
 
-                    # Create issuance record
-                    IssuanceRecord.objects.create(
-                        device=device,
-                        client=device_request.client,
-                        logistics_manager=user,
-                        device_request=device_request,
-                        imei_obj=imei_obj
-                    )
+            if issued:
+                messages.success(
+                    request,
+                    f"{len(issued)} request(s) issued. Delivery notes are being sent."
+                )
+            for pk, error in sorted(errors.items()):
+                messages.error(request, f"Request #{pk}: {error}")
+            return redirect('issue_device')
 
-                # Update request status
-                device_request.status = 'Issued'
-                device_request.save()
+        # ---------------- Issue Every Approved Line of an Order ---------------- #
+        elif action == 'issue_order':
+            order_id = request.POST.get('order_id')
+            line_ids = list(
+                DeviceRequest.objects.filter(order_id=order_id, status='Approved').values_list('id', flat=True)
+            )
+            if not line_ids:
+                messages.error(request, "This order has no approved lines to issue.")
+                return redirect('issue_device')
 
-            # Generate delivery note with company logo
-            generate_delivery_note(device_request)
+            try:
+                issued, errors = issue_requests(line_ids, user)
+            except AllocationError as e:
+                messages.error(request, str(e))
+                return redirect('issue_device')
 
-            messages.success(request, f"Devices for Request #{device_request.id} issued successfully.")
+            if issued:
+                messages.success(
+                    request,
+                    f"Order #{order_id}: {len(issued)} line(s) issued. The delivery note is being sent."
+                )
+            for pk, error in sorted(errors.items()):
+                messages.error(request, f"Request #{pk}: {error}")
             return redirect('issue_device')
 
         # ---------------- Invalid action ---------------- #
@@ -774,163 +844,185 @@ def issue_device(request):
 from django.contrib.auth.models import User
 from django.core.mail import send_mail
 
+def _excel_first_column(excel_file):
+    """
+    First-column values below the header row, streamed in read-only mode and
+    normalized as IMEIs (see invent.validation). Returns (values, rejected
+    [(row, message)]). Non-numeric values pass through as typed, since a
+    serial-only unit is identified by its serial number.
+    """
+    wb = openpyxl.load_workbook(excel_file, read_only=True, data_only=True)
+    try:
+        numbered = []
+        for row_number, (value,) in enumerate(wb.active.iter_rows(min_row=2, max_col=1, values_only=True), start=2):
+            value = cell_text(value)  # long IMEIs typed into Excel come back as floats
+            if value:
+                numbered.append((row_number, value))
+    finally:
+        wb.close()
+    if not numbered:
+        return [], []
+
+    row_numbers, raw = zip(*numbered)
+    imeis, reasons = normalize_imeis(raw)
+    values, rejected = [], []
+    for row_number, original, imei, reason in zip(row_numbers, raw, imeis.tolist(), reasons.tolist()):
+        if reason == NOT_NUMERIC:
+            values.append(original)
+        elif reason:
+            rejected.append((row_number, f"IMEI '{original}' {REASONS[reason]}"))
+        else:
+            values.append(imei)
+    return values, rejected
+
+
+def _report_selection(request, device_request, result):
+    """Tell the clerk what select_units did, including every input it could not use."""
+    def sample(values):
+        shown = ", ".join(str(v) for v in values[:10])
+        return shown + (f" and {len(values) - 10} more" if len(values) > 10 else "")
+
+    if result['selected']:
+        messages.success(
+            request, f"{result['selected']} IMEI(s) submitted for Request #{device_request.id}.")
+        if result['selected'] > device_request.quantity:
+            messages.warning(
+                request,
+                f"You selected {result['selected']} IMEIs but the request asked for {device_request.quantity}."
+            )
+    else:
+        messages.error(request, "No valid IMEIs found or all are already assigned.")
+
+    if result['unmatched']:
+        messages.warning(request, f"Not found for this device: {sample(result['unmatched'])}.")
+    if result['duplicates']:
+        messages.warning(request, f"Listed more than once: {sample(result['duplicates'])}.")
+    if result['taken']:
+        messages.warning(request, f"Already taken or on hold: {sample(result['taken'])}.")
+
+
 @login_required
 @permission_required('invent.can_issue_item', raise_exception=True)
 def select_imeis(request, request_id):
     device_request = get_object_or_404(DeviceRequest, id=request_id)
-    requested_device = device_request.device
     user = request.user
 
-    query = request.GET.get("q", "").strip()
-
-    available_imeis = DeviceIMEI.objects.filter(
-        device__name=requested_device.name,
-        device__oem=requested_device.oem,
-        is_available=True,
-    ).select_related('device')
-
-    if query:
-        available_imeis = available_imeis.filter(
-            Q(imei_number__icontains=query) |
-            Q(device__imei_no__icontains=query) |
-            Q(device__serial_no__icontains=query) |
-            Q(device__name__icontains=query)
-        )
-
-    available_count = available_imeis.count()
-
     if request.method == 'POST':
-        created = 0
-
         # --- Handle Excel Upload ---
         if 'upload_file' in request.FILES:
-            excel_file = request.FILES['upload_file']
             try:
-                wb = openpyxl.load_workbook(excel_file)
-                sheet = wb.active
-                for row in sheet.iter_rows(min_row=2, values_only=True):
-                    imei_number = str(row[0]).strip()
-                    try:
-                        imei_obj = DeviceIMEI.objects.get(
-                            imei_number=imei_number,
-                            device__name=requested_device.name,
-                            device__oem=requested_device.oem,
-                            is_available=True
-                        )
-                        SelectedDevice.objects.create(
-                           imei=imei_obj,
-                           device=imei_obj.device,  
-                           request=device_request,
-                           selected_by=request.user 
-                        )
-                        imei_obj.is_available = False
-                        imei_obj.save(update_fields=['is_available'])
-                        created += 1
-                    except DeviceIMEI.DoesNotExist:
-                        continue
-
-                if created == 0:
-                    messages.warning(
-                        request, "No valid IMEIs found in the Excel file or all are already assigned.")
-                else:
-                    messages.success(
-                        request, f"{created} IMEI(s) submitted via Excel for Request #{device_request.id}.")
-
-                # Update status
-                device_request.status = 'Waiting Approval'
-                device_request.save(update_fields=['status'])
-
-                # ====== Notify Admins ======
-                admins = User.objects.filter(is_superuser=True)
-                admin_emails = [a.email for a in admins if a.email]
-                if admin_emails:
-                    subject = f"Device Request #{device_request.id} Pending Approval"
-                    message = (
-                        f"Hello Admin,\n\n"
-                        f"The store clerk {user.username} has submitted IMEIs for the following request:\n"
-                        f"Device: {device_request.device.name}\n"
-                        f"Quantity: {device_request.quantity}\n"
-                        f"Requestor: {device_request.requestor.username}\n"
-                        f"Client: {device_request.client.name if device_request.client else 'N/A'}\n\n"
-                        f"Please review and approve or reject the request."
-                    )
-                    send_mail(subject, message, from_email=None, recipient_list=admin_emails, fail_silently=False)
-
-                return redirect('issue_device')
-
+                imei_numbers, rejected = _excel_first_column(request.FILES['upload_file'])
             except Exception as e:
                 messages.error(request, f"Error reading Excel file: {e}")
                 return redirect('select_imeis', request_id=request_id)
+            if rejected:
+                messages.warning(request, _rejection_report(rejected))
+            result = select_units(device_request, user, imei_numbers=imei_numbers)
 
         # --- Handle Manual Selection ---
-        selected_imei_ids = request.POST.getlist('selected_imeis')
-        if selected_imei_ids:
-            selected_imeis_qs = DeviceIMEI.objects.filter(
-                id__in=selected_imei_ids,
-                is_available=True
-            ).select_related('device')
-
-            if selected_imeis_qs.exists():
-                if selected_imeis_qs.count() > device_request.quantity:
-                    messages.warning(
-                        request,
-                        f"You selected {selected_imeis_qs.count()} IMEIs but the request asked for {device_request.quantity}."
-                    )
-
-                for imei_obj in selected_imeis_qs:
-                    SelectedDevice.objects.create(
-                        imei=imei_obj,
-                        device=imei_obj.device,  
-                        request=device_request,
-                        selected_by=request.user 
-                    )
-                    imei_obj.is_available = False
-                    imei_obj.save(update_fields=['is_available'])
-                    created += 1
-
-                # Update status
-                device_request.status = 'Waiting Approval'
-                device_request.save(update_fields=['status'])
-                messages.success(
-                    request, f"{created} IMEI(s) submitted for Request #{device_request.id}.")
-
-                # ====== Notify Admins ======
-                admins = User.objects.filter(is_superuser=True)
-                admin_emails = [a.email for a in admins if a.email]
-                if admin_emails:
-                    subject = f"Device Request #{device_request.id} Pending Approval"
-                    message = (
-                        f"Hello Admin,\n\n"
-                        f"The store clerk {user.username} has submitted IMEIs for the following request:\n"
-                        f"Device: {device_request.device.name}\n"
-                        f"Quantity: {device_request.quantity}\n"
-                        f"Requestor: {device_request.requestor.username}\n"
-                        f"Client: {device_request.client.name if device_request.client else 'N/A'}\n\n"
-                        f"Please review and approve or reject the request."
-                    )
-                    send_mail(subject, message, from_email=None, recipient_list=admin_emails, fail_silently=False)
-
-                return redirect('issue_device')
-
-            else:
+        else:
+            selected_imei_ids = [int(pk) for pk in request.POST.getlist('selected_imeis') if pk.isdigit()]
+            if not selected_imei_ids:
                 messages.error(
-                    request, "Selected IMEIs are no longer available.")
+                    request, "Please select at least one IMEI or upload an Excel file.")
                 return redirect('select_imeis', request_id=request_id)
+            result = select_units(device_request, user, imei_ids=selected_imei_ids)
 
-        else:
-            messages.error(
-                request, "Please select at least one IMEI or upload an Excel file.")
+        _report_selection(request, device_request, result)
+        if not result['selected']:
             return redirect('select_imeis', request_id=request_id)
 
+        # Update status
+        device_request.status = 'Waiting Approval'
+        device_request.save(update_fields=['status'])
+
+        # ====== Notify Admins ======
+        admins = User.objects.filter(is_superuser=True)
+        admin_emails = [a.email for a in admins if a.email]
+        if admin_emails:
+            subject = f"Device Request #{device_request.id} Pending Approval"
+            message = (
+                f"Hello Admin,\n\n"
+                f"The store clerk {user.username} has submitted IMEIs for the following request:\n"
+                f"Device: {device_request.device.name}\n"
+                f"Quantity: {device_request.quantity}\n"
+                f"Requestor: {device_request.requestor.username}\n"
+                f"Client: {device_request.client.name if device_request.client else 'N/A'}\n\n"
+                f"Please review and approve or reject the request."
+            )
+            send_mail(subject, message, from_email=None, recipient_list=admin_emails, fail_silently=False)
+
+        return redirect('issue_device')
+
+    # Candidates are fetched page by page from select_imei_candidates
     context = {
         'device_request': device_request,
-        'available_imeis': available_imeis,
-        'query': query,
-        'available_count': available_count,
+        'page_size': CANDIDATE_PAGE_SIZE,
     }
     return render(request, 'invent/select_imeis.html', context)
 
 
+CANDIDATE_PAGE_SIZE = 100
+CANDIDATE_MAX_PAGE_SIZE = 500
+
+
+@login_required
+@permission_required('invent.can_issue_item', raise_exception=True)
+def select_imei_candidates(request, request_id):
+    """
+    JSON page of units that can be picked for a request, in id order.
+    ?cursor= is the last id of the previous page; ?prefix= / ?suffix= match the
+    IMEI number, ?q= the IMEI or serial anywhere. The total is only counted on
+    the first page.
+    """
+    device_request = get_object_or_404(DeviceRequest.objects.select_related('device'), id=request_id)
+    requested_device = device_request.device
+
+    candidates = DeviceIMEI.objects.filter(
+        available_unit_q(),
+        device__name=requested_device.name,
+        device__oem_id=requested_device.oem_id,
+    )
+
+    prefix = request.GET.get('prefix', '').strip()
+    suffix = request.GET.get('suffix', '').strip()
+    query = request.GET.get('q', '').strip()
+    if prefix:
+        candidates = candidates.filter(imei_prefix_q(prefix))
+    if suffix:
+        candidates = candidates.filter(imei_number__endswith=suffix)
+    if query:
+        candidates = candidates.filter(Q(imei_number__icontains=query) | Q(serial_no__icontains=query))
+
+    try:
+        limit = min(max(int(request.GET.get('limit', CANDIDATE_PAGE_SIZE)), 1), CANDIDATE_MAX_PAGE_SIZE)
+        cursor = int(request.GET.get('cursor', 0))
+    except ValueError:
+        return JsonResponse({'error': 'cursor and limit must be integers'}, status=400)
+
+    data = {}
+    if not cursor:
+        data['count'] = candidates.count()
+
+    page = list(
+        candidates.filter(id__gt=cursor)
+        .order_by('id')
+        .values_list('id', 'imei_number', 'serial_no', 'device__name', 'is_available')[:limit + 1]
+    )
+    has_more = len(page) > limit
+    page = page[:limit]
+
+    data['results'] = [
+        {
+            'id': pk, 'imei_number': imei_number, 'serial_no': serial_no,
+            'device': device_name, 'hold_expired': not is_available,
+        }
+        for pk, imei_number, serial_no, device_name, is_available in page
+    ]
+    data['next'] = page[-1][0] if has_more else None
+    return JsonResponse(data)
+
+
 @login_required
 @permission_required('invent.can_issue_item', raise_exception=True)
 def submit_devices_for_approval(request):
@@ -1023,6 +1115,7 @@ def approve_device_selection(request):
                 device_request = sel.device_request
                 device_request.status = 'Rejected'
                 device_request.save(update_fields=['status'])
+                release_reservations([device_request])
 
             messages.warning(
                 request, f"Selection for Request {device_request.id} rejected.")
@@ -1037,7 +1130,7 @@ def approve_device_selection(request):
     pending_selections = (
         DeviceSelectionGroup.objects
         .filter(status='Pending')
-        .select_related('device_request', 'store_clerk')
+        .select_related('device_request__client', 'device_request__order', 'store_clerk')
         .prefetch_related('devices')
         .order_by('-created_at')
     )
@@ -1079,22 +1172,40 @@ def issue_approved_devices(request):
         messages.error(request, "No client linked to this request.")
         return redirect('issue_device')
 
-    with transaction.atomic():
-        for device in sel.devices.select_for_update():  # lock rows
-            if device.status != 'available' and device.status != 'reserved':
-                messages.error(request, f"Device {device} is not available.")
-                return redirect('issue_device')
-            device.status = 'issued'
-            device.save(update_fields=['status'])
-            IssuanceRecord.objects.create(
-                device=device,
-                client=client,
-                logistics_manager=request.user,
-                device_request=device_request
-            )
-        device_request.status = 'Issued'
-        device_request.date_issued = timezone.now()
-        device_request.save(update_fields=['status', 'date_issued'])
+    try:
+        with transaction.atomic():
+            # Fill the requested quantity from the group's devices, oldest units first
+            remaining = device_request.quantity or 1
+            records = []
+            for device in sel.devices.order_by('id'):
+                if remaining <= 0:
+                    break
+                units = allocate_units(device, remaining, strict=False)
+                if not units:
+                    continue
+                remaining -= len(units)
+                device.status = 'issued'
+                device.save(update_fields=['status'])
+                records += [
+                    IssuanceRecord(
+                        device=device,
+                        client=client,
+                        logistics_manager=request.user,
+                        device_request=device_request,
+                        imei_obj=imei_obj
+                    )
+                    for imei_obj in units
+                ]
+            if remaining > 0:
+                raise AllocationError(f"{remaining} unit(s) short for the approved selection.")
+            IssuanceRecord.objects.bulk_create(records, batch_size=500)
+            record_issuances(records)
+            device_request.status = 'Issued'
+            device_request.date_issued = timezone.now()
+            device_request.save(update_fields=['status', 'date_issued'])
+    except AllocationError as e:
+        messages.error(request, f"Request {device_request.id} could not be issued: {e}")
+        return redirect('issue_device')
 
     messages.success(
         request, f"Devices for Request {device_request.id} issued successfully.")
@@ -1124,10 +1235,13 @@ def return_device(request):
         with transaction.atomic():
             device.status = 'returned'
             device.save()
-            ReturnRecord.objects.create(
-                device=device, client=client, reason=reason)
+            # Return the unit of this device most recently issued to the client
+            unit_ids = ClientHolding.objects.filter(
+                client=client, device=device
+            ).order_by('-issued_at').values_list('imei_id', flat=True)[:1]
+            record_return(device, client, reason, unit_ids)
             messages.success(
-                request, f"Device {device.imei_no} returned by {client.name}.")
+                request, f"Device {device.name} returned by {client.name}.")
         return redirect('return_device')
     return render(request, 'invent/return_device.html', {
         'issued_devices': issued_devices,
@@ -1191,6 +1305,201 @@ def client_list(request):
 
     return render(request, 'invent/client_list.html', {'form': form})
 
+# --- Client Holdings ---
+
+
+def _holdings_for_user(user, client):
+    holdings = ClientHolding.objects.filter(client=client)
+    if not user.is_superuser:
+        user_country = getattr(user.profile, "country", None)
+        holdings = holdings.filter(device__branch__country=user_country)
+    return holdings
+
+
+HOLDING_FIELDS = (
+    'imei__imei_number', 'imei__serial_no', 'imei__mac_address',
+    'device__name', 'device__category', 'device__oem__name',
+    'issuance__device_request_id', 'issued_at',
+)
+
+
+@login_required
+@permission_required('invent.view_device', raise_exception=True)
+def client_holdings(request, client_id=None):
+    """
+    What a client currently holds, read from the ClientHolding index.
+    ?format=csv streams the full list.
+    """
+    clients = Client.objects.annotate(units_held=Count('holdings')).order_by('name')
+    client = get_object_or_404(Client, id=client_id) if client_id else None
+
+    if client is None:
+        return render(request, 'invent/client_holdings.html', {'clients': clients})
+
+    holdings = _holdings_for_user(request.user, client)
+
+    if request.GET.get('format') == 'csv':
+        writer = csv.writer(Echo())
+        header = ['IMEI', 'Serial', 'MAC', 'Device', 'Category', 'OEM', 'Request', 'Issued At']
+        rows = holdings.order_by('device__name', 'imei__imei_number').values_list(*HOLDING_FIELDS)
+        response = StreamingHttpResponse(
+            (writer.writerow(row) for row in itertools.chain([header], rows.iterator(chunk_size=2000))),
+            content_type='text/csv',
+        )
+        response['Content-Disposition'] = f'attachment; filename=client_{client.id}_holdings.csv'
+        return response
+
+    summary = (
+        holdings.values('device__name', 'device__category', 'device__oem__name')
+        .annotate(units=Count('id'))
+        .order_by('-units')
+    )
+    page_obj = Paginator(
+        holdings.select_related('imei', 'device').order_by('device__name', 'imei__imei_number'), 50
+    ).get_page(request.GET.get('page'))
+
+    context = {
+        'clients': clients,
+        'client': client,
+        'summary': summary,
+        'total_units': page_obj.paginator.count,
+        'page_obj': page_obj,
+    }
+    return render(request, 'invent/client_holdings.html', context)
+
+
+@login_required
+@permission_required('invent.view_device', raise_exception=True)
+def client_holdings_json(request, client_id):
+    client = get_object_or_404(Client, id=client_id)
+    rows = _holdings_for_user(request.user, client).order_by('device__name', 'imei__imei_number')
+    units = [
+        {
+            'imei': imei, 'serial_no': serial_no, 'mac_address': mac,
+            'device': device, 'category': category, 'oem': oem,
+            'request_id': request_id, 'issued_at': issued_at,
+        }
+        for imei, serial_no, mac, device, category, oem, request_id, issued_at
+        in rows.values_list(*HOLDING_FIELDS).iterator(chunk_size=2000)
+    ]
+    return JsonResponse({'client': {'id': client.id, 'name': client.name}, 'count': len(units), 'units': units})
+
+
+# --- Protected Media (payment proofs, PO documents) ---
+
+
+def _document_in_scope(user, name):
+    """A document is visible to its requestor and to staff of the branch or country it belongs to."""
+    if user.is_superuser:
+        return DeviceOrder.objects.filter(payment_proof=name).exists() or \
+            DeviceRequest.objects.filter(payment_proof=name).exists() or \
+            PurchaseOrder.objects.filter(document=name).exists()
+
+    profile = getattr(user, "profile", None)
+    branch = getattr(profile, "branch", None)
+    country = getattr(profile, "country", None)
+
+    line_scope = Q(requestor=user)
+    po_scope = Q(pk__in=[])
+    if branch:
+        line_scope |= Q(branch=branch)
+        po_scope |= Q(branch=branch)
+    if country:
+        line_scope |= Q(branch__country=country) | Q(country=country)
+        po_scope |= Q(branch__country=country)
+
+    return DeviceRequest.objects.filter(line_scope).filter(
+        Q(payment_proof=name) | Q(order__payment_proof=name)
+    ).exists() or PurchaseOrder.objects.filter(po_scope, document=name).exists()
+
+
+def _parse_range(header, size):
+    """(start, end) for a single 'bytes=' range, or None to send the whole file."""
+    unit, _, spec = (header or "").partition("=")
+    if unit.strip() != "bytes" or "," in spec:
+        return None
+    first, _, last = spec.strip().partition("-")
+    try:
+        if first:
+            start, end = int(first), int(last) if last else size - 1
+        else:
+            start, end = size - int(last), size - 1
+    except ValueError:
+        return None
+    start, end = max(start, 0), min(end, size - 1)
+    return (start, end) if start <= end else (size, size)
+
+
+def _read_range(path, start, length, chunk_size=64 * 1024):
+    with open(path, "rb") as f:
+        f.seek(start)
+        while length > 0:
+            chunk = f.read(min(chunk_size, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+
+
+@login_required
+def protected_media(request, name):
+    """
+    Serve an uploaded document after a scope check. With PROTECTED_MEDIA_SENDFILE
+    set, the transfer is handed to the front proxy (X-Accel-Redirect for nginx,
+    X-Sendfile for Apache/lighttpd); otherwise the file is streamed here with
+    Range support and conditional caching headers.
+    """
+    storage = DeviceOrder._meta.get_field("payment_proof").storage
+    name = posixpath.normpath(name).lstrip("/")
+    original = name[:-len(THUMBNAIL_SUFFIX)] if name.endswith(THUMBNAIL_SUFFIX) else name
+    if original.startswith("..") or not _document_in_scope(request.user, original) or not storage.exists(original):
+        raise Http404("Document not found.")
+    # Thumbnails are rendered in the background on upload; older proofs get theirs on first view
+    if name != original and not storage.exists(name) and not make_thumbnail(original, storage):
+        raise Http404("No preview available.")
+
+    path = storage.path(name)
+    stat = os.stat(path)
+    content_type = mimetypes.guess_type(name)[0] or "application/octet-stream"
+    etag = quote_etag(f"{stat.st_size:x}-{int(stat.st_mtime):x}")
+    headers = {
+        "ETag": etag,
+        "Last-Modified": http_date(stat.st_mtime),
+        "Cache-Control": "private, max-age=3600",
+        "Accept-Ranges": "bytes",
+        "Content-Disposition": content_disposition_header(False, posixpath.basename(name)),
+    }
+
+    if request.headers.get("If-None-Match") == etag:
+        response = HttpResponse(status=304)
+    elif settings.PROTECTED_MEDIA_SENDFILE == "x-accel-redirect":
+        response = HttpResponse(content_type=content_type)
+        response["X-Accel-Redirect"] = settings.PROTECTED_MEDIA_INTERNAL_URL + quote(name)
+    elif settings.PROTECTED_MEDIA_SENDFILE == "x-sendfile":
+        response = HttpResponse(content_type=content_type)
+        response["X-Sendfile"] = path
+    else:
+        byte_range = None
+        if request.headers.get("If-Range", etag) == etag:
+            byte_range = _parse_range(request.headers.get("Range"), stat.st_size)
+        if byte_range is None:
+            response = FileResponse(open(path, "rb"), content_type=content_type)
+        elif byte_range[0] >= stat.st_size:
+            response = HttpResponse(status=416)
+            response["Content-Range"] = f"bytes */{stat.st_size}"
+        else:
+            start, end = byte_range
+            response = StreamingHttpResponse(
+                _read_range(path, start, end - start + 1), status=206, content_type=content_type
+            )
+            response["Content-Length"] = str(end - start + 1)
+            response["Content-Range"] = f"bytes {start}-{end}/{stat.st_size}"
+
+    for header, value in headers.items():
+        response[header] = value
+    return response
+
+
 # --- Stock Adjustment/Search ---
 
 
@@ -1210,25 +1519,18 @@ def adjust_stock(request):
 
     # Apply search query
     if query:
-        devices = devices.filter(
-            Q(imei_no__icontains=query) |
-            Q(serial_no__icontains=query) |
+        devices = devices.filter(identifier_search_q(
+            query,
+            Q(imeis__imei_number__icontains=query) |
+            Q(imeis__serial_no__icontains=query) |
             Q(name__icontains=query) |
             Q(category__icontains=query) |
-            Q(issuancerecord__client__name__icontains=query)
-        ).distinct()
+            Q(current_client__name__icontains=query),
+            'imeis__',
+        )).distinct()
 
-    # Annotate with last issuance info
-    for device in devices:
-        last_issuance = (
-            IssuanceRecord.objects
-            .filter(device=device)
-            .order_by('-issued_at')
-            .select_related('client')
-            .first()
-        )
-        device.current_client = last_issuance.client if last_issuance else None
-        device.issued_at = last_issuance.issued_at if last_issuance else None
+    # Current holder is a column on Device (see invent.issuance)
+    devices = devices.select_related('current_client')
 
     context = {
         'devices': devices,
@@ -1310,7 +1612,7 @@ def reports_view(request):
     # --- Annotate devices with counts ---
     devices_qs = devices_qs.annotate(
         total_quantity=Count('imeis'),
-        available_quantity=Count('imeis', filter=Q(imeis__is_available=True))
+        available_quantity=Count('imeis', filter=available_unit_q('imeis__'))
     )
 
     total_items = devices_qs.aggregate(total=Sum('total_quantity'))['total'] or 0
@@ -1357,6 +1659,134 @@ def reports_view(request):
 
 
 
+# --- Demand & Turnover Analytics (Reports) ---
+
+ANALYTICS_COLUMNS = [
+    ('Branch', 'branch'),
+    ('Category', 'category'),
+    ('OEM', 'oem'),
+    ('Device', 'device'),
+    ('Available', 'available'),
+    ('Requested', 'requested'),
+    ('Issued', 'issued'),
+    ('Returned', 'returned'),
+    ('Demand / Week', 'demand_per_week'),
+    ('Current Demand / Week', 'current_demand_per_week'),
+    ('Peak Demand / Week', 'peak_demand_per_week'),
+    ('Avg Days to Issue', 'avg_days_to_issue'),
+    ('Median Days to Issue', 'median_days_to_issue'),
+    ('P90 Days to Issue', 'p90_days_to_issue'),
+    ('Return Rate %', 'return_rate'),
+    ('Weeks of Cover', 'weeks_of_cover'),
+]
+
+ANALYTICS_BRANCH_COLUMNS = [
+    c for c in ANALYTICS_COLUMNS
+    if c[1] not in ('category', 'oem', 'device', 'peak_demand_per_week', 'median_days_to_issue', 'p90_days_to_issue')
+]
+
+
+def _report_country(user):
+    """
+    Country a user's reports are scoped to: None (every country) for a
+    superuser. Staff without a country see no data rather than everyone's.
+    """
+    if user.is_superuser:
+        return None
+    country = getattr(user.profile, "country", None)
+    if country is None:
+        raise PermissionDenied("Your profile has no country assigned, so there is no data to report.")
+    return country
+
+
+def _analytics_for_user(user):
+    return get_device_analytics(country=_report_country(user))
+
+
+@login_required
+@permission_required('invent.view_device', raise_exception=True)
+def analytics_view(request):
+    analytics = _analytics_for_user(request.user)
+    context = {
+        'rows': analytics['rows'],
+        'branches': analytics['branches'],
+        'history_days': analytics['history_days'],
+        'rolling_weeks': analytics['rolling_weeks'],
+        'generated_at': analytics['generated_at'],
+    }
+    return render(request, 'invent/analytics.html', context)
+
+
+@login_required
+@permission_required('invent.view_device', raise_exception=True)
+def export_analytics(request):
+    analytics = _analytics_for_user(request.user)
+
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet("Device Analytics")
+    ws.append([label for label, _ in ANALYTICS_COLUMNS])
+    for row in analytics['rows']:
+        ws.append([row[key] if row[key] is not None else "-" for _, key in ANALYTICS_COLUMNS])
+
+    ws = wb.create_sheet("Branch Summary")
+    ws.append([label for label, _ in ANALYTICS_BRANCH_COLUMNS])
+    for row in analytics['branches']:
+        ws.append([row[key] if row[key] is not None else "-" for _, key in ANALYTICS_BRANCH_COLUMNS])
+
+    response = HttpResponse(
+        content_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+    )
+    response['Content-Disposition'] = 'attachment; filename=device_analytics.xlsx'
+    wb.save(response)
+    return response
+
+
+class Echo:
+    """File-like object whose write() hands the row back, for streaming csv.writer output."""
+
+    def write(self, value):
+        return value
+
+
+@login_required
+@permission_required('invent.view_device', raise_exception=True)
+def export_pivot(request):
+    """
+    Branch x device x month matrix of units requested, issued and returned.
+    ?format=csv streams CSV; anything else returns a write-only XLSX workbook.
+    """
+    try:
+        months = min(max(int(request.GET.get('months', 12)), 1), 60)
+    except ValueError:
+        months = 12
+
+    row_labels, month_labels, matrix = build_pivot(country=_report_country(request.user), months=months)
+    rows = iter_pivot_rows(row_labels, month_labels, matrix)
+
+    if request.GET.get('format') == 'csv':
+        writer = csv.writer(Echo())
+        response = StreamingHttpResponse(
+            (writer.writerow(row) for row in rows), content_type='text/csv'
+        )
+        response['Content-Disposition'] = 'attachment; filename=branch_device_month_pivot.csv'
+        return response
+
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet("Pivot")
+    for row in rows:
+        ws.append(row)
+
+    tmp = tempfile.TemporaryFile()
+    wb.save(tmp)
+    tmp.seek(0)
+    return FileResponse(
+        tmp,
+        as_attachment=True,
+        filename='branch_device_month_pivot.xlsx',
+        content_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+    )
+
+
 # --- Total Requests Table/Export (Reports) ---
 
 
@@ -1426,26 +1856,28 @@ def export_grouped_inventory(request):
     status = request.GET.get('status', 'all')
     user = request.user
 
+    # One row per physical unit; the current holder is read from DeviceIMEI columns
     if user.is_superuser:
-        devices = Device.objects.select_related(
-            'oem', 'branch').order_by('category', 'oem__name', 'id')
+        units = DeviceIMEI.objects.all()
     else:
         user_country = getattr(user.profile, "country", None)
-        devices = Device.objects.select_related('oem', 'branch').filter(
-            branch__country=user_country).order_by('category', 'oem__name', 'id')
+        units = DeviceIMEI.objects.filter(device__branch__country=user_country)
+
+    units = units.select_related('device__oem', 'current_client').order_by(
+        'device__category', 'device__oem__name', 'device_id', 'id')
 
     if status and status != 'all':
-        devices = devices.filter(status=status)
+        units = units.filter(device__status=status)
     if query:
-        devices = devices.filter(
-            Q(imei_no__icontains=query) |
+        units = units.filter(identifier_search_q(
+            query,
+            Q(imei_number__icontains=query) |
             Q(serial_no__icontains=query) |
-            Q(name__icontains=query) |
-            Q(category__icontains=query) |
-            Q(oem__name__icontains=query) |
-            Q(oem__oem_id__icontains=query) |
-            Q(issuancerecord__client__name__icontains=query)
-        ).distinct()
+            Q(device__name__icontains=query) |
+            Q(device__category__icontains=query) |
+            Q(device__oem__name__icontains=query) |
+            Q(current_client__name__icontains=query),
+        ))
 
     wb = openpyxl.Workbook()
     ws = wb.active
@@ -1455,28 +1887,18 @@ def export_grouped_inventory(request):
                'IMEI', 'Serial', 'Status', 'Client', 'Issued At']
     ws.append(headers)
 
-    for device in devices:
-        last_issuance = (
-            IssuanceRecord.objects
-            .filter(device=device)
-            .order_by('-issued_at')
-            .select_related('client')
-            .first()
-        )
-        client_name = last_issuance.client.name if last_issuance and last_issuance.client else "-"
-        issued_at = last_issuance.issued_at.strftime(
-            '%Y-%m-%d %H:%M') if last_issuance and last_issuance.issued_at else "-"
+    for unit in units.iterator(chunk_size=2000):
+        device = unit.device
         ws.append([
             device.category or "-",
             device.name or "-",
             device.oem.name if device.oem else "-",
-            device.oem.oem_id if device.oem else "-",
-            device.imei_no or "-",
-            device.serial_no or "-",
-            device.get_status_display() if hasattr(
-                device, "get_status_display") else device.status,
-            client_name,
-            issued_at
+            device.oem.id if device.oem else "-",
+            unit.imei_number or "-",
+            unit.serial_no or "-",
+            "Available" if unit.is_available else "Issued",
+            unit.current_client.name if unit.current_client else "-",
+            unit.issued_at.strftime('%Y-%m-%d %H:%M') if unit.issued_at else "-"
         ])
 
     for i, col in enumerate(headers, 1):
@@ -1506,26 +1928,33 @@ def export_total_requests(request):
     if status_filter:
         queryset = queryset.filter(status=status_filter)
 
+    # Latest issuance per request, fetched in one extra query instead of one per row
+    queryset = queryset.prefetch_related(Prefetch(
+        "issuances",
+        queryset=IssuanceRecord.objects.select_related("imei", "imei_obj").order_by("-issued_at"),
+    ))
+
     # Workbook setup
     wb = openpyxl.Workbook()
     ws = wb.active
     ws.title = "Device Requests"
 
-    headers = ["Category", "IMEI", "Serial", "Status", "Client", "Issued At"]
+    headers = ["Order", "Category", "IMEI", "Serial", "Status", "Client", "Issued At"]
     ws.append(headers)
 
     for req in queryset:
         device = req.device
 
         # Get latest issuance for this request
-        issuance = IssuanceRecord.objects.select_related("imei").filter(
-            device_request=req
-        ).order_by("-issued_at").first()
+        issuances = req.issuances.all()
+        issuance = issuances[0] if issuances else None
+        unit = (issuance.imei or issuance.imei_obj) if issuance else None
 
-        imei_number = issuance.imei.imei_number if issuance and issuance.imei else "-"
-        serial_number = issuance.imei.serial_no if issuance and issuance.imei else "-"
+        imei_number = unit.imei_number if unit else "-"
+        serial_number = (unit.serial_no or "-") if unit else "-"
 
         ws.append([
+            f"#{req.order_id}" if req.order_id else "-",
             device.category if device and device.category else "-",
             imei_number,
             serial_number,
@@ -1554,28 +1983,26 @@ def export_inventory_items(request):
     user = request.user
     # COUNTRY FILTER: Restrict by user's country
     if user.is_superuser:
-        queryset = Device.objects.all()
+        queryset = DeviceIMEI.objects.all()
     else:
         user_country = getattr(user.profile, "country", None)
-        queryset = Device.objects.filter(branch__country=user_country)
+        queryset = DeviceIMEI.objects.filter(device__branch__country=user_country)
     if status_filter:
-        queryset = queryset.filter(status=status_filter)
+        queryset = queryset.filter(device__status=status_filter)
+    queryset = queryset.select_related('device', 'current_client').order_by('device_id', 'id')
     wb = openpyxl.Workbook()
     ws = wb.active
     ws.title = "Inventory Items"
     headers = ['Category', 'IMEI', 'Serial', 'Status', 'Client', 'Issued At']
     ws.append(headers)
-    for device in queryset:
-        issuance = IssuanceRecord.objects.filter(
-            device=device
-        ).order_by('-issued_at').first()
+    for unit in queryset.iterator(chunk_size=2000):
         ws.append([
-            device.category,
-            device.imei_no,
-            device.serial_no or "-",
-            device.status,
-            issuance.client.name if issuance else "-",
-            issuance.issued_at.strftime('%Y-%m-%d %H:%M') if issuance else "-"
+            unit.device.category,
+            unit.imei_number,
+            unit.serial_no or "-",
+            unit.device.status,
+            unit.current_client.name if unit.current_client else "-",
+            unit.issued_at.strftime('%Y-%m-%d %H:%M') if unit.issued_at else "-"
         ])
     for i, col in enumerate(headers, 1):
         ws.column_dimensions[get_column_letter(i)].width = 20
@@ -1632,10 +2059,11 @@ def process_return_for_request(request, request_id):
             device = device_request.device
             device.status = 'returned'
             device.save()
-            ReturnRecord.objects.create(
-                device=device,
-                client=device_request.client,
-                reason=reason
+            record_return(
+                device,
+                device_request.client,
+                reason,
+                units_held_for_request(device_request, returned_quantity),
             )
             messages.success(
                 request, f"{returned_quantity} device(s) marked as returned.")
@@ -1657,6 +2085,21 @@ def request_list(request, status):
         'requests': requests
     })
 
+REJECTED_HELD = "Nothing was uploaded: {} row(s) rejected. Fix them, or tick 'Skip rejected rows' to receive the rest."
+
+
+def _rejected_rows(rejected):
+    """The first ten rejected rows, e.g. "row 5: IMEI '123' must be 15 digits"."""
+    shown = "; ".join(f"row {row}: {problem}" for row, problem in rejected[:10])
+    return shown + (f"; and {len(rejected) - 10} more" if len(rejected) > 10 else "")
+
+
+def _rejection_report(rejected, held=False):
+    if held:
+        return f"{REJECTED_HELD.format(len(rejected))} ({_rejected_rows(rejected)})"
+    return f"{len(rejected)} rejected row(s) were skipped ({_rejected_rows(rejected)})."
+
+
 @login_required
 @permission_required('invent.add_device', raise_exception=True)
 def upload_inventory(request):
@@ -1678,89 +2121,243 @@ def upload_inventory(request):
             return redirect("upload_inventory")
 
         # =====================
-        # Load Excel
+        # Validate every row, then insert, deduplicated in chunks
         # =====================
-        try:
-            wb = openpyxl.load_workbook(excel_file)
-            sheet = wb.active
-        except Exception:
-            messages.error(request, "Invalid Excel file. Upload a valid .xlsx file.")
+        sheet = parse_unit_sheet(excel_file, excel_file.name, defaults={'oem': oem_name, 'category': category, 'name': name})
+        if sheet['error']:
+            messages.error(request, sheet['error'])
+            return redirect("upload_inventory")
+        skip_rejected = bool(request.POST.get('skip_rejected'))
+        if sheet['rejected'] and not skip_rejected:
+            messages.error(request, _rejection_report(sheet['rejected'], held=True))
             return redirect("upload_inventory")
 
-        header = [str(cell.value).strip().lower() for cell in sheet[1] if cell.value]
-        header_index_map = {h: i for i, h in enumerate(header)}
+        device = receiving_device(request.user, oem_name, category, name)
+        added_count, skipped_count = ingest_units(device, sheet['units'])
 
-        if not any(col in header_index_map for col in ["imei no", "serial no"]):
+        messages.success(
+            request,
+            f"Upload complete: {added_count} devices added, {skipped_count} skipped."
+        )
+        if sheet['rejected']:
+            messages.warning(request, _rejection_report(sheet['rejected']))
+        return redirect("inventory_list")
+
+    return render(request, "invent/upload_inventory.html", {"chunk_size": CHUNK_SIZE})
+
+
+@login_required
+@permission_required('invent.add_device', raise_exception=True)
+@require_POST
+def upload_inventory_batch(request):
+    """
+    Multi-model shipment: several workbooks, one sheet per model. Each sheet
+    names its device in an OEM / Category / Device preamble, or by its title.
+    """
+    files = request.FILES.getlist('workbooks')
+    if not files:
+        messages.error(request, "Please upload at least one Excel file.")
+        return redirect("upload_inventory")
+
+    defaults = {
+        'oem': request.POST.get('oem', '').strip(),
+        'category': request.POST.get('category', '').strip(),
+    }
+    with tempfile.TemporaryDirectory() as workdir:
+        workbooks = []
+        for index, upload in enumerate(files):
+            path = os.path.join(workdir, f"{index}.xlsx")
+            with open(path, 'wb') as out:
+                for chunk in upload.chunks():
+                    out.write(chunk)
+            workbooks.append((path, os.path.basename(upload.name)))
+
+        # Unreadable workbooks come back as errors in the report; anything else is a bug
+        try:
+            report = receive_workbooks(
+                request.user, workbooks, defaults, skip_rejected=bool(request.POST.get('skip_rejected')))
+        except Exception:
+            logger.exception("Receiving a shipment of %d workbook(s) failed", len(workbooks))
             messages.error(
-                request, "Excel must contain at least 'IMEI No' or 'Serial No' column."
+                request,
+                "Receiving the shipment failed unexpectedly and the error has been logged. Units saved before "
+                "the failure are kept and will be skipped as duplicates if you upload again.",
             )
             return redirect("upload_inventory")
 
-        # =====================
-        # Get or create Device
-        # =====================
-        oem_obj, _ = OEM.objects.get_or_create(name=oem_name)
-
-        device, _ = Device.objects.get_or_create(
-            oem=oem_obj,
-            name=name,
-            category=category,
-            defaults={
-                "status": "available",
-                "branch": request.user.profile.branch if not request.user.is_superuser else None,
-                "country": request.user.profile.country if not request.user.is_superuser else None,
+    total_rejected = sum(len(sheet['rejected']) for sheet in report)
+    if total_rejected and not request.POST.get('skip_rejected'):
+        messages.error(request, REJECTED_HELD.format(total_rejected))
+        for sheet in report:
+            if sheet['rejected']:
+                messages.error(request, f"{sheet['source']}: {_rejected_rows(sheet['rejected'])}")
+        return redirect("upload_inventory")
+
+    for sheet in report:
+        if sheet['error']:
+            messages.error(request, f"{sheet['source']}: {sheet['error']}")
+        else:
+            if sheet['rejected']:
+                messages.warning(request, f"{sheet['source']}: {_rejection_report(sheet['rejected'])}")
+            messages.success(
+                request,
+                f"{sheet['source']} ({sheet['device'].name}): {sheet['added']} devices added, {sheet['skipped']} skipped."
+            )
+    return redirect("inventory_list")
+
+
+# --- Resumable chunked upload for large inventory workbooks ---
+# init (POST) -> status (GET) / chunk (PUT, raw body) -> finalize (POST)
+
+
+@login_required
+@permission_required('invent.add_device', raise_exception=True)
+@require_POST
+def upload_inventory_chunked_init(request):
+    try:
+        status = start_upload(request.user, request.POST.get("filename"), request.POST.get("size"))
+    except UploadError as e:
+        return JsonResponse({"error": str(e)}, status=400)
+    return JsonResponse(status, status=201)
+
+
+@login_required
+@permission_required('invent.add_device', raise_exception=True)
+def upload_inventory_chunk(request, upload_id, number=None):
+    """GET: which chunks have arrived (to resume). PUT .../<number>/: store one chunk."""
+    try:
+        meta = load_upload(request.user, upload_id)
+        if request.method == "PUT" and number is not None:
+            write_chunk(meta, number, request)
+        elif request.method != "GET":
+            return JsonResponse({"error": "Method not allowed."}, status=405)
+    except UploadError as e:
+        return JsonResponse({"error": str(e)}, status=400)
+    return JsonResponse(upload_status(meta))
+
+
+@login_required
+@permission_required('invent.add_device', raise_exception=True)
+@require_POST
+def upload_inventory_chunked_finalize(request, upload_id):
+    oem_name = request.POST.get("oem")
+    category = request.POST.get("category")
+    name = request.POST.get("name")
+    if not all([oem_name, category, name]):
+        return JsonResponse({"error": "Please provide OEM, category, and device name."}, status=400)
+
+    try:
+        meta = load_upload(request.user, upload_id)
+        path = assemble_upload(meta)
+    except UploadError as e:
+        return JsonResponse({"error": str(e)}, status=400)
+
+    sheet = parse_unit_sheet(path, meta['filename'], defaults={'oem': oem_name, 'category': category, 'name': name})
+    if sheet['error']:
+        discard_upload(meta)
+        return JsonResponse({"error": sheet['error']}, status=400)
+    if sheet['rejected'] and not request.POST.get('skip_rejected'):
+        # The assembled file is kept, so finalizing again with skip_rejected needs no re-upload
+        return JsonResponse(
+            {"error": _rejection_report(sheet['rejected'], held=True), "rejected": len(sheet['rejected'])}, status=400)
+
+    try:
+        device = receiving_device(request.user, oem_name, category, name)
+        added_count, skipped_count = ingest_units(device, sheet['units'])
+    finally:
+        discard_upload(meta)
+
+    messages.success(
+        request,
+        f"Upload complete: {added_count} devices added, {skipped_count} skipped."
+    )
+    if sheet['rejected']:
+        messages.warning(request, _rejection_report(sheet['rejected']))
+    return JsonResponse({"added": added_count, "skipped": skipped_count, "redirect": reverse("inventory_list")})
+
+
+def _range_spec(entry, kind, check_digit):
+    """A range from a line of text ("SN000100-SN002099") or a {prefix, start, end, width} dict."""
+    if isinstance(entry, dict):
+        try:
+            return {
+                'prefix': str(entry.get('prefix', '')).strip(),
+                'start': int(entry['start']),
+                'end': int(entry['end']),
+                'width': int(entry.get('width', 0)),
             }
-        )
+        except (KeyError, TypeError, ValueError):
+            raise ValueError("Each range needs a numeric start and end.")
+    return parse_range(str(entry), kind, check_digit)
 
-        added_count = 0
-        skipped_count = 0
 
-        # =====================
-        # Process rows
-        # =====================
-        for row in sheet.iter_rows(min_row=2, values_only=True):
-            imei_number = (
-                str(row[header_index_map["imei no"]]).strip()
-                if "imei no" in header_index_map and row[header_index_map["imei no"]]
-                else None
-            )
-            serial_no = (
-                str(row[header_index_map["serial no"]]).strip()
-                if "serial no" in header_index_map and row[header_index_map["serial no"]]
-                else None
+def _receive_range_request(user, data, entries):
+    """
+    Validate and receive a range submission. `data` holds oem, category, name,
+    kind and check_digit. Returns (device, units, added, skipped); raises
+    ValueError, before anything is written, when the ranges are unusable.
+    """
+    oem_name, category, name = (str(data.get(k) or '').strip() for k in ('oem', 'category', 'name'))
+    if not all([oem_name, category, name]):
+        raise ValueError("Please provide OEM, category, and device name.")
+    kind = data.get('kind') or 'serial'
+    check_digit = data.get('check_digit') not in (None, '', False, 'false', '0')
+
+    ranges = [_range_spec(entry, kind, check_digit) for entry in entries if entry not in ('', None)]
+    units = check_ranges(ranges, kind, check_digit)
+    if kind == 'imei':
+        invalid = invalid_range_imeis(ranges, check_digit)
+        if invalid:
+            raise ValueError(
+                f"{len(invalid)} IMEI(s) in these ranges fail the check digit, starting with {invalid[0]}. "
+                "Nothing was received; tick \"Recompute check digit\" if the range counts the IMEI body."
             )
 
-            if not imei_number and not serial_no:
-                skipped_count += 1
-                continue
-
-            # =====================
-            # Duplicate checks
-            # =====================
-            if imei_number and DeviceIMEI.objects.filter(imei_number=imei_number).exists():
-                skipped_count += 1
-                continue
-
-            if serial_no and DeviceIMEI.objects.filter(serial_no=serial_no).exists():
-                skipped_count += 1
-                continue
-
-            # =====================
-            # Create IMEI record
-            # =====================
-            DeviceIMEI.objects.create(
-                device=device,
-                imei_number=imei_number,
-                serial_no=serial_no,
-                is_available=True
-            )
+    device = receiving_device(user, oem_name, category, name)
+    added, skipped = receive_ranges(device, ranges, kind, check_digit)
+    return device, units, added, skipped
 
-            added_count += 1
+
+@login_required
+@permission_required('invent.add_device', raise_exception=True)
+def receive_range(request):
+    """Receive consecutive serials or IMEIs from a packing list, one range per line."""
+    if request.method == 'POST':
+        try:
+            device, units, added, skipped = _receive_range_request(
+                request.user, request.POST, request.POST.get('ranges', '').splitlines())
+        except ValueError as e:
+            messages.error(request, str(e))
+            # Keep what was typed, so a long list of ranges can be corrected in place
+            return render(request, "invent/receive_range.html", {"form_data": request.POST})
 
         messages.success(
             request,
-            f"Upload complete: {added_count} devices added, {skipped_count} skipped."
+            f"Received {units} units into {device.name}: {added} devices added, {skipped} skipped as duplicates."
         )
         return redirect("inventory_list")
 
-    return render(request, "invent/upload_inventory.html")
+    return render(request, "invent/receive_range.html", {"form_data": {"kind": "serial", "check_digit": "on"}})
+
+
+@login_required
+@permission_required('invent.add_device', raise_exception=True)
+@require_POST
+def receive_range_api(request):
+    """
+    JSON body: {"oem", "category", "name", "kind": "serial" | "imei",
+    "check_digit": bool, "ranges": ["SN000100-SN002099" | {"prefix", "start",
+    "end", "width"}, ...]}.
+    """
+    try:
+        payload = json.loads(request.body or b'{}')
+    except ValueError:
+        return JsonResponse({"error": "Request body must be JSON."}, status=400)
+    if not isinstance(payload, dict) or not isinstance(payload.get('ranges'), list):
+        return JsonResponse({"error": "\"ranges\" must be a list of ranges."}, status=400)
+
+    try:
+        device, units, added, skipped = _receive_range_request(request.user, payload, payload['ranges'])
+    except ValueError as e:
+        return JsonResponse({"error": str(e)}, status=400)
+    return JsonResponse({"device": device.id, "units": units, "added": added, "skipped": skipped})